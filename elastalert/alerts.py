@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import cookielib
 import copy
 import datetime
 import json
@@ -7,8 +8,11 @@ import os
 import subprocess
 import sys
 
+import threading
 import time
+import urlparse
 import warnings
+import zlib
 
 from email.mime.text import MIMEText
 from email.utils import formatdate
@@ -17,28 +21,256 @@ from smtplib import SMTP
 from smtplib import SMTP_SSL
 from smtplib import SMTPAuthenticationError
 from smtplib import SMTPException
+from smtplib import SMTPServerDisconnected
 from socket import error
 
-import boto3
 import requests
-import stomp
-from exotel import Exotel
-from jira.client import JIRA
-from jira.exceptions import JIRAError
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests.packages.urllib3.util.retry import Retry
 from staticconf.loader import yaml_loader
-from texttable import Texttable
-from twilio.base.exceptions import TwilioRestException
-from twilio.rest import Client as TwilioClient
 
 from util import EAException
 from util import elastalert_logger
+from util import es_key_getter
+from util import LazyImport
 from util import lookup_es_key
 from util import pretty_ts
 from util import resolve_string
 from util import ts_now
 from util import ts_to_dt
 
+# Libraries which are only needed by some alerters are imported when they are first used
+boto3 = LazyImport('boto3')
+stomp = LazyImport('stomp')
+stomp_exception = LazyImport('stomp.exception')
+Exotel = LazyImport('exotel', 'Exotel')
+JIRA = LazyImport('jira.client', 'JIRA')
+jira_exceptions = LazyImport('jira.exceptions')
+Texttable = LazyImport('texttable', 'Texttable')
+TwilioClient = LazyImport('twilio.rest', 'Client')
+twilio_exceptions = LazyImport('twilio.base.exceptions')
+
+
+# Keep-alive sessions shared by the HTTP based alerters, see get_http_session
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+
+def get_http_session(url, proxies=None, retries=0):
+    """ Returns a requests Session to use for url. Sessions are shared by every alerter using the same scheme, host,
+    proxies and number of retries, so that connections are pooled and kept alive between alerts. Sessions do not
+    keep cookies, as alerters for different rules may authenticate to the same host with different credentials.
+
+    :param url: The URL which will be requested.
+    :param proxies: The proxies dictionary which will be used for the request.
+    :param retries: The number of times to retry failing to connect.
+    """
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc, tuple(sorted((proxies or {}).items())), retries)
+    with http_sessions_lock:
+        if key not in http_sessions:
+            session = requests.Session()
+            session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+            # Only failures to connect are retried, since a POST which reached the server may have been acted on
+            adapter = HTTPAdapter(max_retries=Retry(total=retries, connect=retries, read=False, redirect=False))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            http_sessions[key] = session
+        return http_sessions[key]
+
+
+class SMTPPool(object):
+    """ Keeps authenticated SMTP connections open between emails. Connections are keyed by everything used to
+    open them, such as the host, port, TLS settings and credentials. An idle connection is checked with NOOP
+    before it is reused, and is closed instead once it has been idle for longer than max_idle seconds. """
+
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key, connect, max_idle):
+        """ Returns an idle connection for key, or a new one from connect() if there is none which is usable. """
+        while True:
+            with self.lock:
+                if not self.idle.get(key):
+                    break
+                smtp, last_used = self.idle[key].pop()
+            if time.time() - last_used <= max_idle:
+                try:
+                    if smtp.noop()[0] == 250:
+                        return smtp
+                except (SMTPException, error):
+                    pass
+            self.close(smtp)
+        return connect()
+
+    def release(self, key, smtp):
+        with self.lock:
+            self.idle.setdefault(key, []).append((smtp, time.time()))
+
+    @staticmethod
+    def close(smtp):
+        try:
+            smtp.close()
+        except (SMTPException, error):
+            pass
+
+    def sendmail(self, key, connect, max_idle, from_addr, to_addrs, message):
+        """ Sends an email over a pooled connection, reconnecting once if the server has closed it. """
+        smtp = self.acquire(key, connect, max_idle)
+        try:
+            try:
+                smtp.sendmail(from_addr, to_addrs, message)
+            except SMTPServerDisconnected:
+                smtp = connect()
+                smtp.sendmail(from_addr, to_addrs, message)
+        except Exception:
+            self.close(smtp)
+            raise
+        self.release(key, smtp)
+
+
+# Connections shared by EmailAlerter and ElastAlert notification emails when smtp_keepalive is set
+smtp_pool = SMTPPool()
+
+
+class JiraCache(object):
+    """ Shares JIRA clients, and the priorities and fields fetched with them, between every JiraAlerter using the
+    same server and account, so that loading many JIRA rules does not make the same requests for each one.
+    Metadata is fetched again once it is older than the TTL given by the alerter. The results of searching for
+    existing tickets are kept for a short time, so that a burst of alerts does not repeat the same search.
+
+    Entries are keyed by a tuple of server, user and password. Each key has its own lock, held while its client and
+    metadata are fetched, so that slow JIRA servers hold up only the alerters which use them. """
+
+    def __init__(self):
+        self.clients = {}
+        self.metadata = {}
+        self.searches = {}
+        self.key_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, ttl):
+        """ Returns a client for key, along with the server's priorities and fields.
+
+        :param key: A tuple of server, user and password.
+        :param ttl: The number of seconds cached priorities and fields are used for.
+        :return: A tuple of client, priorities and fields.
+        """
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                client = self.clients.get(key)
+                metadata = self.metadata.get(key)
+            if client is None:
+                client = JIRA(key[0], basic_auth=key[1:])
+                with self.lock:
+                    self.clients[key] = client
+            if metadata is None or time.time() - metadata[0] > ttl:
+                priorities = client.priorities()
+                fields = client.fields()
+                metadata = (time.time(), priorities, fields)
+                with self.lock:
+                    self.metadata[key] = metadata
+            return (client,) + metadata[1:]
+
+    def search(self, key, client, jql, ttl):
+        """ Returns the issues matching jql, searching with client unless a search younger than ttl seconds is cached. """
+        with self.lock:
+            cached = self.searches.get((key, jql))
+            if cached and cached[0] > time.time():
+                return cached[1]
+        issues = client.search_issues(jql)
+        self.set_search(key, jql, issues, ttl)
+        return issues
+
+    def set_search(self, key, jql, issues, ttl):
+        """ Caches issues as the result of searching for jql for ttl seconds, dropping any expired searches. """
+        now = time.time()
+        with self.lock:
+            for search, (expires, _) in self.searches.items():
+                if expires <= now:
+                    del self.searches[search]
+            if ttl > 0:
+                self.searches[(key, jql)] = (now + ttl, issues)
+
+    def forget_search(self, key, jql):
+        with self.lock:
+            self.searches.pop((key, jql), None)
+
+
+# Clients and metadata shared by JiraAlerters
+jira_cache = JiraCache()
+
+
+stomp_connections = {}
+# Guards stomp_connections and stomp_connection_locks. Connecting holds only the lock for the connection's key,
+# so that a broker which does not respond holds up only the alerters which use it.
+stomp_connections_lock = threading.Lock()
+stomp_connection_locks = {}
+
+
+def get_stomp_connection(host_and_port, login, password, heartbeats=(0, 0), timeout=10):
+    """ Returns a connected STOMP connection, shared by every alerter using the same broker, credentials and heartbeats.
+    A connection which has been lost, for instance because the broker stopped sending heartbeats, is replaced.
+
+    :param host_and_port: A tuple of the broker's host and port.
+    :param heartbeats: A tuple of the heartbeat intervals to send and to expect, in milliseconds.
+    :param timeout: The number of seconds to wait for the broker to accept a new connection.
+    :raises EAException: If the broker did not accept the connection in time.
+    """
+    key = (host_and_port, login, password, heartbeats)
+    with stomp_connections_lock:
+        key_lock = stomp_connection_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        with stomp_connections_lock:
+            conn = stomp_connections.get(key)
+        if conn is not None and conn.is_connected():
+            return conn
+        if conn is not None:
+            try:
+                conn.disconnect()
+            except stomp_exception.StompException:
+                pass
+        conn = stomp.Connection([host_and_port], heartbeats=heartbeats)
+        conn.start()
+        conn.connect(login, password)
+        # Waits for the CONNECTED frame, so that the connection is usable as soon as it is returned
+        deadline = time.time() + timeout
+        while not conn.is_connected():
+            if time.time() >= deadline:
+                try:
+                    conn.disconnect()
+                except stomp_exception.StompException:
+                    pass
+                raise EAException('Timed out connecting to STOMP broker %s:%s' % (host_and_port))
+            time.sleep(0.05)
+        with stomp_connections_lock:
+            stomp_connections[key] = conn
+        return conn
+
+
+sns_clients = {}
+sns_clients_lock = threading.Lock()
+
+
+def get_sns_client(aws_access_key_id, aws_secret_access_key, region, profile):
+    """ Returns a boto3 SNS client, shared by every alerter using the same credentials, region and profile.
+    Clients are safe to use from several threads and keep their HTTPS connections open between alerts. """
+    key = (aws_access_key_id, aws_secret_access_key, region, profile)
+    with sns_clients_lock:
+        if key not in sns_clients:
+            session = boto3.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region,
+                profile_name=profile
+            )
+            sns_clients[key] = session.client('sns')
+        return sns_clients[key]
+
 
 class DateTimeEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -48,6 +280,59 @@ class DateTimeEncoder(json.JSONEncoder):
             return json.JSONEncoder.default(self, obj)
 
 
+def compile_alert_format(rule, option):
+    """ Compiles option, such as alert_text or alert_subject, into a function which formats it for a match.
+    The values for the format are looked up from the fields named by option_args, or option_kw, falling back
+    to top-level rule properties and then alert_missing_value.
+
+    :param rule: The rule configuration.
+    :param option: The name of the option containing the format string.
+    """
+    format_string = unicode(rule.get(option, ''))
+    missing = rule.get('alert_missing_value', '<MISSING VALUE>')
+
+    if option + '_args' in rule:
+        args = [(arg, es_key_getter(arg)) for arg in rule[option + '_args']]
+
+        def render(match):
+            values = []
+            for arg, getter in args:
+                value = getter(match)
+                # Support referencing other top-level rule properties
+                # This technically may not work if there is a top-level rule property with the same name
+                # as an es result key, since it would have been matched in the lookup above
+                if value is None:
+                    value = rule.get(arg) or None
+                values.append(missing if value is None else value)
+            return format_string.format(*values)
+    elif option + '_kw' in rule:
+        kws = [(name, kw_name, es_key_getter(name)) for name, kw_name in rule[option + '_kw'].items()]
+
+        def render(match):
+            kw = {}
+            for name, kw_name, getter in kws:
+                value = getter(match)
+                # Support referencing other top-level rule properties
+                if value is None:
+                    value = rule.get(name)
+                kw[kw_name] = missing if value is None else value
+            return format_string.format(**kw)
+    else:
+        def render(match):
+            return format_string
+    return render
+
+
+def get_alert_format(rule, option):
+    """ Returns compile_alert_format(rule, option), compiling it the first time it is used with the rule,
+    and again if the options it was compiled from have changed since. """
+    options = [rule.get(name) for name in (option, option + '_args', option + '_kw', 'alert_missing_value')]
+    formats = rule.setdefault('_alert_formats', {})
+    if option not in formats or formats[option][0] != options:
+        formats[option] = (copy.deepcopy(options), compile_alert_format(rule, option))
+    return formats[option][1]
+
+
 class BasicMatchString(object):
     """ Creates a string containing fields in match for the given rule. """
 
@@ -56,60 +341,36 @@ class BasicMatchString(object):
         self.match = match
 
     def _ensure_new_line(self):
-        while self.text[-2:] != '\n\n':
-            self.text += '\n'
+        tail = ''
+        for part in reversed(self.text):
+            tail = part + tail
+            if len(tail) >= 2:
+                break
+        tail = tail[-2:]
+        while tail != '\n\n':
+            self.text.append('\n')
+            tail = (tail + '\n')[-2:]
 
     def _add_custom_alert_text(self):
-        missing = self.rule.get('alert_missing_value', '<MISSING VALUE>')
-        alert_text = unicode(self.rule.get('alert_text', ''))
-        if 'alert_text_args' in self.rule:
-            alert_text_args = self.rule.get('alert_text_args')
-            alert_text_values = [lookup_es_key(self.match, arg) for arg in alert_text_args]
-
-            # Support referencing other top-level rule properties
-            # This technically may not work if there is a top-level rule property with the same name
-            # as an es result key, since it would have been matched in the lookup_es_key call above
-            for i in xrange(len(alert_text_values)):
-                if alert_text_values[i] is None:
-                    alert_value = self.rule.get(alert_text_args[i])
-                    if alert_value:
-                        alert_text_values[i] = alert_value
-
-            alert_text_values = [missing if val is None else val for val in alert_text_values]
-            alert_text = alert_text.format(*alert_text_values)
-        elif 'alert_text_kw' in self.rule:
-            kw = {}
-            for name, kw_name in self.rule.get('alert_text_kw').items():
-                val = lookup_es_key(self.match, name)
-
-                # Support referencing other top-level rule properties
-                # This technically may not work if there is a top-level rule property with the same name
-                # as an es result key, since it would have been matched in the lookup_es_key call above
-                if val is None:
-                    val = self.rule.get(name)
-
-                kw[kw_name] = missing if val is None else val
-            alert_text = alert_text.format(**kw)
-
-        self.text += alert_text
+        self.text.append(get_alert_format(self.rule, 'alert_text')(self.match))
 
     def _add_rule_text(self):
-        self.text += self.rule['type'].get_match_str(self.match)
+        self.text.append(self.rule['type'].get_match_str(self.match))
 
     def _add_top_counts(self):
         for key, counts in self.match.items():
             if key.startswith('top_events_'):
-                self.text += '%s:\n' % (key[11:])
+                self.text.append('%s:\n' % (key[11:]))
                 top_events = counts.items()
 
                 if not top_events:
-                    self.text += 'No events found.\n'
+                    self.text.append('No events found.\n')
                 else:
                     top_events.sort(key=lambda x: x[1], reverse=True)
                     for term, count in top_events:
-                        self.text += '%s: %s\n' % (term, count)
+                        self.text.append('%s: %s\n' % (term, count))
 
-                self.text += '\n'
+                self.text.append('\n')
 
     def _add_match_items(self):
         match_items = self.match.items()
@@ -125,7 +386,7 @@ class BasicMatchString(object):
                 except TypeError:
                     # Non serializable object, fallback to str
                     pass
-            self.text += '%s: %s\n' % (key, value_str)
+            self.text.append('%s: %s\n' % (key, value_str))
 
     def _pretty_print_as_json(self, blob):
         try:
@@ -135,9 +396,10 @@ class BasicMatchString(object):
             return json.dumps(blob, cls=DateTimeEncoder, sort_keys=True, indent=4, encoding='Latin-1', ensure_ascii=False)
 
     def __str__(self):
-        self.text = ''
+        # Text is accumulated as a list of parts and joined once it is complete
+        self.text = []
         if 'alert_text' not in self.rule:
-            self.text += self.rule['name'] + '\n\n'
+            self.text.append(self.rule['name'] + '\n\n')
 
         self._add_custom_alert_text()
         self._ensure_new_line()
@@ -148,6 +410,7 @@ class BasicMatchString(object):
                 self._add_top_counts()
             if self.rule.get('alert_text_type') != 'exclude_fields':
                 self._add_match_items()
+        self.text = ''.join(self.text)
         return self.text
 
 
@@ -156,7 +419,7 @@ class JiraFormattedMatchString(BasicMatchString):
         match_items = dict([(x, y) for x, y in self.match.items() if not x.startswith('top_events_')])
         json_blob = self._pretty_print_as_json(match_items)
         preformatted_text = u'{{code}}{0}{{code}}'.format(json_blob)
-        self.text += preformatted_text
+        self.text.append(preformatted_text)
 
 
 class Alerter(object):
@@ -165,6 +428,8 @@ class Alerter(object):
     :param rule: The rule configuration.
     """
     required_options = frozenset([])
+    # The maximum number of alerts which alert_coalesced can send as one, or 0 if it is not supported
+    max_coalesced_alerts = 0
 
     def __init__(self, rule):
         self.rule = rule
@@ -173,6 +438,14 @@ class Alerter(object):
         self.pipeline = None
         self.resolve_rule_references(self.rule)
 
+    def http_post(self, url, *args, **kwargs):
+        """ Sends a POST request using a session shared with other alerters, see get_http_session.
+        Unless given, the timeout is set from the http_connect_timeout and http_read_timeout options.
+        Arguments are the same as for requests.post. """
+        session = get_http_session(url, kwargs.get('proxies'), self.rule.get('http_retries', 2))
+        kwargs.setdefault('timeout', (self.rule.get('http_connect_timeout', 10), self.rule.get('http_read_timeout', 30)))
+        return session.post(url, *args, **kwargs)
+
     def resolve_rule_references(self, root):
         # Support referencing other top-level rule properties to avoid redundant copy/paste
         if type(root) == list:
@@ -212,46 +485,67 @@ class Alerter(object):
         a field type corresponding to the type of Alerter. """
         return {'type': 'Unknown'}
 
+    def get_destination(self):
+        """ Returns a hashable value identifying where alerts are sent, such as a webhook URL, which alerters of the
+        same type share when they send to the same place. Alerts to a destination are rate limited by alert_rate_limit.
+        Returns None if alerts are not rate limited. """
+        return None
+
+    def alert_coalesced(self, alerts):
+        """ Sends several alerts to this alerter's destination as one, if max_coalesced_alerts is set.
+
+        :param alerts: A list of tuples of an alerter, of the same type and destination, and its list of matches.
+        """
+        raise NotImplementedError()
+
+    def get_rendered(self, key, render, *args):
+        """ Returns render(*args), which is only called once per alert and shared through the pipeline
+        with the rule's other alerters which use the same rule configuration. Without a pipeline, render
+        is called every time.
+
+        :param key: A key identifying what is rendered. It must include anything, other than the rule and
+        the alert's matches, which the result depends on.
+        """
+        if self.pipeline is None:
+            return render(*args)
+        rendered = self.pipeline.setdefault('rendered', {})
+        # Alerters with their own configuration have a copy of the rule
+        key = (id(self.rule), key)
+        if key not in rendered:
+            rendered[key] = render(*args)
+        return rendered[key]
+
+    def get_match_text(self, match, match_string=BasicMatchString):
+        """ Returns the text of a match as formatted by match_string, a BasicMatchString class. """
+        return self.get_rendered((match_string, id(match)), lambda: unicode(match_string(self.rule, match)))
+
+    def get_matches_text(self, matches, match_string=BasicMatchString):
+        """ Returns the text of each match, separated by dashes if there is more than one. """
+        parts = []
+        for match in matches:
+            parts.append(self.get_match_text(match, match_string))
+            # Separate text of aggregated alerts with dashes
+            if len(matches) > 1:
+                parts.append('\n----------------------------------------\n')
+        return u''.join(parts)
+
     def create_title(self, matches):
         """ Creates custom alert title to be used, e.g. as an e-mail subject or JIRA issue summary.
 
         :param matches: A list of dictionaries of relevant information to the alert.
         """
         if 'alert_subject' in self.rule:
-            return self.create_custom_title(matches)
+            return self.get_rendered('custom_title', self.create_custom_title, matches)
 
         return self.create_default_title(matches)
 
     def create_custom_title(self, matches):
-        alert_subject = unicode(self.rule['alert_subject'])
-
-        if 'alert_subject_args' in self.rule:
-            alert_subject_args = self.rule['alert_subject_args']
-            alert_subject_values = [lookup_es_key(matches[0], arg) for arg in alert_subject_args]
-
-            # Support referencing other top-level rule properties
-            # This technically may not work if there is a top-level rule property with the same name
-            # as an es result key, since it would have been matched in the lookup_es_key call above
-            for i in xrange(len(alert_subject_values)):
-                if alert_subject_values[i] is None:
-                    alert_value = self.rule.get(alert_subject_args[i])
-                    if alert_value:
-                        alert_subject_values[i] = alert_value
-
-            missing = self.rule.get('alert_missing_value', '<MISSING VALUE>')
-            alert_subject_values = [missing if val is None else val for val in alert_subject_values]
-            return alert_subject.format(*alert_subject_values)
-
-        return alert_subject
+        return get_alert_format(self.rule, 'alert_subject')(matches[0])
 
     def create_alert_body(self, matches):
         body = self.get_aggregation_summary_text(matches)
         if self.rule.get('alert_text_type') != 'aggregation_summary_only':
-            for match in matches:
-                body += unicode(BasicMatchString(self.rule, match))
-                # Separate text of aggregated alerts with dashes
-                if len(matches) > 1:
-                    body += '\n----------------------------------------\n'
+            body += self.get_matches_text(matches)
         return body
 
     def get_aggregation_summary_text__maximum_width(self):
@@ -259,6 +553,10 @@ class Alerter(object):
         return 80
 
     def get_aggregation_summary_text(self, matches):
+        width = self.get_aggregation_summary_text__maximum_width()
+        return self.get_rendered(('summary', width), self.render_aggregation_summary_text, matches, width)
+
+    def render_aggregation_summary_text(self, matches, width):
         text = ''
         if 'aggregation' in self.rule and 'summary_table_fields' in self.rule:
             summary_table_fields = self.rule['summary_table_fields']
@@ -269,7 +567,7 @@ class Alerter(object):
             text += "Aggregation resulted in the following data for summary_table_fields ==> {0}:\n\n".format(
                 summary_table_fields_with_count
             )
-            text_table = Texttable(max_width=self.get_aggregation_summary_text__maximum_width())
+            text_table = Texttable(max_width=width)
             text_table.header(summary_table_fields_with_count)
             # Format all fields as 'text' to avoid long numbers being shown as scientific notation
             text_table.set_cols_dtype(['t' for i in summary_table_fields_with_count])
@@ -313,6 +611,22 @@ class StompAlerter(Alerter):
     required_options = frozenset(
         ['stomp_hostname', 'stomp_hostport', 'stomp_login', 'stomp_password'])
 
+    def __init__(self, rule):
+        super(StompAlerter, self).__init__(rule)
+        self.stomp_hostname = self.rule.get('stomp_hostname', 'localhost')
+        self.stomp_hostport = self.rule.get('stomp_hostport', '61613')
+        self.stomp_login = self.rule.get('stomp_login', 'admin')
+        self.stomp_password = self.rule.get('stomp_password', 'admin')
+        self.stomp_destination = self.rule.get(
+            'stomp_destination', '/queue/ALERT')
+        heartbeat = self.rule.get('stomp_heartbeat', 10000)
+        self.stomp_heartbeats = (heartbeat, heartbeat)
+        self.stomp_connect_timeout = self.rule.get('stomp_connect_timeout', 10)
+
+    def get_connection(self):
+        return get_stomp_connection((self.stomp_hostname, self.stomp_hostport), self.stomp_login, self.stomp_password,
+                                    self.stomp_heartbeats, self.stomp_connect_timeout)
+
     def alert(self, matches):
         alerts = []
 
@@ -342,34 +656,25 @@ class StompAlerter(Alerter):
                 )
                 fullmessage['match'] = lookup_es_key(
                     match, self.rule['timestamp_field'])
-            elastalert_logger.info(unicode(BasicMatchString(self.rule, match)))
+            elastalert_logger.info(self.get_match_text(match))
 
         fullmessage['alerts'] = alerts
         fullmessage['rule'] = self.rule['name']
         fullmessage['rule_file'] = self.rule['rule_file']
 
-        fullmessage['matching'] = unicode(BasicMatchString(self.rule, match))
+        fullmessage['matching'] = self.get_match_text(match)
         fullmessage['alertDate'] = datetime.datetime.now(
         ).strftime("%Y-%m-%d %H:%M:%S")
         fullmessage['body'] = self.create_alert_body(matches)
 
         fullmessage['matches'] = matches
 
-        self.stomp_hostname = self.rule.get('stomp_hostname', 'localhost')
-        self.stomp_hostport = self.rule.get('stomp_hostport', '61613')
-        self.stomp_login = self.rule.get('stomp_login', 'admin')
-        self.stomp_password = self.rule.get('stomp_password', 'admin')
-        self.stomp_destination = self.rule.get(
-            'stomp_destination', '/queue/ALERT')
-
-        conn = stomp.Connection([(self.stomp_hostname, self.stomp_hostport)])
-
-        conn.start()
-        conn.connect(self.stomp_login, self.stomp_password)
-        # Ensures that the CONNECTED frame is received otherwise, the disconnect call will fail.
-        time.sleep(1)
-        conn.send(self.stomp_destination, json.dumps(fullmessage))
-        conn.disconnect()
+        body = json.dumps(fullmessage)
+        try:
+            self.get_connection().send(self.stomp_destination, body)
+        except stomp_exception.StompException:
+            # The shared connection was lost since it was last checked, so send again on a new one
+            self.get_connection().send(self.stomp_destination, body)
 
     def get_info(self):
         return {'type': 'stomp'}
@@ -407,6 +712,8 @@ class EmailAlerter(Alerter):
             self.get_account(self.rule['smtp_auth_file'])
         self.smtp_key_file = self.rule.get('smtp_key_file')
         self.smtp_cert_file = self.rule.get('smtp_cert_file')
+        self.smtp_keepalive = self.rule.get('smtp_keepalive', False)
+        self.smtp_keepalive_timeout = self.rule.get('smtp_keepalive_timeout', 60)
         # Convert email to a list if it isn't already
         if isinstance(self.rule['email'], basestring):
             self.rule['email'] = [self.rule['email']]
@@ -454,30 +761,43 @@ class EmailAlerter(Alerter):
         if self.rule.get('bcc'):
             to_addr = to_addr + self.rule['bcc']
 
+        if self.smtp_keepalive:
+            key = (self.smtp_host, self.smtp_port, self.smtp_ssl, self.smtp_key_file, self.smtp_cert_file,
+                   getattr(self, 'user', None), getattr(self, 'password', None))
+            try:
+                smtp_pool.sendmail(key, self.connect, self.smtp_keepalive_timeout, self.from_addr, to_addr, email_msg.as_string())
+            except SMTPServerDisconnected as e:
+                raise EAException("Error connecting to SMTP host: %s" % (e))
+        else:
+            self.smtp = self.connect()
+            self.smtp.sendmail(self.from_addr, to_addr, email_msg.as_string())
+            self.smtp.close()
+
+        elastalert_logger.info("Sent email to %s" % (to_addr))
+
+    def connect(self):
+        """ Opens an SMTP connection, using TLS if available, and logs in if smtp_auth_file is set. """
         try:
             if self.smtp_ssl:
                 if self.smtp_port:
-                    self.smtp = SMTP_SSL(self.smtp_host, self.smtp_port, keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
+                    smtp = SMTP_SSL(self.smtp_host, self.smtp_port, keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
                 else:
-                    self.smtp = SMTP_SSL(self.smtp_host, keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
+                    smtp = SMTP_SSL(self.smtp_host, keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
             else:
                 if self.smtp_port:
-                    self.smtp = SMTP(self.smtp_host, self.smtp_port)
+                    smtp = SMTP(self.smtp_host, self.smtp_port)
                 else:
-                    self.smtp = SMTP(self.smtp_host)
-                self.smtp.ehlo()
-                if self.smtp.has_extn('STARTTLS'):
-                    self.smtp.starttls(keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
+                    smtp = SMTP(self.smtp_host)
+                smtp.ehlo()
+                if smtp.has_extn('STARTTLS'):
+                    smtp.starttls(keyfile=self.smtp_key_file, certfile=self.smtp_cert_file)
             if 'smtp_auth_file' in self.rule:
-                self.smtp.login(self.user, self.password)
+                smtp.login(self.user, self.password)
         except (SMTPException, error) as e:
             raise EAException("Error connecting to SMTP host: %s" % (e))
         except SMTPAuthenticationError as e:
             raise EAException("SMTP username/password rejected: %s" % (e))
-        self.smtp.sendmail(self.from_addr, to_addr, email_msg.as_string())
-        self.smtp.close()
-
-        elastalert_logger.info("Sent email to %s" % (to_addr))
+        return smtp
 
     def create_default_title(self, matches):
         subject = 'ElastAlert: %s' % (self.rule['name'])
@@ -517,8 +837,10 @@ class JiraAlerter(Alerter):
         'jira_label',
         'jira_labels',
         'jira_max_age',
+        'jira_metadata_ttl',
         'jira_priority',
         'jira_project',
+        'jira_search_cache_ttl',
         'jira_server',
         'jira_transition_to',
         'jira_watchers',
@@ -545,7 +867,7 @@ class JiraAlerter(Alerter):
 
         # Deferred settings refer to values that can only be resolved when a match
         # is found and as such loading them will be delayed until we find a match
-        self.deferred_settings = []
+        self.deferred_settings = {}
 
         # We used to support only a single component. This allows us to maintain backwards compatibility
         # while also giving the user-facing API a more representative name
@@ -566,6 +888,9 @@ class JiraAlerter(Alerter):
         self.bump_only = self.rule.get('jira_bump_only', False)
         self.transition = self.rule.get('jira_transition_to', False)
         self.watchers = self.rule.get('jira_watchers')
+        self.metadata_ttl = self.rule.get('jira_metadata_ttl', 3600)
+        self.search_cache_ttl = self.rule.get('jira_search_cache_ttl', 60)
+        self.account_key = (self.server, self.user, self.password)
         self.client = None
 
         if self.bump_in_statuses and self.bump_not_in_statuses:
@@ -580,16 +905,18 @@ class JiraAlerter(Alerter):
 
         self.reset_jira_args()
 
+        self.get_metadata()
+        self.get_arbitrary_fields()
+        self.set_priority()
+
+    def get_metadata(self):
+        """ Gets the client, priorities and fields for this server and account from jira_cache. """
         try:
-            self.client = JIRA(self.server, basic_auth=(self.user, self.password))
-            self.get_priorities()
-            self.jira_fields = self.client.fields()
-            self.get_arbitrary_fields()
-        except JIRAError as e:
+            self.client, priorities, self.jira_fields = jira_cache.get(self.account_key, self.metadata_ttl)
+        except jira_exceptions.JIRAError as e:
             # JIRAError may contain HTML, pass along only first 1024 chars
             raise EAException("Error connecting to JIRA: %s" % (str(e)[:1024])), None, sys.exc_info()[2]
-
-        self.set_priority()
+        self.get_priorities(priorities)
 
     def set_priority(self):
         try:
@@ -697,11 +1024,11 @@ class JiraAlerter(Alerter):
             if jira_field.startswith('jira_') and jira_field not in self.known_field_list and str(value)[:1] != '#':
                 self.set_jira_arg(jira_field, value, self.jira_fields)
             if jira_field.startswith('jira_') and jira_field not in self.known_field_list and str(value)[:1] == '#':
-                self.deferred_settings.append(jira_field)
+                if jira_field not in self.deferred_settings:
+                    self.deferred_settings[jira_field] = es_key_getter(value[1:])
 
-    def get_priorities(self):
+    def get_priorities(self, priorities):
         """ Creates a mapping of priority index to id. """
-        priorities = self.client.priorities()
         self.priority_ids = {}
         for x in range(len(priorities)):
             self.priority_ids[x] = priorities[x].id
@@ -713,7 +1040,7 @@ class JiraAlerter(Alerter):
         elif 'assignee' in self.jira_args:
             self.jira_args.pop('assignee')
 
-    def find_existing_ticket(self, matches):
+    def get_search_jql(self, matches):
         # Default title, get stripped search version
         if 'alert_subject' not in self.rule:
             title = self.create_default_title(matches, True)
@@ -736,9 +1063,13 @@ class JiraAlerter(Alerter):
         if self.bump_not_in_statuses:
             jql = '%s and status not in (%s)' % (jql, ','.join(["\"%s\"" % status if ' ' in status else status
                                                                 for status in self.bump_not_in_statuses]))
+        return jql
+
+    def find_existing_ticket(self, matches):
+        jql = self.get_search_jql(matches)
         try:
-            issues = self.client.search_issues(jql)
-        except JIRAError as e:
+            issues = jira_cache.search(self.account_key, self.client, jql, self.search_cache_ttl)
+        except jira_exceptions.JIRAError as e:
             logging.exception("Error while searching for JIRA ticket using jql '%s': %s" % (jql, e))
             return None
 
@@ -746,7 +1077,7 @@ class JiraAlerter(Alerter):
             return issues[0]
 
     def comment_on_ticket(self, ticket, match):
-        text = unicode(JiraFormattedMatchString(self.rule, match))
+        text = self.get_match_text(match, JiraFormattedMatchString)
         timestamp = pretty_ts(lookup_es_key(match, self.rule['timestamp_field']))
         comment = "This alert was triggered again at %s\n%s" % (timestamp, text)
         self.client.add_comment(ticket, comment)
@@ -759,12 +1090,10 @@ class JiraAlerter(Alerter):
 
     def alert(self, matches):
         # Reset arbitrary fields to pick up changes
+        self.get_metadata()
         self.get_arbitrary_fields()
-        if len(self.deferred_settings) > 0:
-            fields = self.client.fields()
-            for jira_field in self.deferred_settings:
-                value = lookup_es_key(matches[0], self.rule[jira_field][1:])
-                self.set_jira_arg(jira_field, value, fields)
+        for jira_field, getter in self.deferred_settings.iteritems():
+            self.set_jira_arg(jira_field, getter(matches[0]), self.jira_fields)
 
         title = self.create_title(matches)
 
@@ -781,19 +1110,22 @@ class JiraAlerter(Alerter):
                 for match in matches:
                     try:
                         self.comment_on_ticket(ticket, match)
-                    except JIRAError as e:
+                    except jira_exceptions.JIRAError as e:
                         logging.exception("Error while commenting on ticket %s: %s" % (ticket, e))
                     if self.labels:
                         for l in self.labels:
                             try:
                                 ticket.fields.labels.append(l)
-                            except JIRAError as e:
+                            except jira_exceptions.JIRAError as e:
                                 logging.exception("Error while appending labels to ticket %s: %s" % (ticket, e))
+                if self.bump_after_inactivity:
+                    # The cached ticket no longer shows when it was last updated
+                    jira_cache.forget_search(self.account_key, self.get_search_jql(matches))
                 if self.transition:
                     elastalert_logger.info('Transitioning existing ticket %s' % (ticket.key))
                     try:
                         self.transition_ticket(ticket)
-                    except JIRAError as e:
+                    except jira_exceptions.JIRAError as e:
                         logging.exception("Error while transitioning ticket %s: %s" % (ticket, e))
 
                 if self.pipeline is not None:
@@ -823,23 +1155,22 @@ class JiraAlerter(Alerter):
                                 ex
                             )), None, sys.exc_info()[2]
 
-        except JIRAError as e:
+        except jira_exceptions.JIRAError as e:
             raise EAException("Error creating JIRA ticket using jira_args (%s): %s" % (self.jira_args, e))
         elastalert_logger.info("Opened Jira ticket: %s" % (self.issue))
+        if self.bump_tickets:
+            # Let further alerts in this burst find the new ticket without searching for it
+            jira_cache.set_search(self.account_key, self.get_search_jql(matches), [self.issue], self.search_cache_ttl)
 
         if self.pipeline is not None:
             self.pipeline['jira_ticket'] = self.issue
             self.pipeline['jira_server'] = self.server
 
     def create_alert_body(self, matches):
-        body = self.description + '\n'
-        body += self.get_aggregation_summary_text(matches)
+        body = [self.description, '\n', self.get_aggregation_summary_text(matches)]
         if self.rule.get('alert_text_type') != 'aggregation_summary_only':
-            for match in matches:
-                body += unicode(JiraFormattedMatchString(self.rule, match))
-                if len(matches) > 1:
-                    body += '\n----------------------------------------\n'
-        return body
+            body.append(self.get_matches_text(matches, JiraFormattedMatchString))
+        return u''.join(body)
 
     def get_aggregation_summary_text(self, matches):
         text = super(JiraAlerter, self).get_aggregation_summary_text(matches)
@@ -935,13 +1266,7 @@ class SnsAlerter(Alerter):
     def alert(self, matches):
         body = self.create_alert_body(matches)
 
-        session = boto3.Session(
-            aws_access_key_id=self.aws_access_key_id,
-            aws_secret_access_key=self.aws_secret_access_key,
-            region_name=self.aws_region,
-            profile_name=self.profile
-        )
-        sns_client = session.client('sns')
+        sns_client = get_sns_client(self.aws_access_key_id, self.aws_secret_access_key, self.aws_region, self.profile)
         sns_client.publish(
             TopicArn=self.sns_topic_arn,
             Message=body,
@@ -1015,22 +1340,25 @@ class HipChatAlerter(Alerter):
                 )
                 ping_msg['message_format'] = "text"
 
-                response = requests.post(
+                response = self.http_post(
                     self.url,
                     data=json.dumps(ping_msg, cls=DateTimeEncoder),
                     headers=headers,
                     verify=not self.hipchat_ignore_ssl_errors,
                     proxies=proxies)
 
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers,
-                                     verify=not self.hipchat_ignore_ssl_errors,
-                                     proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers,
+                                      verify=not self.hipchat_ignore_ssl_errors,
+                                      proxies=proxies)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to HipChat: %s" % e)
         elastalert_logger.info("Alert sent to HipChat room %s" % self.hipchat_room_id)
 
+    def get_destination(self):
+        return self.url
+
     def get_info(self):
         return {'type': 'hipchat',
                 'hipchat_room_id': self.hipchat_room_id}
@@ -1077,12 +1405,15 @@ class MsTeamsAlerter(Alerter):
 
         for url in self.ms_teams_webhook_url:
             try:
-                response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+                response = self.http_post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
                 response.raise_for_status()
             except RequestException as e:
                 raise EAException("Error posting to ms teams: %s" % e)
         elastalert_logger.info("Alert sent to MS Teams")
 
+    def get_destination(self):
+        return tuple(self.ms_teams_webhook_url)
+
     def get_info(self):
         return {'type': 'ms_teams',
                 'ms_teams_webhook_url': self.ms_teams_webhook_url}
@@ -1091,6 +1422,8 @@ class MsTeamsAlerter(Alerter):
 class SlackAlerter(Alerter):
     """ Creates a Slack room message for each alert """
     required_options = frozenset(['slack_webhook_url'])
+    # Slack allows up to 100 attachments in a message
+    max_coalesced_alerts = 100
 
     def __init__(self, rule):
         super(SlackAlerter, self).__init__(rule)
@@ -1130,10 +1463,22 @@ class SlackAlerter(Alerter):
             alert_fields.append(arg)
         return alert_fields
 
-    def alert(self, matches):
+    def get_attachment(self, matches):
         body = self.create_alert_body(matches)
+        attachment = {
+            'color': self.slack_msg_color,
+            'title': self.create_title(matches),
+            'text': self.format_body(body),
+            'mrkdwn_in': ['text', 'pretext'],
+            'fields': []
+        }
 
-        body = self.format_body(body)
+        # if we have defined fields, populate noteable fields for the alert
+        if self.slack_alert_fields != '':
+            attachment['fields'] = self.populate_fields(matches)
+        return attachment
+
+    def post(self, attachments):
         # post to slack
         headers = {'content-type': 'application/json'}
         # set https proxy, if it was provided
@@ -1143,21 +1488,9 @@ class SlackAlerter(Alerter):
             'channel': self.slack_channel_override,
             'parse': self.slack_parse_override,
             'text': self.slack_text_string,
-            'attachments': [
-                {
-                    'color': self.slack_msg_color,
-                    'title': self.create_title(matches),
-                    'text': body,
-                    'mrkdwn_in': ['text', 'pretext'],
-                    'fields': []
-                }
-            ]
+            'attachments': attachments
         }
 
-        # if we have defined fields, populate noteable fields for the alert
-        if self.slack_alert_fields != '':
-            payload['attachments'][0]['fields'] = self.populate_fields(matches)
-
         if self.slack_icon_url_override != '':
             payload['icon_url'] = self.slack_icon_url_override
         else:
@@ -1165,12 +1498,23 @@ class SlackAlerter(Alerter):
 
         for url in self.slack_webhook_url:
             try:
-                response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+                response = self.http_post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
                 response.raise_for_status()
             except RequestException as e:
                 raise EAException("Error posting to slack: %s" % e)
+
+    def alert(self, matches):
+        self.post([self.get_attachment(matches)])
         elastalert_logger.info("Alert sent to Slack")
 
+    def alert_coalesced(self, alerts):
+        # Each alert is an attachment of the same message
+        self.post([alerter.get_attachment(matches) for alerter, matches in alerts])
+        elastalert_logger.info("%d alerts sent to Slack as one message" % (len(alerts)))
+
+    def get_destination(self):
+        return (tuple(self.slack_webhook_url), self.slack_channel_override)
+
     def get_info(self):
         return {'type': 'slack',
                 'slack_username_override': self.slack_username_override,
@@ -1210,7 +1554,7 @@ class PagerDutyAlerter(Alerter):
         # set https proxy, if it was provided
         proxies = {'https': self.pagerduty_proxy} if self.pagerduty_proxy else None
         try:
-            response = requests.post(
+            response = self.http_post(
                 self.url,
                 data=json.dumps(payload, cls=DateTimeEncoder, ensure_ascii=False),
                 headers=headers,
@@ -1244,6 +1588,9 @@ class PagerDutyAlerter(Alerter):
         else:
             return self.pagerduty_incident_key
 
+    def get_destination(self):
+        return self.pagerduty_service_key
+
     def get_info(self):
         return {'type': 'pagerduty',
                 'pagerduty_client_name': self.pagerduty_client_name}
@@ -1294,7 +1641,7 @@ class TwilioAlerter(Alerter):
                                    to=self.twilio_to_number,
                                    from_=self.twilio_from_number)
 
-        except TwilioRestException as e:
+        except twilio_exceptions.TwilioRestException as e:
             raise EAException("Error posting to twilio: %s" % e)
 
         elastalert_logger.info("Trigger sent to Twilio")
@@ -1336,7 +1683,7 @@ class VictorOpsAlerter(Alerter):
             payload["entity_id"] = self.victorops_entity_id
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to VictorOps: %s" % e)
@@ -1361,11 +1708,7 @@ class TelegramAlerter(Alerter):
 
     def alert(self, matches):
         body = u'⚠ *%s* ⚠ ```\n' % (self.create_title(matches))
-        for match in matches:
-            body += unicode(BasicMatchString(self.rule, match))
-            # Separate text of aggregated alerts with dashes
-            if len(matches) > 1:
-                body += '\n----------------------------------------\n'
+        body += self.get_matches_text(matches)
         if len(body) > 4095:
             body = body[0:4000] + "\n⚠ *message was cropped according to telegram limits!* ⚠"
         body += u' ```'
@@ -1381,7 +1724,7 @@ class TelegramAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
@@ -1390,6 +1733,9 @@ class TelegramAlerter(Alerter):
         elastalert_logger.info(
             "Alert sent to Telegram room %s" % self.telegram_room_id)
 
+    def get_destination(self):
+        return self.url, self.telegram_room_id
+
     def get_info(self):
         return {'type': 'telegram',
                 'telegram_room_id': self.telegram_room_id}
@@ -1418,7 +1764,7 @@ class GitterAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.gitter_webhook_url, json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+            response = self.http_post(self.gitter_webhook_url, json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to Gitter: %s" % e)
@@ -1471,7 +1817,7 @@ class ServiceNowAlerter(Alerter):
             "caller_id": self.rule["caller_id"]
         }
         try:
-            response = requests.post(
+            response = self.http_post(
                 self.servicenow_rest_url,
                 auth=(self.rule['username'], self.rule['password']),
                 headers=headers,
@@ -1532,7 +1878,7 @@ class AlertaAlerter(Alerter):
 
         try:
 
-            response = requests.post(self.url, data=alerta_payload, headers=headers)
+            response = self.http_post(self.url, data=alerta_payload, headers=headers)
             response.raise_for_status()
         except RequestException as e:
             raise EAException("Error posting to Alerta: %s" % e)
@@ -1618,34 +1964,127 @@ class HTTPPostAlerter(Alerter):
         self.post_static_payload = self.rule.get('http_post_static_payload', {})
         self.post_all_values = self.rule.get('http_post_all_values', not self.post_payload)
         self.post_http_headers = self.rule.get('http_post_headers', {})
+        self.post_batch_size = self.rule.get('http_post_batch_size')
+        self.post_batch_format = self.rule.get('http_post_batch_format', 'json')
+        self.post_gzip = self.rule.get('http_post_gzip', False)
+        self.post_concurrent = self.rule.get('http_post_concurrent', False)
+
+    def get_payload(self, match):
+        """ Builds the payload for a match, without modifying the match. """
+        payload = copy.copy(match) if self.post_all_values else {}
+        payload.update(self.post_static_payload)
+        for post_key, es_key in self.post_payload.items():
+            payload[post_key] = lookup_es_key(match, es_key)
+        return payload
+
+    def get_bodies(self, matches):
+        """ Returns the request bodies for a list of matches. This is one JSON object per match or, with
+        http_post_batch_size, a JSON array or newline delimited JSON objects per batch of matches. """
+        payloads = [self.get_payload(match) for match in matches]
+        if not self.post_batch_size:
+            bodies = [json.dumps(payload, cls=DateTimeEncoder) for payload in payloads]
+        elif self.post_batch_format == 'ndjson':
+            bodies = [''.join(json.dumps(payload, cls=DateTimeEncoder) + '\n' for payload in payloads[i:i + self.post_batch_size])
+                      for i in range(0, len(payloads), self.post_batch_size)]
+        else:
+            bodies = [json.dumps(payloads[i:i + self.post_batch_size], cls=DateTimeEncoder)
+                      for i in range(0, len(payloads), self.post_batch_size)]
+        if self.post_gzip:
+            bodies = [self.gzip(body) for body in bodies]
+        return bodies
+
+    @staticmethod
+    def gzip(data):
+        # A window size of 16 + MAX_WBITS writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def post(self, url, bodies, headers, proxies):
+        for body in bodies:
+            try:
+                response = self.http_post(url, data=body, headers=headers, proxies=proxies)
+                response.raise_for_status()
+            except RequestException as e:
+                raise EAException("Error posting HTTP Post alert: %s" % e)
+
+    def post_concurrently(self, bodies, headers, proxies):
+        """ POSTs the bodies to every URL at once, one thread per URL. """
+        errors = []
+
+        def post_to_url(url):
+            try:
+                self.post(url, bodies, headers, proxies)
+            except EAException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=post_to_url, args=(url,)) for url in self.post_url]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
 
     def alert(self, matches):
-        """ Each match will trigger a POST to the specified endpoint(s). """
-        for match in matches:
-            payload = match if self.post_all_values else {}
-            payload.update(self.post_static_payload)
-            for post_key, es_key in self.post_payload.items():
-                payload[post_key] = lookup_es_key(match, es_key)
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json;charset=utf-8"
-            }
-            headers.update(self.post_http_headers)
-            proxies = {'https': self.post_proxy} if self.post_proxy else None
-            for url in self.post_url:
-                try:
-                    response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder),
-                                             headers=headers, proxies=proxies)
-                    response.raise_for_status()
-                except RequestException as e:
-                    raise EAException("Error posting HTTP Post alert: %s" % e)
-            elastalert_logger.info("HTTP Post alert sent.")
+        """ Each match, or batch of matches, will trigger a POST to the specified endpoint(s). """
+        headers = {
+            "Content-Type": "application/x-ndjson" if self.post_batch_size and self.post_batch_format == 'ndjson' else "application/json",
+            "Accept": "application/json;charset=utf-8"
+        }
+        if self.post_gzip:
+            headers['Content-Encoding'] = 'gzip'
+        headers.update(self.post_http_headers)
+        proxies = {'https': self.post_proxy} if self.post_proxy else None
+        bodies = self.get_bodies(matches)
+
+        if self.post_concurrent and len(self.post_url) > 1:
+            self.post_concurrently(bodies, headers, proxies)
+        else:
+            for body in bodies:
+                for url in self.post_url:
+                    self.post(url, [body], headers, proxies)
+        elastalert_logger.info("HTTP Post alert sent.")
 
     def get_info(self):
         return {'type': 'http_post',
                 'http_post_webhook_url': self.post_url}
 
 
+class SimplePostAlerter(Alerter):
+    """ Sends the rule name and its matches to a JSON endpoint by HTTP POST. """
+    required_options = frozenset(['simple_webhook_url'])
+
+    def __init__(self, rule):
+        super(SimplePostAlerter, self).__init__(rule)
+        simple_webhook_url = self.rule['simple_webhook_url']
+        if isinstance(simple_webhook_url, basestring):
+            simple_webhook_url = [simple_webhook_url]
+        self.simple_webhook_url = simple_webhook_url
+        self.simple_proxy = self.rule.get('simple_proxy')
+
+    def alert(self, matches):
+        payload = {
+            'rule': self.rule['name'],
+            'matches': matches
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json;charset=utf-8"
+        }
+        proxies = {'https': self.simple_proxy} if self.simple_proxy else None
+        for url in self.simple_webhook_url:
+            try:
+                response = self.http_post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies)
+                response.raise_for_status()
+            except RequestException as e:
+                raise EAException("Error posting simple alert: %s" % e)
+        elastalert_logger.info("Simple alert sent")
+
+    def get_info(self):
+        return {'type': 'simple',
+                'simple_webhook_url': self.simple_webhook_url}
+
+
 class StrideHTMLParser(HTMLParser):
     """Parse html into stride's fabric structure"""
 
@@ -1722,7 +2161,7 @@ class StrideAlerter(Alerter):
         try:
             if self.stride_ignore_ssl_errors:
                 requests.packages.urllib3.disable_warnings()
-            response = requests.post(
+            response = self.http_post(
                 self.url, data=json.dumps(payload, cls=DateTimeEncoder),
                 headers=headers, verify=not self.stride_ignore_ssl_errors,
                 proxies=proxies)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
-import boto3
+
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 
 
@@ -53,6 +53,8 @@ class Auth(object):
         if not aws_region and not os.environ.get('AWS_DEFAULT_REGION'):
             return None
 
+        # boto3 is slow to import and only needed to sign requests
+        import boto3
         session = boto3.session.Session(profile_name=profile_name, region_name=aws_region)
 
         return RefeshableAWSRequestsAuth(
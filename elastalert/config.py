@@ -1,26 +1,31 @@
 # -*- coding: utf-8 -*-
 import copy
+import cPickle
 import datetime
 import hashlib
+import json
 import logging
 import os
 import sys
+import urllib
 
 import jsonschema
 import yaml
 import yaml.scanner
+from requests.exceptions import RequestException
 from staticconf.loader import yaml_loader
 
 import alerts
 import enhancements
 from http import HttpConnection
-from opsgenie import OpsGenieAlerter
+from http import HttpConnectionError
 import ruletypes
 from util import dt_to_ts
 from util import dt_to_ts_with_format
 from util import dt_to_unix
 from util import dt_to_unixms
 from util import EAException
+from util import elastalert_logger
 from util import ts_to_dt
 from util import ts_to_dt_with_format
 from util import unix_to_dt
@@ -47,43 +52,44 @@ env_settings = {'ES_USE_SSL': 'use_ssl',
                 'ES_HOST': 'es_host',
                 'ES_PORT': 'es_port'}
 
-# Used to map the names of rules to their classes
+# Used to map the names of rules to their classes, which are imported by get_module when a rule uses them
 rules_mapping = {
-    'frequency': ruletypes.FrequencyRule,
-    'any': ruletypes.AnyRule,
-    'spike': ruletypes.SpikeRule,
-    'blacklist': ruletypes.BlacklistRule,
-    'whitelist': ruletypes.WhitelistRule,
-    'change': ruletypes.ChangeRule,
-    'flatline': ruletypes.FlatlineRule,
-    'new_term': ruletypes.NewTermsRule,
-    'cardinality': ruletypes.CardinalityRule,
-    'metric_aggregation': ruletypes.MetricAggregationRule,
-    'percentage_match': ruletypes.PercentageMatchRule,
+    'frequency': 'ruletypes.FrequencyRule',
+    'any': 'ruletypes.AnyRule',
+    'spike': 'ruletypes.SpikeRule',
+    'blacklist': 'ruletypes.BlacklistRule',
+    'whitelist': 'ruletypes.WhitelistRule',
+    'change': 'ruletypes.ChangeRule',
+    'flatline': 'ruletypes.FlatlineRule',
+    'new_term': 'ruletypes.NewTermsRule',
+    'cardinality': 'ruletypes.CardinalityRule',
+    'metric_aggregation': 'ruletypes.MetricAggregationRule',
+    'percentage_match': 'ruletypes.PercentageMatchRule',
 }
 
-# Used to map names of alerts to their classes
+# Used to map names of alerts to their classes, imported in the same way as rules_mapping
 alerts_mapping = {
-    'email': alerts.EmailAlerter,
-    'jira': alerts.JiraAlerter,
-    'opsgenie': OpsGenieAlerter,
-    'stomp': alerts.StompAlerter,
-    'debug': alerts.DebugAlerter,
-    'command': alerts.CommandAlerter,
-    'sns': alerts.SnsAlerter,
-    'hipchat': alerts.HipChatAlerter,
-    'stride': alerts.StrideAlerter,
-    'ms_teams': alerts.MsTeamsAlerter,
-    'slack': alerts.SlackAlerter,
-    'pagerduty': alerts.PagerDutyAlerter,
-    'exotel': alerts.ExotelAlerter,
-    'twilio': alerts.TwilioAlerter,
-    'victorops': alerts.VictorOpsAlerter,
-    'telegram': alerts.TelegramAlerter,
-    'gitter': alerts.GitterAlerter,
-    'servicenow': alerts.ServiceNowAlerter,
-    'alerta': alerts.AlertaAlerter,
-    'post': alerts.HTTPPostAlerter
+    'email': 'alerts.EmailAlerter',
+    'jira': 'alerts.JiraAlerter',
+    'opsgenie': 'opsgenie.OpsGenieAlerter',
+    'stomp': 'alerts.StompAlerter',
+    'debug': 'alerts.DebugAlerter',
+    'command': 'alerts.CommandAlerter',
+    'sns': 'alerts.SnsAlerter',
+    'hipchat': 'alerts.HipChatAlerter',
+    'stride': 'alerts.StrideAlerter',
+    'ms_teams': 'alerts.MsTeamsAlerter',
+    'slack': 'alerts.SlackAlerter',
+    'pagerduty': 'alerts.PagerDutyAlerter',
+    'exotel': 'alerts.ExotelAlerter',
+    'twilio': 'alerts.TwilioAlerter',
+    'victorops': 'alerts.VictorOpsAlerter',
+    'telegram': 'alerts.TelegramAlerter',
+    'gitter': 'alerts.GitterAlerter',
+    'servicenow': 'alerts.ServiceNowAlerter',
+    'alerta': 'alerts.AlertaAlerter',
+    'post': 'alerts.HTTPPostAlerter',
+    'simple': 'alerts.SimplePostAlerter'
 }
 '''
 A partial ordering of alert types. Relative order will be preserved in the 
@@ -120,7 +126,7 @@ def load_configuration(key, rule, conf, args=None):
     :param conf: The global configuration dictionary, used for populating defaults.
     :return: The rule configuration, a dictionary.
     """
-    load_options(rule, conf, key, args)
+    load_cached_options(rule, conf, key, args)
     load_modules(rule, args)
     return rule
 
@@ -162,6 +168,10 @@ def load_options(rule, conf, key, args=None):
             rule['kibana4_start_timedelta'] = datetime.timedelta(**rule['kibana4_start_timedelta'])
         if 'kibana4_end_timedelta' in rule:
             rule['kibana4_end_timedelta'] = datetime.timedelta(**rule['kibana4_end_timedelta'])
+        if 'change_key_ttl' in rule:
+            rule['change_key_ttl'] = datetime.timedelta(**rule['change_key_ttl'])
+        if 'request_cache_interval' in rule:
+            rule['request_cache_interval'] = datetime.timedelta(**rule['request_cache_interval'])
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % (e))
 
@@ -180,28 +190,8 @@ def load_options(rule, conf, key, args=None):
     rule.setdefault('use_local_time', True)
     rule.setdefault('description', "")
 
-    # Set timestamp_type conversion function, used when generating queries and processing hits
     rule['timestamp_type'] = rule['timestamp_type'].strip().lower()
-    if rule['timestamp_type'] == 'iso':
-        rule['ts_to_dt'] = ts_to_dt
-        rule['dt_to_ts'] = dt_to_ts
-    elif rule['timestamp_type'] == 'unix':
-        rule['ts_to_dt'] = unix_to_dt
-        rule['dt_to_ts'] = dt_to_unix
-    elif rule['timestamp_type'] == 'unix_ms':
-        rule['ts_to_dt'] = unixms_to_dt
-        rule['dt_to_ts'] = dt_to_unixms
-    elif rule['timestamp_type'] == 'custom':
-        def _ts_to_dt_with_format(ts):
-            return ts_to_dt_with_format(ts, ts_format=rule['timestamp_format'])
-
-        def _dt_to_ts_with_format(dt):
-            return dt_to_ts_with_format(dt, ts_format=rule['timestamp_format'])
-
-        rule['ts_to_dt'] = _ts_to_dt_with_format
-        rule['dt_to_ts'] = _dt_to_ts_with_format
-    else:
-        raise EAException('timestamp_type must be one of iso, unix, or unix_ms')
+    set_timestamp_conversion(rule)
 
     # Set HipChat options from global config
     rule.setdefault('hipchat_msg_color', 'red')
@@ -279,6 +269,30 @@ def load_options(rule, conf, key, args=None):
                                                                          datetime.datetime.now().strftime(rule.get('index'))))
 
 
+def set_timestamp_conversion(rule):
+    """ Sets the timestamp_type conversion functions, used when generating queries and processing hits. """
+    if rule['timestamp_type'] == 'iso':
+        rule['ts_to_dt'] = ts_to_dt
+        rule['dt_to_ts'] = dt_to_ts
+    elif rule['timestamp_type'] == 'unix':
+        rule['ts_to_dt'] = unix_to_dt
+        rule['dt_to_ts'] = dt_to_unix
+    elif rule['timestamp_type'] == 'unix_ms':
+        rule['ts_to_dt'] = unixms_to_dt
+        rule['dt_to_ts'] = dt_to_unixms
+    elif rule['timestamp_type'] == 'custom':
+        def _ts_to_dt_with_format(ts):
+            return ts_to_dt_with_format(ts, ts_format=rule['timestamp_format'])
+
+        def _dt_to_ts_with_format(dt):
+            return dt_to_ts_with_format(dt, ts_format=rule['timestamp_format'])
+
+        rule['ts_to_dt'] = _ts_to_dt_with_format
+        rule['dt_to_ts'] = _dt_to_ts_with_format
+    else:
+        raise EAException('timestamp_type must be one of iso, unix, or unix_ms')
+
+
 def load_modules(rule, args=None):
     """ Loads things that could be modules. Enhancements, alerts and rule type. """
     # Set match enhancements
@@ -295,7 +309,7 @@ def load_modules(rule, args=None):
 
     # Convert rule type into RuleType object
     if rule['type'] in rules_mapping:
-        rule['type'] = rules_mapping[rule['type']]
+        rule['type'] = get_module(rules_mapping[rule['type']])
     else:
         rule['type'] = get_module(rule['type'])
         if not issubclass(rule['type'], ruletypes.RuleType):
@@ -340,6 +354,19 @@ def get_file_paths(conf, use_rule=None):
     return rule_keys
 
 
+def get_rule_file_stats(conf, use_rule=None):
+    """ Returns a dictionary mapping the path of each rule file to a tuple of its modification time and size. """
+    stats = {}
+    for rule_key in get_file_paths(conf, use_rule):
+        try:
+            stat = os.stat(rule_key)
+        except OSError:
+            # The file was removed since it was listed
+            continue
+        stats[rule_key] = (stat.st_mtime, stat.st_size)
+    return stats
+
+
 def load_alerts(rule, alert_field):
     def normalize_config(alert):
         """Alert config entries are either "alertType" or {"alertType": {"key": "data"}}.
@@ -355,7 +382,7 @@ def load_alerts(rule, alert_field):
             raise EAException()
 
     def create_alert(alert, alert_config):
-        alert_class = alerts_mapping.get(alert) or get_module(alert)
+        alert_class = get_module(alerts_mapping.get(alert, alert))
         if not issubclass(alert_class, alerts.Alerter):
             raise EAException('Alert module %s is not a subclass of Alerter' % (alert))
         missing_options = (rule['type'].required_options | alert_class.required_options) - frozenset(alert_config or [])
@@ -412,6 +439,14 @@ def load_rules_configuration(filename):
             conf['old_query_limit'] = datetime.timedelta(**conf['old_query_limit'])
         else:
             conf['old_query_limit'] = datetime.timedelta(weeks=1)
+        if 'state_snapshot_interval' in conf:
+            conf['state_snapshot_interval'] = datetime.timedelta(**conf['state_snapshot_interval'])
+        if 'alert_retry_backoff' in conf:
+            conf['alert_retry_backoff'] = datetime.timedelta(**conf['alert_retry_backoff'])
+        if 'rule_watch_interval' in conf:
+            conf['rule_watch_interval'] = datetime.timedelta(**conf['rule_watch_interval'])
+        if 'request_cache_interval' in conf:
+            conf['request_cache_interval'] = datetime.timedelta(**conf['request_cache_interval'])
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % (e))
 
@@ -454,7 +489,8 @@ def load_test_configuration(filename):
 
 def load_rules(args, is_test=False):
     """ Creates a conf dictionary for ElastAlerter. Loads the global
-    config file and then each rule found in rules_folder.
+    config file and then each rule found in rules_folder. With rule_init_workers,
+    the rules' modules are not loaded, as ElastAlerter loads them in the background.
 
     :param args: The parsed arguments to ElastAlert
     :return: The global configuration, a dictionary.
@@ -466,13 +502,24 @@ def load_rules(args, is_test=False):
 
     use_rule = args.rule
 
+    rule_cache = None
+    if conf.get('rule_cache_dir'):
+        rule_cache = get_rule_cache(conf)
+        if getattr(args, 'rebuild_rule_cache', False):
+            rule_cache.clear()
+        rule_cache.reset()
+
     # Load each rule configuration file
     names = []
     rules = []
 
     for key, value in yield_rules(conf, use_rule=use_rule):
         try:
-            rule = load_configuration(key, value, conf, args)            
+            if conf.get('rule_init_workers'):
+                load_cached_options(value, conf, key, args)
+                rule = value
+            else:
+                rule = load_configuration(key, value, conf, args)
             if rule['name'] in names:
                 raise EAException('Duplicate rule named %s' % (rule['name']))
         except EAException as e:
@@ -481,6 +528,12 @@ def load_rules(args, is_test=False):
         rules.append(rule)
         names.append(rule['name'])
 
+    if rule_cache:
+        elastalert_logger.info('Rule cache: %s hits, %s misses' % (rule_cache.hits, rule_cache.misses))
+        # Rules which were changed or removed leave entries which will not be used again
+        if not use_rule:
+            rule_cache.remove_unused()
+
     conf['rules'] = rules
     return conf
 
@@ -514,52 +567,202 @@ def parse_rule(key, value):
     return rule
 
 
-def yield_api_rules(conf, use_rule=None):
-    if 'rules_api_host' not in conf:
-        raise EAException("'api' rule type requires 'rules_api_host' config")
+class ApiRuleSource(object):
+    """ Fetches rules from rules_api_host, for rules_type api. Requests are conditional, sending the ETag and
+    Last-Modified headers of the previous response, so that an unchanged rule set is not fetched or hashed again.
 
-    rules_api_host = conf['rules_api_host']
-    
-    if 'rules_api_path' in conf:
-        rules_api_path = conf['rules_api_path']
-    else:
-        rules_api_path = ''
-
-    if 'rules_api_method' in conf:
-        rules_api_method = conf['rules_api_method'].strip().lower()
-    else:
-        rules_api_method = 'get'
+    With rules_api_delta, each response is a dictionary with the rules which changed, in 'rules', the keys of the
+    rules which were removed, in 'deleted', and a 'version' token. The token is sent back as the rules_api_since_param
+    parameter of the next request, so that only rules changed since then are returned. A response is a full rule set
+    if it was not sent a token, or it sets 'full'. Responses may be paginated with the path of the next page in 'next'.
 
-    if 'rules_api_port' in conf:
-        rules_api_port = int(conf['rules_api_port'])
-    else:
-        rules_api_port = 80
+    The last rule set is written to rules_api_cache_file, if set, from which the rules are loaded when the API
+    cannot be reached, such as while ElastAlert starts.
+    """
 
-    conn = HttpConnection(rules_api_host, port=rules_api_port)
-    if rules_api_method not in ["get", "post", "delete", "put"]:
-        raise EAException(
-            'rules_api_method "{method}" is invalid'.format(
-                method=rules_api_method
+    def __init__(self, conf):
+        if 'rules_api_host' not in conf:
+            raise EAException("'api' rule type requires 'rules_api_host' config")
+
+        self.host = conf['rules_api_host']
+        self.path = conf.get('rules_api_path', '')
+        self.method = conf.get('rules_api_method', 'get').strip().lower()
+        self.port = int(conf.get('rules_api_port', 80))
+        if self.method not in ["get", "post", "delete", "put"]:
+            raise EAException(
+                'rules_api_method "{method}" is invalid'.format(
+                    method=self.method
+                )
             )
-        )
 
-    configs = getattr(conn, rules_api_method)(
-        rules_api_path, headers={'Connection':'close'}
-    ).response.decode_json()
-    
-    for k, v in configs.items():
-        yield k, v
+        self.conn = HttpConnection(self.host, port=self.port, timeout=conf.get('rules_api_timeout', 30),
+                                   retries=conf.get('rules_api_retries', 3))
+        self.delta = conf.get('rules_api_delta', False)
+        self.since_param = conf.get('rules_api_since_param', 'since')
+        self.cache_file = conf.get('rules_api_cache_file')
+        self.rules = None
+        self.hashes = None
+        self.etag = None
+        self.last_modified = None
+        self.version = None
+        if self.cache_file:
+            self.read_cache()
+
+    def get_cache_id(self):
+        return '%s:%s/%s %s' % (self.host, self.port, self.path, self.method)
+
+    def read_cache(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file) as fh:
+                cache = json.load(fh)
+        except (IOError, ValueError) as e:
+            logging.warning('Could not read the rules API cache %s: %s' % (self.cache_file, e))
+            return
+        if cache.get('id') != self.get_cache_id():
+            return
+        self.rules = cache['rules']
+        self.etag = cache.get('etag')
+        self.last_modified = cache.get('last_modified')
+        self.version = cache.get('version')
+
+    def write_cache(self):
+        cache = {'id': self.get_cache_id(),
+                 'rules': self.rules,
+                 'etag': self.etag,
+                 'last_modified': self.last_modified,
+                 'version': self.version}
+        # Write to a temporary file first, so that the cache is never left half written
+        temp_file = self.cache_file + '.tmp'
+        try:
+            with open(temp_file, 'w') as fh:
+                json.dump(cache, fh)
+            os.rename(temp_file, self.cache_file)
+        except (IOError, OSError) as e:
+            logging.warning('Could not write the rules API cache %s: %s' % (self.cache_file, e))
+
+    def request(self, path, headers=None):
+        """ Requests a path from the API, returning the decoded JSON response and the response headers,
+        or None if the response was 304 Not Modified. """
+        try:
+            response = getattr(self.conn, self.method)(path, headers=headers or {}).response
+            return response.decode_json(), response.headers
+        except HttpConnectionError as e:
+            if e.status_code == 304:
+                return None
+            raise EAException('Could not fetch rules: %s' % (e))
+        except (RequestException, ValueError) as e:
+            raise EAException('Could not fetch rules from %s: %s' % (self.conn.uri, e))
+
+    def fetch(self):
+        """ Fetches the rules, if they changed since they were last fetched. """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+
+        since = self.version if self.delta and self.rules is not None else None
+        path = self.path
+        if since is not None:
+            path += ('&' if '?' in path else '?') + urllib.urlencode({self.since_param: since})
+
+        result = self.request(path, headers)
+        if result is None:
+            return
+        body, response_headers = result
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+
+        version = None
+        if not isinstance(body, dict):
+            raise EAException('Rules API response is not a dictionary')
+        if not self.delta:
+            rules = body
+        else:
+            rules = {} if since is None or body.get('full') else dict(self.rules)
+            while True:
+                rules.update(body.get('rules', {}))
+                for key in body.get('deleted', []):
+                    rules.pop(key, None)
+                version = body.get('version', version)
+                if not body.get('next'):
+                    break
+                result = self.request(body['next'])
+                if result is None:
+                    raise EAException('Rules API returned 304 for %s' % (body['next']))
+                body = result[0]
+
+        self.rules = rules
+        self.etag = etag
+        self.last_modified = last_modified
+        self.version = version
+        if self.cache_file:
+            self.write_cache()
+
+    def get_rules(self, refresh=True):
+        """ Returns a dictionary mapping rule keys to rules, which must not be modified.
+
+        :param refresh: Whether to fetch changes to the rules, rather than use those fetched last.
+        """
+        if refresh or self.rules is None:
+            try:
+                self.fetch()
+            except EAException as e:
+                if self.rules is None:
+                    raise
+                logging.warning('%s, using the rules which were fetched last' % (e))
+        return self.rules
+
+    def get_rule_hashes(self):
+        """ Returns the hashes of the rules, as get_rule_hashes would. Only rules which changed are hashed, and the
+        same dictionary is returned for as long as none have changed. """
+        old_rules = self.rules
+        rules = self.get_rules()
+        if self.hashes is None or rules is not old_rules:
+            hashes = {}
+            for key, rule in rules.iteritems():
+                if self.hashes is not None and key in self.hashes and old_rules.get(key) is rule:
+                    hashes[key] = self.hashes[key]
+                else:
+                    hashes[key] = hash_rule(parse_rule(key, copy.deepcopy(rule)))
+            self.hashes = hashes
+        return self.hashes
+
+
+# An ApiRuleSource for each rules API, see get_api_rule_source
+api_rule_sources = {}
+
+
+def get_api_rule_source(conf):
+    key = (conf.get('rules_api_host'), conf.get('rules_api_port'), conf.get('rules_api_path'),
+           conf.get('rules_api_method'))
+    if key not in api_rule_sources:
+        api_rule_sources[key] = ApiRuleSource(conf)
+    return api_rule_sources[key]
+
+
+def yield_api_rules(conf, use_rule=None):
+    rules = get_api_rule_source(conf).get_rules()
+
+    for k, v in rules.items():
+        # Rules are modified as they are loaded, so each gets its own copy
+        yield k, copy.deepcopy(v)
+
+
+def load_rule_yaml(rule_key):
+    try:
+        return yaml_loader(rule_key)
+    except yaml.scanner.ScannerError as e:
+        raise EAException('Could not parse file %s: %s' % (rule_key, e))
 
 
 def yield_dir_rules(conf, use_rule=None):
     rule_keys = get_file_paths(conf, use_rule)
 
     for rule_key in rule_keys:
-        with open(rule_key) as fh:
-            try:
-                yield rule_key, yaml_loader(fh.read())        
-            except yaml.scanner.ScannerError as e:
-                raise EAException('Could not parse file %s: %s' % (rule_key, e))
+        yield rule_key, load_rule_yaml(rule_key)
 
 
 def yield_rules(conf, use_rule=None):
@@ -578,7 +781,25 @@ def yield_rules(conf, use_rule=None):
         yield k, parse_rule(k, v)
 
 
+def load_rule_file(rule_key):
+    """ Reads and parses a single rule file, as yield_rules does for every rule file. """
+    try:
+        return parse_rule(rule_key, load_rule_yaml(rule_key))
+    except IOError as e:
+        raise EAException('Could not read file %s: %s' % (rule_key, e))
+
+
 def load_rule_configuration(key, conf, use_rule=None):
+    # Rule files are read directly, rather than reading every rule to find one
+    if conf['rules_type'] == 'dir':
+        return load_configuration(key, load_rule_file(key), conf)
+
+    # API rules were just fetched by get_rule_hashes
+    if conf['rules_type'] == 'api':
+        rules = get_api_rule_source(conf).get_rules(refresh=False)
+        if key in rules:
+            return load_configuration(key, parse_rule(key, copy.deepcopy(rules[key])), conf)
+
     for rule_key, rule in yield_rules(conf, use_rule=use_rule):
         if rule_key == key:
             return load_configuration(key, rule, conf)
@@ -586,10 +807,140 @@ def load_rule_configuration(key, conf, use_rule=None):
     raise EAException("Unable to find rule with key: '{key}'".format(key=key))
 
 
+def hash_rule(rule):
+    return hashlib.sha1(str(rule)).digest()
+
+
+def get_code_version():
+    """ Returns a hash of the code which validates and normalizes rules, so that rules cached by another version of
+    ElastAlert are not used. """
+    code_hash = hashlib.sha1()
+    for filename in (os.path.splitext(__file__)[0] + '.py', os.path.join(os.path.dirname(__file__), 'schema.yaml')):
+        try:
+            with open(filename, 'rb') as fh:
+                code_hash.update(fh.read())
+        except IOError:
+            # Running from a package without the sources
+            code_hash.update(filename)
+    return code_hash.hexdigest()
+
+
+class RuleCache(object):
+    """ Stores rules after they were validated and normalized by load_options, in rule_cache_dir, so that the rules
+    which have not changed are not validated again when ElastAlert restarts. Each rule is stored in a file named after
+    a hash of the rule, the global configuration and the code which loads it, so a change to any of them is a miss.
+
+    :param directory: The directory in which to store the rules.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.code_version = get_code_version()
+        self.reset()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                logging.warning('Could not create the rule cache directory %s: %s' % (directory, e))
+
+    def reset(self):
+        """ Resets the counts of hits and misses and which rules were used, such as before loading every rule. """
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+
+    def get_cache_key(self, rule):
+        data = json.dumps([self.code_version, base_config, rule], sort_keys=True, default=repr)
+        return hashlib.sha1(data).hexdigest()
+
+    def get_path(self, cache_key):
+        return os.path.join(self.directory, cache_key + '.pickle')
+
+    def read(self, cache_key):
+        path = self.get_path(cache_key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as fh:
+                return cPickle.load(fh)
+        except Exception as e:
+            logging.warning('Could not read the cached rule %s: %s' % (path, e))
+            return None
+
+    def write(self, cache_key, rule):
+        # The timestamp conversion functions may be closures, which cannot be pickled
+        rule = dict((key, value) for key, value in rule.iteritems() if key not in ('ts_to_dt', 'dt_to_ts'))
+        path = self.get_path(cache_key)
+        temp_file = path + '.tmp'
+        try:
+            with open(temp_file, 'wb') as fh:
+                cPickle.dump(rule, fh, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_file, path)
+        except (IOError, OSError, cPickle.PicklingError, TypeError) as e:
+            logging.warning('Could not write the cached rule %s: %s' % (path, e))
+
+    def load_options(self, rule, conf, key, args=None):
+        """ Does the same as load_options, using the cached result if the rule was loaded before. """
+        cache_key = self.get_cache_key(rule)
+        self.used.add(cache_key)
+        cached_rule = self.read(cache_key)
+        if cached_rule is not None:
+            self.hits += 1
+            rule.clear()
+            rule.update(cached_rule)
+            set_timestamp_conversion(rule)
+            return
+        self.misses += 1
+        load_options(rule, conf, key, args)
+        self.write(cache_key, rule)
+
+    def clear(self):
+        """ Removes every cached rule. """
+        self.remove(lambda cache_key: True)
+
+    def remove_unused(self):
+        """ Removes the cached rules which were not used since the cache was reset. """
+        self.remove(lambda cache_key: cache_key not in self.used)
+
+    def remove(self, should_remove):
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            cache_key, extension = os.path.splitext(filename)
+            if extension == '.pickle' and should_remove(cache_key):
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError as e:
+                    logging.warning('Could not remove the cached rule %s: %s' % (filename, e))
+
+
+# A RuleCache for each rule_cache_dir, see get_rule_cache
+rule_caches = {}
+
+
+def get_rule_cache(conf):
+    if conf['rule_cache_dir'] not in rule_caches:
+        rule_caches[conf['rule_cache_dir']] = RuleCache(conf['rule_cache_dir'])
+    return rule_caches[conf['rule_cache_dir']]
+
+
+def load_cached_options(rule, conf, key, args=None):
+    """ Calls load_options, through the rule cache if rule_cache_dir is set. """
+    if conf.get('rule_cache_dir'):
+        get_rule_cache(conf).load_options(rule, conf, key, args)
+    else:
+        load_options(rule, conf, key, args)
+
+
 def get_rule_hashes(conf, use_rule=None):
+    if conf['rules_type'] == 'api':
+        return get_api_rule_source(conf).get_rule_hashes()
+
     rule_mod_times = {}
 
     for k, v in yield_rules(conf, use_rule=use_rule):
-        rule_mod_times[k] = hashlib.sha1(str(v)).digest()
+        rule_mod_times[k] = hash_rule(v)
     
     return rule_mod_times
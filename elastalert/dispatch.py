@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+from util import EAException
+from util import elastalert_logger
+
+
+class WorkerPool(object):
+    """ Runs jobs on a pool of worker threads, such as sending alerts, so that a slow alerter does not hold up
+    running rules, or initializing rules, so that each can run as soon as it is ready.
+
+    Jobs are submitted with a key, normally the rule name. Jobs with the same key run one at a time,
+    in the order they were submitted, as alerters keep state between alerts. The number of calls made with call
+    in each group, such as an alerter type, running at once can be limited, and failing calls are retried with
+    exponential backoff. Results added by jobs are kept until the caller collects them with pop_results.
+
+    :param workers: The number of worker threads.
+    :param name: The prefix of the worker threads' names.
+    :param concurrency: A dictionary mapping groups to the maximum number of their calls running at once.
+    :param default_concurrency: The maximum number of calls running at once for groups which are not in concurrency.
+    :param retries: The number of times to retry a call which raises EAException.
+    :param backoff: The delay, in seconds, before the first retry. It doubles with each further retry.
+    :param max_queue_size: The maximum number of jobs waiting to run. Submitting blocks while it is reached.
+    """
+
+    def __init__(self, workers, name='elastalert-worker', concurrency=None, retries=3, backoff=1.0, max_queue_size=0,
+                 default_concurrency=None):
+        self.concurrency = concurrency or {}
+        self.default_concurrency = default_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_queue_size = max_queue_size
+        self.pending = []
+        self.active_keys = set()
+        self.results = []
+        self.semaphores = {}
+        self.running = True
+        self.stopped = threading.Event()
+        self.condition = threading.Condition()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.work, name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, func, *args):
+        """ Queues func(*args) to be run by a worker, after any jobs already queued with the same key. """
+        with self.condition:
+            while self.max_queue_size and len(self.pending) >= self.max_queue_size:
+                self.condition.wait()
+            self.pending.append((key, func, args))
+            self.condition.notify_all()
+
+    def next_job(self):
+        """ Blocks until there is a job whose key is not already being run, or returns None once stopped. """
+        with self.condition:
+            while True:
+                for job in self.pending:
+                    if job[0] not in self.active_keys:
+                        self.pending.remove(job)
+                        self.active_keys.add(job[0])
+                        self.condition.notify_all()
+                        return job
+                if not self.running and not self.pending:
+                    return None
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            key, func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                # Jobs are expected to handle their own errors; this only keeps the worker alive
+                logging.exception('Uncaught exception in job for %s: %s' % (key, e))
+            finally:
+                with self.condition:
+                    self.active_keys.discard(key)
+                    self.condition.notify_all()
+
+    def get_semaphore(self, group):
+        with self.condition:
+            if group not in self.semaphores:
+                limit = self.concurrency.get(group, self.default_concurrency)
+                self.semaphores[group] = threading.BoundedSemaphore(limit) if limit else None
+            return self.semaphores[group]
+
+    def call(self, group, func, *args):
+        """ Calls func(*args) while holding one of group's concurrency slots. If it raises EAException,
+        it is retried after an exponentially increasing delay, until retries is exhausted or the pool stops.
+
+        :return: The return value of func.
+        """
+        semaphore = self.get_semaphore(group)
+        delay = self.backoff
+        attempt = 0
+        stopping = False
+        while True:
+            if semaphore:
+                semaphore.acquire()
+            try:
+                return func(*args)
+            except EAException as e:
+                if attempt >= self.retries or stopping:
+                    raise
+                elastalert_logger.warning('Error while running %s, retrying in %s seconds: %s' % (group, delay, e))
+            finally:
+                if semaphore:
+                    semaphore.release()
+            # Once stopped, the wait ends straight away and this is the last attempt
+            stopping = self.stopped.wait(delay)
+            delay *= 2
+            attempt += 1
+
+    def add_result(self, result):
+        with self.condition:
+            self.results.append(result)
+            self.condition.notify_all()
+
+    def wait_for_results(self, timeout):
+        """ Waits for up to timeout seconds for a job to add a result, unless there already are results. """
+        with self.condition:
+            if not self.results:
+                self.condition.wait(timeout)
+
+    def pop_results(self):
+        """ Returns and clears the results added by finished jobs. """
+        with self.condition:
+            results, self.results = self.results, []
+        return results
+
+    def stop(self, timeout=None, cancel=False):
+        """ Stops accepting new jobs once those already queued have run, and waits for the workers to finish.
+        Retries which are waiting are attempted once more without further delay.
+
+        :param timeout: The maximum time, in seconds, to wait for each worker.
+        :param cancel: If true, jobs which have not started are dropped instead of run.
+        """
+        with self.condition:
+            self.running = False
+            if cancel:
+                self.pending = []
+            self.condition.notify_all()
+        self.stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class TokenBucket(object):
+    """ Allows bursts of up to burst tokens, refilled at rate tokens per second. """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+
+    def take(self):
+        """ Takes a token if there is one.
+
+        :return: 0 if a token was taken, otherwise the number of seconds until there will be one.
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class HeldAlerts(object):
+    """ Alerts held back by storm control, to be sent as one by the alerter which is first in alerts.
+
+    :param send: Called with an alerter and its matches to send a single alert.
+    :param send_coalesced: Called with the first alerter and a list of (alerter, matches) to send several alerts as one.
+    """
+
+    def __init__(self, send, send_coalesced):
+        self.send = send
+        self.send_coalesced = send_coalesced
+        # Tuples of an alerter, its matches, the function called when it was sent, and the time it was held
+        self.alerts = []
+
+
+class AlertOutcome(object):
+    """ Collects the results of sending an alert with each of a rule's alerters. Alerters which storm control
+    holds back finish later, on another thread, so the outcome is only complete once every alerter has finished.
+
+    :param on_complete: Called with the outcome once it is complete.
+    """
+
+    def __init__(self, on_complete=None):
+        self.alert_sent = False
+        self.alert_exception = None
+        self.storm_control = []
+        self.alerts_sent = 0
+        # Whether an alerter raised an uncaught exception
+        self.failed = False
+        self.on_complete = on_complete
+        # The alerters which have not finished, plus one until all of them were started
+        self.pending = 1
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Records that an alerter started sending, so that the outcome is not complete until it finishes. """
+        with self.lock:
+            self.pending += 1
+
+    def finish(self, error=None, decision=None):
+        """ Records the result of an alerter which was started.
+
+        :param error: The error the alerter failed with, or None if it succeeded.
+        :param decision: A dictionary describing how storm control held the alert back, if it did.
+        """
+        with self.lock:
+            if error is None:
+                self.alert_sent = True
+                self.alerts_sent += 1
+            else:
+                self.alert_exception = str(error)
+            if decision:
+                self.storm_control.append(decision)
+        self.done()
+
+    def done(self):
+        """ Records that every alerter was started. The outcome is complete once they have all finished. """
+        with self.lock:
+            self.pending -= 1
+            complete = not self.pending
+        if complete and self.on_complete:
+            self.on_complete(self)
+
+
+class StormControl(object):
+    """ Limits the rate at which alerts are sent to each destination, such as a Slack webhook, with a token bucket.
+    Alerts over the limit are held in a queue for their destination, rather than being dropped or holding up the
+    thread which sent them. While an alert is held, later alerts to the same destination, from any rule, are
+    coalesced with it and sent as a single alert, if its alerter supports it. A background thread submits held
+    alerts to a WorkerPool as their destination's limit allows.
+
+    :param limits: A dictionary mapping alerter types to a tuple of the rate, in alerts per second, and burst size.
+    :param pool: The WorkerPool which sends held alerts. They are submitted with the first alerter's rule name as
+    the key, so that they are not sent at the same time as that rule's other alerts.
+    """
+
+    def __init__(self, limits, pool):
+        self.limits = limits
+        self.pool = pool
+        self.buckets = {}
+        # Lists of HeldAlerts, oldest first, by alerter type and destination
+        self.held = {}
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.release_held, name='elastalert-storm-control')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, alerter_type, alerter, matches, send, send_coalesced, on_sent):
+        """ Sends an alert using send(alerter, matches) if its destination's rate limit allows it. Otherwise, the
+        alert is held, or coalesced with a held alert, to be sent later by send_coalesced(first_alerter,
+        [(alerter, matches), ...]) or send, and on_sent(error, decision) is called once it was sent. The error
+        is None if sending succeeded, and decision is a dictionary describing how the alert was held back.
+
+        :return: True if the alert was held, or False if it was sent straight away.
+        """
+        destination = alerter.get_destination()
+        if alerter_type not in self.limits or destination is None:
+            send(alerter, matches)
+            return False
+
+        key = (alerter_type, destination)
+        with self.condition:
+            queue = self.held.get(key)
+            if not queue:
+                if key not in self.buckets:
+                    self.buckets[key] = TokenBucket(*self.limits[alerter_type])
+                # Once stopped, nothing releases held alerts, so they are sent straight away
+                hold = self.running and self.buckets[key].take()
+            else:
+                hold = True
+            if hold:
+                if queue and len(queue[-1].alerts) < queue[-1].alerts[0][0].max_coalesced_alerts:
+                    group = queue[-1]
+                else:
+                    group = HeldAlerts(send, send_coalesced)
+                    self.held.setdefault(key, []).append(group)
+                group.alerts.append((alerter, matches, on_sent, time.time()))
+                self.condition.notify_all()
+                return True
+        send(alerter, matches)
+        return False
+
+    def release_held(self):
+        """ Submits held alerts to the pool as their destinations' rate limits allow, until stopped. Once stopped,
+        every held alert is submitted straight away. """
+        while True:
+            ready = []
+            with self.condition:
+                while True:
+                    wait = None
+                    for key in self.held.keys():
+                        queue = self.held[key]
+                        while queue:
+                            delay = self.buckets[key].take() if self.running else 0
+                            if delay:
+                                wait = delay if wait is None else min(wait, delay)
+                                break
+                            ready.append(queue.pop(0))
+                        if not queue:
+                            del self.held[key]
+                    if ready or not self.running:
+                        break
+                    self.condition.wait(wait)
+                stopping = not self.running
+            # Submitting may block while the pool's queue is full, so it is done without holding the condition
+            for group in ready:
+                self.pool.submit(group.alerts[0][0].rule['name'], self.send_held, group)
+            if stopping:
+                return
+
+    def send_held(self, group):
+        """ Sends a group of held alerts on a pool worker, and tells each of them how it went. If sending fails,
+        they are told while the error is being handled, so that its traceback can be logged. """
+        try:
+            if len(group.alerts) > 1:
+                group.send_coalesced(group.alerts[0][0], [(alerter, matches) for alerter, matches, _, _ in group.alerts])
+            else:
+                group.send(group.alerts[0][0], group.alerts[0][1])
+        except Exception as e:
+            self.finish_held(group, e)
+        else:
+            self.finish_held(group)
+
+    def finish_held(self, group, error=None):
+        """ Calls each alert's on_sent with the error, if sending failed, and how it was held back. """
+        now = time.time()
+        leader = group.alerts[0][0]
+        for i, (alerter, matches, on_sent, held_at) in enumerate(group.alerts):
+            decision = {'throttled_seconds': now - held_at, 'coalesced_alerts': len(group.alerts)}
+            if i:
+                decision['coalesced_into'] = leader.rule['name']
+            on_sent(error, decision)
+
+    def stop(self):
+        """ Submits every held alert to the pool straight away, and stops holding alerts back. """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import argparse
+import cPickle as pickle
 import copy
 import datetime
+import hashlib
 import json
 import logging
 import os
@@ -10,6 +12,8 @@ import sys
 import time
 import timeit
 import traceback
+import uuid
+import zlib
 from email.mime.text import MIMEText
 from smtplib import SMTP
 from smtplib import SMTPException
@@ -19,16 +23,29 @@ import dateutil.tz
 import kibana
 import yaml
 from alerts import DebugAlerter
+from alerts import smtp_pool
 from config import get_rule_hashes
+from config import load_modules
 from config import load_rule_configuration
 from config import load_rules
 from croniter import croniter
+from dispatch import AlertOutcome
+from dispatch import StormControl
+from dispatch import WorkerPool
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.exceptions import ElasticsearchException
 from elasticsearch.exceptions import TransportError
+from enhancements import BaseEnhancement
 from enhancements import DropMatchException
+from metrics import Metrics
+from metrics import MetricsServer
+from query_plan import FILTER_PATHS
+from query_plan import QueryPlan
+from rule_registry import RuleRegistry
+from rule_watcher import RuleWatcher
 from ruletypes import FlatlineRule
 from util import add_raw_postfix
+from util import approximate_size
 from util import cronite_datetime_to_timestamp
 from util import dt_to_ts
 from util import dt_to_unix
@@ -49,6 +66,9 @@ from util import ts_now
 from util import ts_to_dt
 from util import unix_to_dt
 
+# Incremented whenever the contents of state snapshots change incompatibly
+STATE_SNAPSHOT_VERSION = 1
+
 
 class ElastAlerter():
     """ The main ElastAlert runner. This class holds all state about active rules,
@@ -91,6 +111,11 @@ class ElastAlerter():
             action='store_true',
             dest='pin_rules',
             help='Stop ElastAlert from monitoring config file changes')
+        parser.add_argument(
+            '--rebuild-rule-cache',
+            action='store_true',
+            dest='rebuild_rule_cache',
+            help='Validate every rule again, rather than use those stored in rule_cache_dir')
         parser.add_argument('--es_debug', action='store_true', dest='es_debug', help='Enable verbose logging from Elasticsearch queries')
         parser.add_argument(
             '--es_debug_trace',
@@ -130,7 +155,7 @@ class ElastAlerter():
         self.conf = load_rules(self.args)
         self.max_query_size = self.conf['max_query_size']
         self.scroll_keepalive = self.conf['scroll_keepalive']
-        self.rules = self.conf['rules']
+        self.rules = RuleRegistry(self.conf['rules'])
         self.writeback_index = self.conf['writeback_index']
         self.run_every = self.conf['run_every']
         self.alert_time_limit = self.conf['alert_time_limit']
@@ -140,6 +165,10 @@ class ElastAlerter():
         self.from_addr = self.conf.get('from_addr', 'ElastAlert')
         self.smtp_host = self.conf.get('smtp_host', 'localhost')
         self.max_aggregation = self.conf.get('max_aggregation', 10000)
+        self.max_total_state_bytes = self.conf.get('max_total_state_bytes')
+        self.state_snapshot_dir = self.conf.get('state_snapshot_dir')
+        self.state_snapshot_interval = self.conf.get('state_snapshot_interval', datetime.timedelta(0))
+        self.last_state_snapshot = None
         self.alerts_sent = 0
         self.num_hits = 0
         self.num_dupes = 0
@@ -147,20 +176,63 @@ class ElastAlerter():
         self.current_es_addr = None
         self.buffer_time = self.conf['buffer_time']
         self.silence_cache = {}
-        self.rule_hashes = get_rule_hashes(self.conf, self.args.rule)
+        # Rule files are checked for changes in the background, only parsing the files which changed
+        self.rule_watcher = None
+        if not self.args.pin_rules and self.conf.get('rules_type') == 'dir':
+            self.rule_watcher = RuleWatcher(self.conf, self.args.rule,
+                                            interval=total_seconds(self.conf.get('rule_watch_interval',
+                                                                                 datetime.timedelta(seconds=10))),
+                                            use_inotify=self.conf.get('rule_watch_inotify', False))
+            self.rule_hashes = self.rule_watcher.get_rule_hashes()
+        else:
+            self.rule_hashes = get_rule_hashes(self.conf, self.args.rule)
         self.starttime = self.args.start
-        self.disabled_rules = []
+        self.disabled_rules = RuleRegistry()
         self.replace_dots_in_field_names = self.conf.get('replace_dots_in_field_names', False)
         self.string_multi_field_name = self.conf.get('string_multi_field_name', False)
 
         self.writeback_es = elasticsearch_client(self.conf)
         self._es_version = None
 
-        remove = []
-        for rule in self.rules:
-            if not self.init_rule(rule):
-                remove.append(rule)
-        map(self.rules.remove, remove)
+        # Metrics are only recorded if they are served, see start_metrics_server
+        self.metrics = Metrics() if self.conf.get('metrics_port') is not None else None
+        self.metrics_server = None
+
+        self.alert_dispatcher = None
+        if self.conf.get('alert_workers') and not self.debug:
+            self.alert_dispatcher = WorkerPool(self.conf['alert_workers'], name='elastalert-alert',
+                                               concurrency=self.conf.get('alerter_concurrency'),
+                                               retries=self.conf.get('alert_retries', 3),
+                                               backoff=total_seconds(self.conf.get('alert_retry_backoff',
+                                                                                   datetime.timedelta(seconds=1))),
+                                               max_queue_size=self.conf.get('alert_queue_size', 1000))
+
+        # Storm control sends alerts it held back for a rate limit on the dispatcher's workers
+        self.storm_control = None
+        if self.alert_dispatcher and self.conf.get('alert_rate_limit'):
+            limits = {}
+            for alerter_type, limit in self.conf['alert_rate_limit'].iteritems():
+                limits[alerter_type] = (limit['rate'] / 60.0, limit.get('burst', 1))
+            self.storm_control = StormControl(limits, self.alert_dispatcher)
+
+        # With rule_init_workers, rules are loaded and initialized in the background, and each
+        # rule starts running as soon as it is ready
+        self.rule_initializer = None
+        self.initializing_rules = set()
+        self.rule_init_starttime = None
+        if self.conf.get('rule_init_workers'):
+            # Silencing only needs the rules' names
+            if not self.args.silence:
+                self.rule_initializer = WorkerPool(self.conf['rule_init_workers'], name='elastalert-rule-init', retries=0,
+                                                   default_concurrency=self.conf.get('rule_init_concurrency', 2))
+                for rule in self.rules:
+                    self.initializing_rules.add(rule['name'])
+                    self.rule_initializer.submit(rule['name'], self.initialize_rule, rule)
+                self.rules = RuleRegistry()
+        else:
+            for rule in self.rules:
+                if not self.init_rule(rule):
+                    self.rules.remove(rule)
 
         if self.args.silence:
             self.silence()
@@ -226,67 +298,16 @@ class ElastAlerter():
         :param sort: If true, sort results by timestamp. (Default True)
         :return: A query dictionary to pass to Elasticsearch.
         """
-        starttime = to_ts_func(starttime)
-        endtime = to_ts_func(endtime)
-        filters = copy.copy(filters)
-        es_filters = {'filter': {'bool': {'must': filters}}}
-        if starttime and endtime:
-            es_filters['filter']['bool']['must'].insert(0, {'range': {timestamp_field: {'gt': starttime,
-                                                                                        'lte': endtime}}})
-        if five:
-            query = {'query': {'bool': es_filters}}
-        else:
-            query = {'query': {'filtered': es_filters}}
-        if sort:
-            query['sort'] = [{timestamp_field: {'order': 'desc' if desc else 'asc'}}]
-        return query
-
-    def get_terms_query(self, query, size, field, five=False):
-        """ Takes a query generated by get_query and outputs a aggregation query """
-        query_element = query['query']
-        if 'sort' in query_element:
-            query_element.pop('sort')
-        if not five:
-            query_element['filtered'].update({'aggs': {'counts': {'terms': {'field': field, 'size': size}}}})
-            aggs_query = {'aggs': query_element}
-        else:
-            aggs_query = query
-            aggs_query['aggs'] = {'counts': {'terms': {'field': field, 'size': size}}}
-        return aggs_query
-
-    def get_aggregation_query(self, query, rule, query_key, terms_size, timestamp_field='@timestamp'):
-        """ Takes a query generated by get_query and outputs a aggregation query """
-        query_element = query['query']
-        if 'sort' in query_element:
-            query_element.pop('sort')
-        metric_agg_element = rule['aggregation_query_element']
-
-        bucket_interval_period = rule.get('bucket_interval_period')
-        if bucket_interval_period is not None:
-            aggs_element = {
-                'interval_aggs': {
-                    'date_histogram': {
-                        'field': timestamp_field,
-                        'interval': bucket_interval_period},
-                    'aggs': metric_agg_element
-                }
-            }
-            if rule.get('bucket_offset_delta'):
-                aggs_element['interval_aggs']['date_histogram']['offset'] = '+%ss' % (rule['bucket_offset_delta'])
-        else:
-            aggs_element = metric_agg_element
-
-        if query_key is not None:
-            for idx, key in reversed(list(enumerate(query_key.split(',')))):
-                aggs_element = {'bucket_aggs': {'terms': {'field': key, 'size': terms_size}, 'aggs': aggs_element}}
+        plan = QueryPlan({'filter': filters, 'timestamp_field': timestamp_field, 'dt_to_ts': to_ts_func, 'five': five})
+        return plan.get_query(starttime, endtime, sort=sort, desc=desc)
 
-        if not rule['five']:
-            query_element['filtered'].update({'aggs': aggs_element})
-            aggs_query = {'aggs': query_element}
-        else:
-            aggs_query = query
-            aggs_query['aggs'] = aggs_element
-        return aggs_query
+    @staticmethod
+    def get_query_plan(rule):
+        """ Returns the rule's QueryPlan, compiling it again if the options it was compiled from changed. """
+        plan = rule.get('query_plan')
+        if plan is None or not plan.is_current(rule):
+            plan = rule['query_plan'] = QueryPlan(rule)
+        return plan
 
     def get_index_start(self, index, timestamp_field='@timestamp'):
         """ Query for one result sorted by timestamp to find the beginning of the index.
@@ -360,14 +381,7 @@ class ElastAlerter():
         :return: A list of hits, bounded by rule['max_query_size'] (or self.max_query_size).
         """
 
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five'],
-        )
+        query = self.get_query_plan(rule).get_query(starttime, endtime)
         extra_args = {'_source_include': rule['include']}
         scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
         if not rule.get('_source_enabled'):
@@ -376,10 +390,13 @@ class ElastAlerter():
             else:
                 query['fields'] = rule['include']
             extra_args = {}
+        filter_path_args = self.get_filter_path_args(rule, 'hits')
+        extra_args.update(filter_path_args)
 
+        query_start = timeit.default_timer()
         try:
             if scroll:
-                res = self.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
+                res = self.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive, **filter_path_args)
             else:
                 res = self.current_es.search(
                     scroll=scroll_keepalive,
@@ -398,7 +415,12 @@ class ElastAlerter():
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running query: %s' % (e), {'rule': rule['name'], 'query': query})
             return None
-        hits = res['hits']['hits']
+        if self.metrics:
+            self.record_query(rule, 'scroll' if scroll else 'hits', query_start, res)
+            if scroll:
+                self.metrics.inc('elastalert_scroll_pages_total', rule=rule['name'])
+        # Elasticsearch leaves out hits filtered by filter_path if there are none
+        hits = res['hits'].get('hits', [])
         self.num_hits += len(hits)
         lt = rule.get('use_local_time')
         status_log = "Queried rule %s from %s to %s: %s / %s hits" % (
@@ -431,18 +453,12 @@ class ElastAlerter():
         :param endtime: The latest time to query.
         :return: A dictionary mapping timestamps to number of hits for that time period.
         """
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+        query = self.get_query_plan(rule).get_query(starttime, endtime, sort=False)
 
+        query_start = timeit.default_timer()
         try:
-            res = self.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True)
+            res = self.current_es.count(index=index, doc_type=rule['doc_type'], body=query, ignore_unavailable=True,
+                                        **self.get_search_args(rule, 'count'))
         except ElasticsearchException as e:
             # Elasticsearch sometimes gives us GIGANTIC error messages
             # (so big that they will fill the entire terminal buffer)
@@ -450,6 +466,8 @@ class ElastAlerter():
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running count query: %s' % (e), {'rule': rule['name'], 'query': query})
             return None
+        if self.metrics:
+            self.record_query(rule, 'count', query_start, res)
 
         self.num_hits += res['count']
         lt = rule.get('use_local_time')
@@ -459,7 +477,7 @@ class ElastAlerter():
         return {endtime: res['count']}
 
     def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
-        rule_filter = copy.copy(rule['filter'])
+        extra_filters = []
         if qk:
             filter_key = rule['query_key']
             if rule['five']:
@@ -468,20 +486,12 @@ class ElastAlerter():
                 end = '.raw'
             if rule.get('raw_count_keys', True) and not rule['query_key'].endswith(end):
                 filter_key = add_raw_postfix(filter_key, rule['five'])
-            rule_filter.extend([{'term': {filter_key: qk}}])
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+            extra_filters.append({'term': {filter_key: qk}})
         if size is None:
             size = rule.get('terms_size', 50)
-        query = self.get_terms_query(base_query, size, key, rule['five'])
+        query = self.get_query_plan(rule).get_terms_query(starttime, endtime, key, size, extra_filters)
 
+        query_start = timeit.default_timer()
         try:
             if not rule['five']:
                 res = self.current_es.search(
@@ -489,10 +499,12 @@ class ElastAlerter():
                     doc_type=rule['doc_type'],
                     body=query,
                     search_type='count',
-                    ignore_unavailable=True
+                    ignore_unavailable=True,
+                    **self.get_search_args(rule, 'terms')
                 )
             else:
-                res = self.current_es.search(index=index, doc_type=rule['doc_type'], body=query, size=0, ignore_unavailable=True)
+                res = self.current_es.search(index=index, doc_type=rule['doc_type'], body=query, size=0, ignore_unavailable=True,
+                                             **self.get_search_args(rule, 'terms'))
         except ElasticsearchException as e:
             # Elasticsearch sometimes gives us GIGANTIC error messages
             # (so big that they will fill the entire terminal buffer)
@@ -500,6 +512,8 @@ class ElastAlerter():
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running terms query: %s' % (e), {'rule': rule['name'], 'query': query})
             return None
+        if self.metrics:
+            self.record_query(rule, 'terms', query_start, res)
 
         if 'aggregations' not in res:
             return {}
@@ -515,19 +529,10 @@ class ElastAlerter():
         return {endtime: buckets}
 
     def get_hits_aggregation(self, rule, starttime, endtime, index, query_key, term_size=None):
-        rule_filter = copy.copy(rule['filter'])
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
         if term_size is None:
             term_size = rule.get('terms_size', 50)
-        query = self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
+        query = self.get_query_plan(rule).get_aggregation_query(starttime, endtime, query_key, term_size)
+        query_start = timeit.default_timer()
         try:
             if not rule['five']:
                 res = self.current_es.search(
@@ -535,15 +540,19 @@ class ElastAlerter():
                     doc_type=rule.get('doc_type'),
                     body=query,
                     search_type='count',
-                    ignore_unavailable=True
+                    ignore_unavailable=True,
+                    **self.get_search_args(rule, 'aggregation')
                 )
             else:
-                res = self.current_es.search(index=index, doc_type=rule.get('doc_type'), body=query, size=0, ignore_unavailable=True)
+                res = self.current_es.search(index=index, doc_type=rule.get('doc_type'), body=query, size=0, ignore_unavailable=True,
+                                             **self.get_search_args(rule, 'aggregation'))
         except ElasticsearchException as e:
             if len(str(e)) > 1024:
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running query: %s' % (e), {'rule': rule['name']})
             return None
+        if self.metrics:
+            self.record_query(rule, 'aggregation', query_start, res)
         if 'aggregations' not in res:
             return {}
         if not rule['five']:
@@ -553,6 +562,17 @@ class ElastAlerter():
         self.num_hits += res['hits']['total']
         return {endtime: payload}
 
+    def record_query(self, rule, query_type, query_start, res):
+        """ Records the wall time of a query which started at query_start, and the time Elasticsearch says it took.
+
+        :param query_type: The kind of query: hits, scroll, count, terms or aggregation.
+        :param query_start: The timeit.default_timer() value from before the query was sent.
+        :param res: The response to the query.
+        """
+        self.metrics.observe('elastalert_query_seconds', timeit.default_timer() - query_start, rule=rule['name'], type=query_type)
+        if isinstance(res, dict) and 'took' in res:
+            self.metrics.observe('elastalert_query_took_seconds', res['took'] / 1000.0, rule=rule['name'], type=query_type)
+
     def remove_duplicate_events(self, data, rule):
         new_events = []
         for event in data:
@@ -592,7 +612,15 @@ class ElastAlerter():
 
         # Reset hit counter and query
         rule_inst = rule['type']
+        cache_stats = None
+        if rule.get('request_cache') and self.is_cacheable(rule):
+            start, end = self.align_query_range(rule, start, end)
+            if start >= end:
+                # The range will be queried once the next boundary has passed
+                return True
         index = self.get_index(rule, start, end)
+        if rule.get('request_cache_stats') and self.is_cacheable(rule):
+            cache_stats = self.get_request_cache_stats(index)
         if rule.get('use_count_query'):
             data = self.get_hits_count(rule, start, end, index)
         elif rule.get('use_terms_query'):
@@ -606,6 +634,12 @@ class ElastAlerter():
                 data = self.remove_duplicate_events(data, rule)
                 self.num_dupes += old_len - len(data)
 
+        if cache_stats:
+            new_cache_stats = self.get_request_cache_stats(index)
+            if new_cache_stats:
+                self.request_cache_hits += new_cache_stats[0] - cache_stats[0]
+                self.request_cache_misses += new_cache_stats[1] - cache_stats[1]
+
         # There was an exception while querying
         if data is None:
             return False
@@ -723,12 +757,72 @@ class ElastAlerter():
                 es_interval_delta_in_sec = total_seconds(es_interval_delta)
                 offset = int(unix_starttime % es_interval_delta_in_sec)
 
-                if rule.get('sync_bucket_interval'):
+                # With request_cache, query ranges are aligned to the bucket interval, so the buckets must be too
+                if rule.get('sync_bucket_interval') or rule.get('request_cache'):
                     rule['starttime'] = unix_to_dt(unix_starttime - offset)
                     endtime = unix_to_dt(dt_to_unix(endtime) - offset)
                 else:
                     rule['bucket_offset_delta'] = offset
 
+    @staticmethod
+    def is_cacheable(rule):
+        """ Returns whether a rule's queries only count or aggregate, which Elasticsearch's shard request cache can store. """
+        return bool(rule.get('use_count_query') or rule.get('use_terms_query') or rule.get('aggregation_query_element'))
+
+    def align_query_range(self, rule, starttime, endtime):
+        """ Aligns a query's time range to request_cache_interval boundaries, or bucket_interval for rules which use it,
+        so that the same range is queried in the same way and the response can be served from the request cache.
+        Anything after the last boundary is queried by the next query, whose start is aligned down to the same
+        boundary.
+
+        :return: A tuple of the aligned start and end times.
+        """
+        interval = rule.get('bucket_interval_timedelta') or rule.get('request_cache_interval', datetime.timedelta(minutes=1))
+        interval_seconds = int(total_seconds(interval))
+        if interval_seconds < 1:
+            return starttime, endtime
+        unix_starttime = dt_to_unix(starttime)
+        unix_endtime = dt_to_unix(endtime)
+        return (unix_to_dt(unix_starttime - unix_starttime % interval_seconds),
+                unix_to_dt(unix_endtime - unix_endtime % interval_seconds))
+
+    @staticmethod
+    def get_filter_path_args(rule, query_type):
+        """ Returns the filter_path argument which trims the response to a query of query_type, one of the keys of
+        FILTER_PATHS, to the parts which are read, unless the rule sets es_filter_path to false. """
+        if not rule.get('es_filter_path', True):
+            return {}
+        return {'filter_path': FILTER_PATHS[query_type]}
+
+    @staticmethod
+    def get_search_args(rule, query_type):
+        """ Returns the arguments for a count, terms or aggregation query of a rule. """
+        args = ElastAlerter.get_request_cache_args(rule, count=query_type == 'count')
+        args.update(ElastAlerter.get_filter_path_args(rule, query_type))
+        return args
+
+    @staticmethod
+    def get_request_cache_args(rule, count=False):
+        """ Returns the arguments which let Elasticsearch serve a rule's queries from its shard request cache. The
+        preference routes each of the rule's queries to the same shard copies, whose cache holds its earlier responses. """
+        if not rule.get('request_cache'):
+            return {}
+        args = {'preference': rule.get('request_cache_preference', 'elastalert-%s' % (rule['name']))}
+        # The count API does not take request_cache, but it is cached like any search with size 0
+        if not count:
+            args['request_cache'] = 'true'
+        return args
+
+    def get_request_cache_stats(self, index):
+        """ Returns a tuple of the request cache hit and miss counts of an index, or None if they could not be read. """
+        try:
+            stats = self.current_es.indices.stats(index=index, metric='request_cache', ignore_unavailable=True)
+            request_cache = stats['_all']['total']['request_cache']
+            return request_cache['hit_count'], request_cache['miss_count']
+        except (ElasticsearchException, KeyError, TypeError) as e:
+            logging.warning('Could not read the request cache stats of %s: %s' % (index, e))
+            return None
+
     def get_segment_size(self, rule):
         """ The segment size is either buffer_size for queries which can overlap or run_every for queries
         which must be strictly separate. This mimicks the query size for when ElastAlert is running continuously. """
@@ -805,6 +899,8 @@ class ElastAlerter():
         # Run the rule. If querying over a large time period, split it up into segments
         self.num_hits = 0
         self.num_dupes = 0
+        self.request_cache_hits = 0
+        self.request_cache_misses = 0
         segment_size = self.get_segment_size(rule)
 
         tmp_endtime = rule['starttime']
@@ -831,6 +927,7 @@ class ElastAlerter():
 
         # Process any new matches
         num_matches = len(rule['type'].matches)
+        new_matches = []
         while rule['type'].matches:
             match = rule['type'].matches.pop(0)
             match['num_hits'] = self.num_hits
@@ -852,16 +949,13 @@ class ElastAlerter():
                 next_alert, exponent = self.next_alert_time(rule, silence_cache_key, ts_now())
                 self.set_realert(silence_cache_key, next_alert, exponent)
 
-            if rule.get('run_enhancements_first'):
-                try:
-                    for enhancement in rule['match_enhancements']:
-                        try:
-                            enhancement.process(match)
-                        except EAException as e:
-                            self.handle_error("Error running match enhancement: %s" % (e), {'rule': rule['name']})
-                except DropMatchException:
-                    continue
+            new_matches.append(match)
+
+        # Enhancements are run on every new match at once, so that enhancements with process_batch can batch their work
+        if rule.get('run_enhancements_first'):
+            new_matches = self.run_enhancements(rule, new_matches)
 
+        for match in new_matches:
             # If no aggregation, alert immediately
             if not rule['aggregation']:
                 self.alert([match], rule)
@@ -873,6 +967,13 @@ class ElastAlerter():
         # Mark this endtime for next run's start
         rule['previous_endtime'] = endtime
 
+        # Measuring the state walks all of it, so it is only done when something uses the size
+        measure_state = rule.get('max_rule_state_bytes') or self.max_total_state_bytes or self.metrics
+        if measure_state:
+            rule['state_size'] = self.get_rule_state_size(rule)
+            if rule.get('max_rule_state_bytes') and rule['state_size'] > rule['max_rule_state_bytes']:
+                self.enforce_state_budget(rule, rule['max_rule_state_bytes'])
+
         time_taken = time.time() - run_start
         # Write to ES that we've run this rule against this time period
         body = {'rule_name': rule['name'],
@@ -882,6 +983,21 @@ class ElastAlerter():
                 'hits': self.num_hits,
                 '@timestamp': ts_now(),
                 'time_taken': time_taken}
+        if measure_state:
+            body['state_size'] = rule['state_size']
+            body['state_keys'] = rule['type'].get_key_count()
+        enhancement_caches = self.get_enhancement_cache_stats(rule)
+        if enhancement_caches:
+            body['enhancement_caches'] = enhancement_caches
+        if self.metrics:
+            self.metrics.inc('elastalert_hits_total', self.num_hits, rule=rule['name'])
+            self.metrics.inc('elastalert_duplicate_hits_total', self.num_dupes, rule=rule['name'])
+            self.metrics.inc('elastalert_matches_total', num_matches, rule=rule['name'])
+            self.metrics.set('elastalert_rule_state_bytes', rule['state_size'], rule=rule['name'])
+        if rule.get('request_cache_stats'):
+            body['request_cache'] = {'hits': self.request_cache_hits, 'misses': self.request_cache_misses}
+            elastalert_logger.info('Request cache for rule %s: %s hits, %s misses' % (
+                rule['name'], self.request_cache_hits, self.request_cache_misses))
         self.writeback('elastalert_status', body)
 
         return num_matches
@@ -925,11 +1041,7 @@ class ElastAlerter():
 
         # Set rule to either a blank template or existing rule with same name
         if not new:
-            for rule in self.rules:
-                if rule['name'] == new_rule['name']:
-                    break
-            else:
-                rule = blank_rule
+            rule = self.rules.get(new_rule['name']) or blank_rule
 
         copy_properties = ['agg_matches',
                            'current_aggregate_id',
@@ -942,8 +1054,68 @@ class ElastAlerter():
                 continue
             new_rule[prop] = rule[prop]
 
+        # Carry the rule type's windows over to the reloaded rule, or restore them from the last snapshot
+        if 'type' in rule and rule['type'].__class__ is new_rule['type'].__class__:
+            new_rule['type'].set_state(rule['type'].get_state())
+        elif new and self.state_snapshot_dir:
+            self.load_state_snapshot(new_rule)
+
+        # Compile the rule's queries, now that its filters and options are final
+        self.get_query_plan(new_rule)
         return new_rule
 
+    def initialize_rule(self, rule):
+        """ Loads a rule's modules and initializes it on a rule_init_workers thread. Loading a rule may query
+        Elasticsearch, such as for the existing terms of a new_term rule, so at most rule_init_concurrency rules
+        are loaded at once for each cluster. The rule, or None if it failed, is collected by add_initialized_rules. """
+        name = rule['name']
+        cluster = '%s:%s' % (rule.get('es_host'), rule.get('es_port'))
+        try:
+            rule = self.rule_initializer.call(cluster, self.load_and_init_rule, rule)
+        except Exception as e:
+            self.handle_error('Could not initialize rule %s: %s' % (name, e), {'rule': name})
+            rule = None
+        self.rule_initializer.add_result((name, rule))
+
+    def load_and_init_rule(self, rule):
+        load_modules(rule, self.args)
+        return self.init_rule(rule)
+
+    def add_initialized_rules(self):
+        """ Adds the rules which rule_init_workers finished initializing to the running rules.
+
+        :return: The list of rules which were added.
+        """
+        added = []
+        for name, rule in self.rule_initializer.pop_results():
+            self.initializing_rules.discard(name)
+            if not rule:
+                continue
+            # The rule file may have been changed, and the rule reloaded, or removed while the rule was initializing
+            if rule['rule_key'] not in self.rule_hashes or self.rules.get_by_key(rule['rule_key']) is not None:
+                continue
+            try:
+                self.rules.add(rule)
+            except EAException as e:
+                # A new file with the same name was loaded while the rule was initializing
+                self.handle_error('Could not load rule %s: %s' % (rule['rule_key'], e), {'rule': name})
+                continue
+            elastalert_logger.info('Initialized rule %s' % (name))
+            added.append(rule)
+        return added
+
+    def run_initialized_rules(self, timeout=0):
+        """ Runs each rule as soon as it finishes initializing, for up to timeout seconds. """
+        deadline = time.time() + timeout
+        while True:
+            next_run = datetime.datetime.utcnow() + self.run_every
+            for rule in self.add_initialized_rules():
+                self.run_scheduled_rule(rule, next_run, self.rule_init_starttime)
+            remaining = deadline - time.time()
+            if not self.initializing_rules or remaining <= 0:
+                return
+            self.rule_initializer.wait_for_results(remaining)
+
     @staticmethod
     def modify_rule_for_ES5(new_rule):
         # Get ES version per rule
@@ -966,7 +1138,12 @@ class ElastAlerter():
     def load_rule_changes(self):
         ''' Using the modification times of rule config files, syncs the running rules
         to match the files in rules_folder by removing, adding or reloading rules. '''
-        new_rule_hashes = get_rule_hashes(self.conf, self.args.rule)
+        if self.rule_watcher:
+            new_rule_hashes = self.rule_watcher.get_rule_hashes()
+        else:
+            new_rule_hashes = get_rule_hashes(self.conf, self.args.rule)
+        if new_rule_hashes is self.rule_hashes:
+            return
 
         # Check each current rule for changes
         for rule_key, hash_value in self.rule_hashes.iteritems():
@@ -977,9 +1154,9 @@ class ElastAlerter():
                         key=rule_key
                     )
                 )
-                self.rules = [
-                    rule for rule in self.rules if rule['rule_key'] != rule_key
-                ]
+                removed = self.rules.remove_key(rule_key)
+                if removed and self.metrics:
+                    self.metrics.remove(rule=removed['name'])
                 continue
             if hash_value != new_rule_hashes[rule_key]:
                 # Rule file was changed, reload rule
@@ -987,6 +1164,11 @@ class ElastAlerter():
                     new_rule = load_rule_configuration(
                         rule_key, self.conf, use_rule=self.args.rule
                     )
+                    # The rule may have been renamed to the name of another file's rule
+                    for registry in (self.rules, self.disabled_rules):
+                        existing = registry.get(new_rule['name'])
+                        if existing is not None and existing.get('rule_key') != rule_key:
+                            raise EAException("A rule with the name %s already exists" % (new_rule['name']))
                 except EAException as e:
                     message = 'Could not load rule %s: %s' % (rule_key, e)
                     self.handle_error(message)                
@@ -994,17 +1176,15 @@ class ElastAlerter():
                 elastalert_logger.info("Reloading configuration for rule %s" % (rule_key))
 
                 # Re-enable if rule had been disabled
-                for disabled_rule in self.disabled_rules:
-                    if disabled_rule['name'] == new_rule['name']:
-                        self.rules.append(disabled_rule)
-                        self.disabled_rules.remove(disabled_rule)
-                        break
+                disabled_rule = self.disabled_rules.remove(new_rule)
+                if disabled_rule:
+                    self.rules.add(disabled_rule)
 
                 # Initialize the rule that matches rule_key
                 new_rule = self.init_rule(new_rule, False)
-                self.rules = [rule for rule in self.rules if rule['rule_key'] != rule_key]
+                self.rules.remove_key(rule_key)
                 if new_rule:
-                    self.rules.append(new_rule)
+                    self.rules.add(new_rule)
 
         # Load new rules
         if not self.args.rule:
@@ -1013,7 +1193,7 @@ class ElastAlerter():
                     new_rule = load_rule_configuration(
                         rule_key, self.conf, use_rule=self.args.rule
                     )
-                    if new_rule['name'] in [rule['name'] for rule in self.rules]:
+                    if self.rules.get(new_rule['name']) is not None:
                         raise EAException("A rule with the name %s already exists" % (new_rule['name']))
                 except EAException as e:
                     self.handle_error('Could not load rule %s: %s' % (rule_key, e))
@@ -1021,7 +1201,7 @@ class ElastAlerter():
                     continue
                 if self.init_rule(new_rule):
                     elastalert_logger.info('Loaded new rule %s' % (rule_key))
-                    self.rules.append(new_rule)
+                    self.rules.add(new_rule)
 
         self.rule_hashes = new_rule_hashes
 
@@ -1036,11 +1216,17 @@ class ElastAlerter():
                 except (TypeError, ValueError):
                     self.handle_error("%s is not a valid ISO8601 timestamp (YYYY-MM-DDTHH:MM:SS+XX:00)" % (self.starttime))
                     exit(1)
+        self.rule_init_starttime = self.starttime
         self.wait_until_responsive(timeout=self.args.timeout)
+        self.start_metrics_server()
         self.running = True
         elastalert_logger.info("Starting up")
+        next_run = None
         while self.running:
-            next_run = datetime.datetime.utcnow() + self.run_every
+            now = datetime.datetime.utcnow()
+            if self.metrics and next_run:
+                self.metrics.observe('elastalert_loop_lag_seconds', max(total_seconds(now - next_run), 0))
+            next_run = now + self.run_every
 
             self.run_all_rules()
 
@@ -1049,15 +1235,39 @@ class ElastAlerter():
                 endtime = ts_to_dt(self.args.end)
 
                 if next_run.replace(tzinfo=dateutil.tz.tzutc()) > endtime:
+                    self.stop_rule_initializer()
+                    self.stop_rule_watcher()
+                    self.stop_alert_dispatcher()
                     exit(0)
 
             if next_run < datetime.datetime.utcnow():
                 continue
 
-            # Wait before querying again
+            # Wait before querying again, running rules as they finish initializing meanwhile
             sleep_duration = total_seconds(next_run - datetime.datetime.utcnow())
+            if self.initializing_rules:
+                self.run_initialized_rules(sleep_duration)
+                sleep_duration = total_seconds(next_run - datetime.datetime.utcnow())
+                if sleep_duration <= 0:
+                    continue
             self.sleep_for(sleep_duration)
 
+        self.stop_rule_initializer()
+        self.stop_rule_watcher()
+        self.stop_alert_dispatcher()
+        self.stop_metrics_server()
+
+    def start_metrics_server(self):
+        """ Starts serving metrics for Prometheus to scrape, if metrics_port is set. """
+        if self.metrics and not self.metrics_server:
+            self.metrics_server = MetricsServer(self.metrics, self.conf['metrics_port'], self.conf.get('metrics_host', '0.0.0.0'))
+            self.metrics_server.start()
+
+    def stop_metrics_server(self):
+        if self.metrics_server:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
     def wait_until_responsive(self, timeout, clock=timeit.default_timer):
         """Wait until ElasticSearch becomes responsive (or too much time passes)."""
 
@@ -1099,41 +1309,21 @@ class ElastAlerter():
         next_run = datetime.datetime.utcnow() + self.run_every
 
         for rule in self.rules:
-            # Set endtime based on the rule's delay
-            delay = rule.get('query_delay')
-            if hasattr(self.args, 'end') and self.args.end:
-                endtime = ts_to_dt(self.args.end)
-            elif delay:
-                endtime = ts_now() - delay
-            else:
-                endtime = ts_now()
+            self.run_scheduled_rule(rule, next_run, self.starttime)
 
-            try:
-                num_matches = self.run_rule(rule, endtime, self.starttime)
-            except EAException as e:
-                self.handle_error("Error running rule %s: %s" % (rule['name'], e), {'rule': rule['name']})
-            except Exception as e:
-                self.handle_uncaught_exception(e, rule)
-            else:
-                old_starttime = pretty_ts(rule.get('original_starttime'), rule.get('use_local_time'))
-                elastalert_logger.info("Ran %s from %s to %s: %s query hits (%s already seen), %s matches,"
-                                       " %s alerts sent" % (rule['name'], old_starttime, pretty_ts(endtime, rule.get('use_local_time')),
-                                                            self.num_hits, self.num_dupes, num_matches, self.alerts_sent))
-                self.alerts_sent = 0
-
-                if next_run < datetime.datetime.utcnow():
-                    # We were processing for longer than our refresh interval
-                    # This can happen if --start was specified with a large time period
-                    # or if we are running too slow to process events in real time.
-                    logging.warning(
-                        "Querying from %s to %s took longer than %s!" % (
-                            old_starttime,
-                            pretty_ts(endtime, rule.get('use_local_time')),
-                            self.run_every
-                        )
-                    )
+        # Rules which finished initializing during the run are run straight away
+        if self.initializing_rules:
+            self.run_initialized_rules()
+
+        if self.alert_dispatcher:
+            self.flush_alert_results()
+
+        if self.max_total_state_bytes:
+            self.enforce_total_state_budget()
 
-            self.remove_old_events(rule)
+        if self.state_snapshot_dir:
+            if not self.last_state_snapshot or ts_now() - self.last_state_snapshot >= self.state_snapshot_interval:
+                self.write_state_snapshots()
 
         # Only force starttime once
         self.starttime = None
@@ -1141,9 +1331,53 @@ class ElastAlerter():
         if not self.args.pin_rules:
             self.load_rule_changes()
 
+    def run_scheduled_rule(self, rule, next_run, starttime=None):
+        """ Runs a rule up to the present, or to its query_delay, and logs the result.
+
+        :param next_run: The time of the next run, which is warned about if this rule runs past it.
+        :param starttime: A time to run the rule from, instead of where it last ran.
+        """
+        # Set endtime based on the rule's delay
+        delay = rule.get('query_delay')
+        if hasattr(self.args, 'end') and self.args.end:
+            endtime = ts_to_dt(self.args.end)
+        elif delay:
+            endtime = ts_now() - delay
+        else:
+            endtime = ts_now()
+
+        try:
+            num_matches = self.run_rule(rule, endtime, starttime)
+        except EAException as e:
+            self.handle_error("Error running rule %s: %s" % (rule['name'], e), {'rule': rule['name']})
+        except Exception as e:
+            self.handle_uncaught_exception(e, rule)
+        else:
+            old_starttime = pretty_ts(rule.get('original_starttime'), rule.get('use_local_time'))
+            elastalert_logger.info("Ran %s from %s to %s: %s query hits (%s already seen), %s matches,"
+                                   " %s alerts sent" % (rule['name'], old_starttime, pretty_ts(endtime, rule.get('use_local_time')),
+                                                        self.num_hits, self.num_dupes, num_matches, self.alerts_sent))
+            self.alerts_sent = 0
+
+            if next_run < datetime.datetime.utcnow():
+                # We were processing for longer than our refresh interval
+                # This can happen if --start was specified with a large time period
+                # or if we are running too slow to process events in real time.
+                logging.warning(
+                    "Querying from %s to %s took longer than %s!" % (
+                        old_starttime,
+                        pretty_ts(endtime, rule.get('use_local_time')),
+                        self.run_every
+                    )
+                )
+
+        self.remove_old_events(rule)
+
     def stop(self):
         """ Stop an ElastAlert runner that's been started """
         self.running = False
+        self.stop_rule_initializer()
+        self.stop_rule_watcher()
 
     def sleep_for(self, duration):
         """ Sleep for a set duration """
@@ -1336,55 +1570,225 @@ class ElastAlerter():
         # run_enhancements_first is set or
         # retried==True, which means this is a retry of a failed alert
         if not rule.get('run_enhancements_first') and not retried:
-            for enhancement in rule['match_enhancements']:
+            matches = self.run_enhancements(rule, matches)
+            if not matches:
+                return None
+
+        # Don't send real alerts in debug mode
+        if self.debug:
+            alerter = DebugAlerter(rule)
+            alerter.alert(matches)
+            return None
+
+        # Only pay for queueing the alert if it is sent by the dispatcher's workers
+        if self.alert_dispatcher:
+            self.alert_dispatcher.submit(rule['name'], self.dispatch_alert, matches, rule, alert_time)
+            return None
+
+        outcome = self.run_alerters(matches, rule, alert_time)
+        self.alerts_sent += outcome.alerts_sent
+
+        # Write the alert(s) to ES
+        agg_id = None
+        for match in matches:
+            alert_body = self.get_alert_body(match, rule, outcome.alert_sent, alert_time, outcome.alert_exception,
+                                             outcome.storm_control)
+            # Set all matches to aggregate together
+            if agg_id:
+                alert_body['aggregate_id'] = agg_id
+            res = self.writeback('elastalert', alert_body)
+            if res and not agg_id:
+                agg_id = res['_id']
+
+    def run_enhancements(self, rule, matches):
+        """ Runs each of a rule's match enhancements on a list of matches. Enhancements which define
+        process_batch are given every match at once, others are given one match at a time.
+
+        :return: The matches which were not dropped by an enhancement.
+        """
+        for enhancement in rule['match_enhancements']:
+            if hasattr(enhancement, 'process_batch'):
+                try:
+                    matches = enhancement.process_batch(matches)
+                except EAException as e:
+                    self.handle_error("Error running match enhancement: %s" % (e), {'rule': rule['name']})
+            else:
                 valid_matches = []
                 for match in matches:
                     try:
                         enhancement.process(match)
                         valid_matches.append(match)
-                    except DropMatchException as e:
+                    except DropMatchException:
                         pass
                     except EAException as e:
                         self.handle_error("Error running match enhancement: %s" % (e), {'rule': rule['name']})
                 matches = valid_matches
-                if not matches:
-                    return None
-
-        # Don't send real alerts in debug mode
-        if self.debug:
-            alerter = DebugAlerter(rule)
-            alerter.alert(matches)
-            return None
+            if not matches:
+                break
+        return matches
 
-        # Run the alerts
-        alert_sent = False
-        alert_exception = None
+    def get_enhancement_cache_stats(self, rule):
+        """ Returns the statistics of the caches used by a rule's enhancements, such as their hit rates,
+        keyed by enhancement class and method name. """
+        stats = {}
+        for enhancement in rule['match_enhancements']:
+            if isinstance(enhancement, BaseEnhancement):
+                for name, cache_stats in enhancement.get_cache_stats().iteritems():
+                    stats['%s.%s' % (enhancement.__class__.__name__, name)] = cache_stats
+        return stats
+
+    def run_alerters(self, matches, rule, alert_time, outcome=None):
+        """ Runs each of a rule's alerters on a list of matches. With an alert dispatcher, failing
+        alerters are retried and each type of alerter is limited to its alerter_concurrency. With
+        storm control, alerts are also rate limited, and coalesced, by destination. Alerts which
+        storm control holds back are sent later by another worker, which completes the outcome if
+        they were the last to be sent. It runs on the dispatcher's workers, so it must not change
+        the rules or the ElastAlerter's counts.
+
+        :param outcome: The AlertOutcome to record the results in, or None to create one.
+        :return: The AlertOutcome, which is only complete if no alert was held back.
+        """
+        if outcome is None:
+            outcome = AlertOutcome()
         # Alert.pipeline is a single object shared between every alerter
         # This allows alerters to pass objects and data between themselves
         alert_pipeline = {"alert_time": alert_time}
         for alert in rule['alert']:
             alert.pipeline = alert_pipeline
+            outcome.start()
             try:
-                alert.alert(matches)
+                if self.storm_control:
+                    alerter_type = alert.get_info()['type']
+                    # The alert may be sent after the loop moves on, so each function is bound to this alerter
+                    held = self.storm_control.send(
+                        alerter_type, alert, matches,
+                        lambda alerter, matches, alerter_type=alerter_type, pipeline=alert_pipeline:
+                            self.send_held_alert(alerter_type, alerter, matches, pipeline),
+                        lambda alerter, alerts, alerter_type=alerter_type, pipeline=alert_pipeline:
+                            self.send_held_alert(alerter_type, alerter, alerts, pipeline, coalesced=True),
+                        lambda error, decision, alert=alert: self.finish_alerter(rule, alert, outcome, error, decision))
+                    if held:
+                        continue
+                elif self.alert_dispatcher:
+                    self.alert_dispatcher.call(alert.get_info()['type'], alert.alert, matches)
+                else:
+                    alert.alert(matches)
             except EAException as e:
-                self.handle_error('Error while running alert %s: %s' % (alert.get_info()['type'], e), {'rule': rule['name']})
-                alert_exception = str(e)
+                self.finish_alerter(rule, alert, outcome, e)
             else:
-                self.alerts_sent += 1
-                alert_sent = True
+                self.finish_alerter(rule, alert, outcome)
+        outcome.done()
+        return outcome
+
+    def send_held_alert(self, alerter_type, alerter, matches, pipeline, coalesced=False):
+        """ Sends an alert which storm control held back, or several coalesced alerts, on an alert dispatcher worker.
+        The alerter's pipeline is restored first, as the rule may have sent other alerts since. """
+        alerter.pipeline = pipeline
+        if coalesced:
+            self.alert_dispatcher.call(alerter_type, alerter.alert_coalesced, matches)
+        else:
+            self.alert_dispatcher.call(alerter_type, alerter.alert, matches)
 
-        # Write the alert(s) to ES
-        agg_id = None
-        for match in matches:
-            alert_body = self.get_alert_body(match, rule, alert_sent, alert_time, alert_exception)
-            # Set all matches to aggregate together
-            if agg_id:
+    def finish_alerter(self, rule, alerter, outcome, error=None, decision=None):
+        """ Records the result of sending an alert with one of a rule's alerters in its AlertOutcome. Errors other
+        than EAException must be passed while they are being handled, so that their traceback can be logged.
+
+        :param decision: A dictionary describing how storm control held the alert back, if it did.
+        """
+        if error is None:
+            if self.metrics:
+                self.metrics.inc('elastalert_alerts_sent_total', rule=rule['name'], alerter=alerter.get_info()['type'])
+        else:
+            if isinstance(error, EAException):
+                self.handle_error('Error while running alert %s: %s' % (alerter.get_info()['type'], error), {'rule': rule['name']})
+            else:
+                self.report_uncaught_exception(error, rule)
+                outcome.failed = True
+            if self.metrics:
+                self.metrics.inc('elastalert_alerts_failed_total', rule=rule['name'], alerter=alerter.get_info()['type'])
+        if decision:
+            decision['alerter'] = alerter.get_info()['type']
+        outcome.finish(error, decision)
+
+    def dispatch_alert(self, matches, rule, alert_time):
+        """ Sends an alert on an alert dispatcher worker. Once every alerter has finished, which may be later
+        if storm control held an alert back, the result, with the alert bodies, is kept to be applied on the
+        main thread by flush_alert_results, as workers must not change the running rules. """
+        try:
+            self.run_alerters(matches, rule, alert_time,
+                              AlertOutcome(lambda outcome: self.add_alert_result(matches, rule, alert_time, outcome)))
+        except Exception as e:
+            self.report_uncaught_exception(e, rule)
+            self.alert_dispatcher.add_result({'rule': rule, 'alerts_sent': 0, 'bodies': [], 'failed': True})
+
+    def add_alert_result(self, matches, rule, alert_time, outcome):
+        """ Keeps the result of a dispatched alert, with its alert bodies, for flush_alert_results. """
+        result = {'rule': rule, 'alerts_sent': outcome.alerts_sent, 'bodies': [], 'failed': outcome.failed}
+        # The first alert's ID is chosen here, as the others refer to it before it is written
+        agg_id = uuid.uuid4().hex if len(matches) > 1 else None
+        for i, match in enumerate(matches):
+            alert_body = self.get_alert_body(match, rule, outcome.alert_sent, alert_time, outcome.alert_exception,
+                                             outcome.storm_control)
+            if i:
                 alert_body['aggregate_id'] = agg_id
-            res = self.writeback('elastalert', alert_body)
-            if res and not agg_id:
-                agg_id = res['_id']
+                result['bodies'].append((alert_body, None))
+            else:
+                result['bodies'].append((alert_body, agg_id))
+        self.alert_dispatcher.add_result(result)
+
+    def flush_alert_results(self):
+        """ Applies the results of alerts sent by the alert dispatcher: logs the number of alerts sent for each
+        rule, disables rules whose alerts raised an uncaught exception, and writes the alert bodies to
+        Elasticsearch in a single bulk request. """
+        alerts_sent = {}
+        actions = []
+        for result in self.alert_dispatcher.pop_results():
+            rule = result['rule']
+            # The rule may have been reloaded or disabled since the alert was queued
+            if result['failed'] and self.disable_rules_on_error and rule in self.rules:
+                self.disable_rule(rule)
+            if result['alerts_sent']:
+                alerts_sent[rule['name']] = alerts_sent.get(rule['name'], 0) + result['alerts_sent']
+            for body, _id in result['bodies']:
+                action = {'_index': self.get_writeback_index('elastalert'), '_type': 'elastalert'}
+                if _id:
+                    action['_id'] = _id
+                actions.append({'index': action})
+                actions.append(self.get_writeback_body(body))
+        for name, count in sorted(alerts_sent.items()):
+            elastalert_logger.info('Sent %s alerts for rule %s' % (count, name))
+        if not actions or self.debug:
+            return
+        writeback_start = timeit.default_timer()
+        try:
+            res = self.writeback_es.bulk(body=actions)
+            if self.metrics:
+                self.metrics.observe('elastalert_writeback_seconds', timeit.default_timer() - writeback_start, doc_type='elastalert')
+            if res.get('errors'):
+                failed = [item for item in res['items'] if 'error' in item.get('index', {})]
+                logging.error("Error writing %d alerts to Elasticsearch: %s" % (len(failed), failed[0]['index']['error']))
+        except ElasticsearchException as e:
+            logging.exception("Error writing alert info to Elasticsearch: %s" % (e))
 
-    def get_alert_body(self, match, rule, alert_sent, alert_time, alert_exception=None):
+    def stop_rule_initializer(self):
+        """ Stops initializing rules, dropping those which have not started, and waits for the rest to finish. """
+        if self.rule_initializer:
+            self.rule_initializer.stop(cancel=True)
+
+    def stop_rule_watcher(self):
+        """ Stops checking rule files for changes in the background. """
+        if self.rule_watcher:
+            self.rule_watcher.stop()
+
+    def stop_alert_dispatcher(self):
+        """ Waits for queued alerts, and those held back by storm control, to be sent and writes back their results. """
+        if self.storm_control:
+            self.storm_control.stop()
+        if self.alert_dispatcher:
+            self.alert_dispatcher.stop()
+            self.flush_alert_results()
+
+    def get_alert_body(self, match, rule, alert_sent, alert_time, alert_exception=None, storm_control=None):
         body = {
             'match_body': match,
             'rule_name': rule['name'],
@@ -1402,13 +1806,19 @@ class ElastAlerter():
         # If the alert failed to send, record the exception
         if not alert_sent:
             body['alert_exception'] = alert_exception
+
+        # Record alerts which were rate limited or coalesced with others
+        if storm_control:
+            body['storm_control'] = storm_control
         return body
 
-    def writeback(self, doc_type, body):
+    def get_writeback_index(self, doc_type):
         writeback_index = self.writeback_index
         if(self.is_atleastsix()):
             writeback_index = self.get_six_index(doc_type)
+        return writeback_index
 
+    def get_writeback_body(self, body):
         # ES 2.0 - 2.3 does not support dots in field names.
         if self.replace_dots_in_field_names:
             writeback_body = replace_dots_in_field_names(body)
@@ -1420,16 +1830,24 @@ class ElastAlerter():
             if isinstance(writeback_body[key], datetime.datetime):
                 writeback_body[key] = dt_to_ts(writeback_body[key])
 
+        if '@timestamp' not in writeback_body:
+            writeback_body['@timestamp'] = dt_to_ts(ts_now())
+        return writeback_body
+
+    def writeback(self, doc_type, body):
+        writeback_index = self.get_writeback_index(doc_type)
+        writeback_body = self.get_writeback_body(body)
+
         if self.debug:
             elastalert_logger.info("Skipping writing to ES: %s" % (writeback_body))
             return None
 
-        if '@timestamp' not in writeback_body:
-            writeback_body['@timestamp'] = dt_to_ts(ts_now())
-
+        writeback_start = timeit.default_timer()
         try:
             res = self.writeback_es.index(index=writeback_index,
                                           doc_type=doc_type, body=body)
+            if self.metrics:
+                self.metrics.observe('elastalert_writeback_seconds', timeit.default_timer() - writeback_start, doc_type=doc_type)
             return res
         except ElasticsearchException as e:
             logging.exception("Error writing alert info to Elasticsearch: %s" % (e))
@@ -1476,10 +1894,8 @@ class ElastAlerter():
                 continue
 
             # Find original rule
-            for rule in self.rules:
-                if rule['name'] == rule_name:
-                    break
-            else:
+            rule = self.rules.get(rule_name)
+            if rule is None:
                 # Original rule is missing, keep alert for later if rule reappears
                 continue
 
@@ -1740,15 +2156,128 @@ class ElastAlerter():
 
     def handle_uncaught_exception(self, exception, rule):
         """ Disables a rule and sends a notification. """
+        self.report_uncaught_exception(exception, rule)
+        if self.disable_rules_on_error:
+            self.disable_rule(rule)
+
+    def report_uncaught_exception(self, exception, rule):
+        """ Logs and writes back an uncaught exception raised by a rule, and sends a notification. It must be
+        called while the exception is being handled. As it does not change the rules, workers may call it. """
         logging.error(traceback.format_exc())
         self.handle_error('Uncaught exception running rule %s: %s' % (rule['name'], exception), {'rule': rule['name']})
-        if self.disable_rules_on_error:
-            self.rules = [running_rule for running_rule in self.rules if running_rule['name'] != rule['name']]
-            self.disabled_rules.append(rule)
-            elastalert_logger.info('Rule %s disabled', rule['name'])
         if self.notify_email:
             self.send_notification_email(exception=exception, rule=rule)
 
+    def disable_rule(self, rule):
+        """ Stops running a rule until ElastAlert restarts or the rule file is modified. """
+        self.rules.remove(rule)
+        self.disabled_rules.add(rule)
+        elastalert_logger.info('Rule %s disabled', rule['name'])
+
+    def get_rule_state_size(self, rule):
+        """ Returns an estimate, in bytes, of the memory used by the state a rule keeps between runs. """
+        return rule['type'].get_state_size() + approximate_size([rule['processed_hits'], rule['agg_matches']])
+
+    def enforce_state_budget(self, rule, budget):
+        """ Brings a rule's state under budget by forgetting its least recently seen query keys.
+        If state_budget_action is disable, or forgetting keys is not enough, the rule is disabled instead.
+        Either way, an error is written to Elasticsearch and a notification email is sent.
+
+        :param rule: The rule configuration, with state_size set by run_rule.
+        :param budget: The maximum state size, in bytes.
+        """
+        state_size = rule['state_size']
+        forgotten = 0
+        if rule.get('state_budget_action', 'evict') == 'evict':
+            while state_size > budget:
+                # Forget keys in proportion to how far over budget the rule is
+                key_count = rule['type'].get_key_count()
+                count = max(1, int(key_count * float(state_size - budget) / state_size))
+                evicted = rule['type'].forget_oldest_keys(count)
+                if not evicted:
+                    break
+                forgotten += evicted
+                state_size = self.get_rule_state_size(rule)
+
+        message = 'Rule %s exceeded its state budget of %d bytes with an estimated %d bytes' % (rule['name'], budget, rule['state_size'])
+        if state_size <= budget:
+            message += ', forgot %d query keys' % (forgotten)
+        else:
+            self.disable_rule(rule)
+            message += ', rule disabled'
+        rule['state_size'] = state_size
+        self.handle_error(message, {'rule': rule['name'], 'state_size': state_size, 'forgotten_keys': forgotten})
+        if self.notify_email:
+            self.send_notification_email(text=message, rule=rule, subject='ElastAlert state budget exceeded - %s' % (rule['name']))
+
+    def get_state_snapshot_path(self, rule):
+        """ Returns the path of the file in state_snapshot_dir holding a rule's state. """
+        return os.path.join(self.state_snapshot_dir, '%s.state' % (hashlib.sha1(rule['name'].encode('utf-8')).hexdigest()))
+
+    def write_state_snapshots(self):
+        """ Writes the state of each rule which has run to state_snapshot_dir, to be restored by load_state_snapshot. """
+        for rule in self.rules:
+            if 'previous_endtime' not in rule:
+                continue
+            snapshot = {'version': STATE_SNAPSHOT_VERSION,
+                        'rule_name': rule['name'],
+                        'rule_type': rule['type'].__class__.__name__,
+                        'endtime': rule['previous_endtime'],
+                        'processed_hits': rule['processed_hits'],
+                        'state': rule['type'].get_state()}
+            path = self.get_state_snapshot_path(rule)
+            try:
+                # Write to a temporary file first so that a crash never leaves a partial snapshot
+                with open(path + '.tmp', 'wb') as snapshot_file:
+                    snapshot_file.write(zlib.compress(pickle.dumps(snapshot, pickle.HIGHEST_PROTOCOL)))
+                os.rename(path + '.tmp', path)
+            except (IOError, OSError, pickle.PicklingError) as e:
+                self.handle_error('Error writing state snapshot for rule %s: %s' % (rule['name'], e), {'rule': rule['name']})
+        self.last_state_snapshot = ts_now()
+
+    def load_state_snapshot(self, rule):
+        """ Restores a rule's state from state_snapshot_dir. Snapshots from a different rule type, from a different
+        format version, or older than old_query_limit are ignored.
+
+        :return: True if the state was restored.
+        """
+        path = self.get_state_snapshot_path(rule)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'rb') as snapshot_file:
+                snapshot = pickle.loads(zlib.decompress(snapshot_file.read()))
+        except Exception as e:
+            # A truncated or corrupt file can raise almost anything while unpickling
+            elastalert_logger.warning('Could not read state snapshot for rule %s: %s' % (rule['name'], e))
+            return False
+
+        if (snapshot.get('version') != STATE_SNAPSHOT_VERSION or snapshot.get('rule_name') != rule['name'] or
+                snapshot.get('rule_type') != rule['type'].__class__.__name__):
+            return False
+        if ts_now() - snapshot['endtime'] > self.old_query_limit:
+            return False
+
+        rule['type'].set_state(snapshot['state'])
+        rule['processed_hits'] = snapshot['processed_hits']
+        elastalert_logger.info('Restored state for rule %s as of %s' % (rule['name'],
+                                                                        pretty_ts(snapshot['endtime'], rule.get('use_local_time'))))
+        return True
+
+    def enforce_total_state_budget(self):
+        """ If the combined state of all rules is over max_total_state_bytes, enforces a smaller budget
+        on the rules with the largest state, largest first, until the total is under. """
+        total = sum(rule.get('state_size', 0) for rule in self.rules)
+        for rule in sorted(self.rules, key=lambda rule: rule.get('state_size', 0), reverse=True):
+            if total <= self.max_total_state_bytes:
+                break
+            state_size = rule.get('state_size', 0)
+            self.enforce_state_budget(rule, max(state_size - (total - self.max_total_state_bytes), 0))
+            if rule in self.disabled_rules:
+                total -= state_size
+            else:
+                total -= state_size - rule['state_size']
+
     def send_notification_email(self, text='', exception=None, rule=None, subject=None, rule_file=None):
         email_body = text
         rule_name = None
@@ -1782,8 +2311,12 @@ class ElastAlerter():
         email['Reply-To'] = self.conf.get('email_reply_to', email['To'])
 
         try:
-            smtp = SMTP(self.smtp_host)
-            smtp.sendmail(self.from_addr, recipients, email.as_string())
+            if self.conf.get('smtp_keepalive'):
+                smtp_pool.sendmail(('notification', self.smtp_host), lambda: SMTP(self.smtp_host),
+                                   self.conf.get('smtp_keepalive_timeout', 60), self.from_addr, recipients, email.as_string())
+            else:
+                smtp = SMTP(self.smtp_host)
+                smtp.sendmail(self.from_addr, recipients, email.as_string())
         except (SMTPException, error) as e:
             self.handle_error('Error connecting to SMTP host: %s' % (e), {'email_body': email_body})
 
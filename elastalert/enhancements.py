@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
+import collections
+import functools
+import time
+
+from util import lookup_es_key
 
 
 class BaseEnhancement(object):
     """ Enhancements take a match dictionary object and modify it in some way to
     enhance an alert. These are specified in each rule under the match_enhancements option.
-    Generally, the key value pairs in the match module will be contained in the alert body. """
+    Generally, the key value pairs in the match module will be contained in the alert body.
+
+    An enhancement may also define process_batch(matches), which is called with every match
+    of an alert at once instead of calling process for each one. It returns the list of matches
+    to keep, leaving out any which should be dropped. """
 
     def __init__(self, rule):
         self.rule = rule
@@ -13,7 +22,81 @@ class BaseEnhancement(object):
         """ Modify the contents of match, a dictionary, in some way """
         raise NotImplementedError()
 
+    def get_cache_stats(self):
+        """ Returns a dictionary of statistics for each cache used by methods decorated with cached_by_fields. """
+        caches = getattr(self, 'enhancement_caches', {})
+        return dict((name, cache.get_stats()) for name, cache in caches.iteritems())
+
 
 class DropMatchException(Exception):
     """ ElastAlert will drop a match if this exception type is raised by an enhancement """
-    pass
\ No newline at end of file
+    pass
+
+
+class EnhancementCache(object):
+    """ A least recently used cache whose entries expire after ttl seconds.
+
+    :param max_size: The maximum number of entries. The least recently used entry is removed to make room.
+    :param ttl: The number of seconds an entry is used for, or None for entries to never expire.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns a tuple of whether key was found, and its value. """
+        if key in self.entries:
+            value, stored = self.entries.pop(key)
+            if self.ttl is None or time.time() - stored < self.ttl:
+                self.entries[key] = (value, stored)
+                self.hits += 1
+                return True, value
+        self.misses += 1
+        return False, None
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.time())
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'size': len(self.entries)}
+
+
+def cached_by_fields(fields, max_size=1000, ttl=None):
+    """ Decorates an enhancement method taking a match, such as a lookup in an external service, so that its
+    result is cached, keyed by the values of the given fields in the match. Each enhancement instance has its
+    own cache, whose statistics are returned by BaseEnhancement.get_cache_stats.
+
+    :param fields: A list of field names, which may use dots to refer to nested fields.
+    :param max_size: The maximum number of results to cache.
+    :param ttl: The number of seconds a result is cached for, or None to cache until it is least recently used.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, match):
+            caches = self.__dict__.setdefault('enhancement_caches', {})
+            if func.__name__ not in caches:
+                caches[func.__name__] = EnhancementCache(max_size, ttl)
+            cache = caches[func.__name__]
+            key = tuple(lookup_es_key(match, field) for field in fields)
+            try:
+                found, value = cache.get(key)
+            except TypeError:
+                # Values such as lists and dictionaries cannot be used as a key
+                return func(self, match)
+            if not found:
+                value = func(self, match)
+                cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
@@ -1,8 +1,41 @@
 import enum
 import json
+import threading
 import xml.etree.ElementTree
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Used when connections are not given a timeout, in seconds, or a tuple of the connect and read timeouts
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+# Sessions shared by every connection to the same host, see get_session
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(protocol, host, port, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+	""" Returns a requests Session shared by connections to the same host, which pools connections
+	and keeps them alive between requests.
+
+	:param retries: The number of times to retry a request which fails to connect or, unless it is a POST,
+	fails with a 502, 503 or 504 status.
+	:param backoff: The backoff factor of the delay between retries, in seconds.
+	"""
+	key = (protocol, host, port, retries, backoff)
+	with sessions_lock:
+		if key not in sessions:
+			session = requests.Session()
+			adapter = HTTPAdapter(max_retries=Retry(
+				total=retries, backoff_factor=backoff,
+				status_forcelist=[502, 503, 504], raise_on_status=False
+			))
+			session.mount("{protocol}://".format(protocol=protocol), adapter)
+			sessions[key] = session
+		return sessions[key]
 
 
 def parse_uri(uri):
@@ -64,11 +97,19 @@ class HttpConnection():
 	protocol = "http"
 	default_port = 80
 
-	def __init__(self, url, port=None):
+	def __init__(
+		self, url, port=None, session=None, timeout=DEFAULT_TIMEOUT,
+		retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF
+	):
 		self.request = None
 		self.url = url
 		self.port = port or self.default_port
 		self.uri = None
+		self.session = session or get_session(
+			self.protocol, self.url, self.port, retries, backoff
+		)
+		self.timeout = timeout
+		self._response = None
 
 	def _clean_param(self, param):
 		if type(param) is list or type(param) is set:
@@ -81,7 +122,10 @@ class HttpConnection():
 		params = {k: self._clean_param(v) for k, v in params.items()}
 		self.set_uri(path)
 
-		self.request = requests.get(self.uri, params=params, headers=headers)
+		self.request = self.session.get(
+			self.uri, params=params, headers=headers, timeout=self.timeout,
+			stream=True
+		)
 		return self
 
 	def upload(self, path, data=None):
@@ -89,7 +133,10 @@ class HttpConnection():
 		headers['Content-Type'] = "application/octet-stream"
 		self.set_uri(path)
 
-		self.request = requests.post(self.uri, data=data, headers=headers)
+		self.request = self.session.post(
+			self.uri, data=data, headers=headers, timeout=self.timeout,
+			stream=True
+		)
 		return self
 
 	def post(self, path, data=None, headers=None):
@@ -98,22 +145,29 @@ class HttpConnection():
 			"Content-Type" not in headers else headers['Content-Type']
 		self.set_uri(path)
 
-		self.request = requests.post(self.uri, data=data, headers=headers)
+		self.request = self.session.post(
+			self.uri, data=data, headers=headers, timeout=self.timeout,
+			stream=True
+		)
 		return self
 
 	def delete(self, path, data=None, headers=None):
 		headers = headers or {}
 		self.set_uri(path)
 
-		self.request = requests.delete(self.uri, data=data, headers=headers)
+		self.request = self.session.delete(
+			self.uri, data=data, headers=headers, timeout=self.timeout,
+			stream=True
+		)
 		return self
 
 	def put(self, path, json=None, data=None, headers=None):
 		headers = headers or {}
 		self.set_uri(path)
 
-		self.request = requests.put(
-			self.uri, data=data, json=json, headers=headers
+		self.request = self.session.put(
+			self.uri, data=data, json=json, headers=headers,
+			timeout=self.timeout, stream=True
 		)
 		return self
 
@@ -124,7 +178,10 @@ class HttpConnection():
 
 	@property
 	def response(self):
-		return HttpResponse(self.request, self.uri)
+		# The body of the response can only be read once
+		if self._response is None or self._response.response is not self.request:
+			self._response = HttpResponse(self.request, self.uri)
+		return self._response
 
 
 class HttpsConnection(HttpConnection):
@@ -133,22 +190,39 @@ class HttpsConnection(HttpConnection):
 
 
 class HttpResponse():
+	""" The response to a request, whose body is read from the connection when it is first decoded.
+	The body can be decoded either as JSON, or with the other decode methods, but not both. """
 
 	def __init__(self, response, uri):
 		self.response = response
 		self.status = response.status_code
 		self.uri = uri
+		self._json = None
+		self._json_decoded = False
 
 		if self.status != 200:
 			raise HttpConnectionError(
 				self.decode_text(), uri=self.uri, status_code=self.status
 			)
 
+	@property
+	def headers(self):
+		return self.response.headers
+
 	def decode_text(self):
 		return self.response.text
 
 	def decode_json(self):
-		return self.response.json()
+		# JSON is decoded straight from the connection, decompressing it if it was gzipped, without the
+		# response also keeping the body as bytes and as text
+		if not self._json_decoded:
+			self.response.raw.decode_content = True
+			try:
+				self._json = json.load(self.response.raw)
+			finally:
+				self.response.close()
+			self._json_decoded = True
+		return self._json
 
 	def decode_xml(self):
 		return xml.etree.ElementTree.fromstring(self.response.text)
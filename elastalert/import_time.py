@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Reports how long importing modules takes, in the same format as python -X importtime, which Python 2.7 lacks.
+Imports which take longer than a budget make it exit with an error, so that slow imports can be caught in CI.
+
+Usage: elastalert-import-time [--budget SECONDS] [--min-time SECONDS] [module ...]
+"""
+from __future__ import print_function
+
+import __builtin__
+import argparse
+import sys
+import timeit
+
+
+class ImportTimer(object):
+    """ Wraps the __import__ builtin to measure the time taken by each import which loads new modules.
+    Like python -X importtime, each import is recorded after the imports it caused, with its own time,
+    its cumulative time and its depth. """
+
+    def __init__(self):
+        self.records = []
+        self.stack = []
+        self.original_import = None
+
+    def __enter__(self):
+        self.original_import = __builtin__.__import__
+        __builtin__.__import__ = self.timed_import
+        return self
+
+    def __exit__(self, *args):
+        __builtin__.__import__ = self.original_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        module_count = len(sys.modules)
+        self.stack.append(0.0)
+        start = timeit.default_timer()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = timeit.default_timer() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            # Imports of modules which were already loaded are not interesting
+            if len(sys.modules) > module_count:
+                # from . import x has no module name
+                label = name or ', '.join(fromlist or [])
+                self.records.append((len(self.stack), label, elapsed - nested, elapsed))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Report how long importing ElastAlert modules takes')
+    parser.add_argument('modules', nargs='*', default=['elastalert.elastalert'], help='Modules to import '
+                        '(default: elastalert.elastalert)')
+    parser.add_argument('--budget', type=float, help='Exit with an error if importing takes longer than this '
+                        'many seconds')
+    parser.add_argument('--min-time', type=float, default=0, help='Only report imports which took at least this '
+                        'many seconds, in total')
+    args = parser.parse_args(args)
+
+    total = 0.0
+    with ImportTimer() as timer:
+        for module in args.modules:
+            start = timeit.default_timer()
+            __import__(module)
+            total += timeit.default_timer() - start
+
+    print('import time: self [us] | cumulative | imported package', file=sys.stderr)
+    for depth, name, self_time, cumulative in timer.records:
+        if cumulative >= args.min_time:
+            print('import time: %9d | %10d | %s%s' % (self_time * 1e6, cumulative * 1e6, '  ' * depth, name),
+                  file=sys.stderr)
+    print('Importing %s took %.3f seconds' % (', '.join(args.modules), total))
+
+    if args.budget is not None and total > args.budget:
+        print('Imports took longer than the budget of %.3f seconds' % (args.budget), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
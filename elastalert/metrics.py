@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import BaseHTTPServer
+import threading
+
+from util import elastalert_logger
+
+# The upper bounds, in seconds, of the buckets of every histogram
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# The type and help text of each metric, by name
+METRICS = {
+    'elastalert_query_seconds': ('histogram', 'Wall time of queries to Elasticsearch, as seen by ElastAlert'),
+    'elastalert_query_took_seconds': ('histogram', 'Time Elasticsearch reported it took to run queries'),
+    'elastalert_scroll_pages_total': ('counter', 'Pages of hits fetched by scrolling'),
+    'elastalert_hits_total': ('counter', 'Hits returned by queries'),
+    'elastalert_duplicate_hits_total': ('counter', 'Hits which had already been seen and were ignored'),
+    'elastalert_matches_total': ('counter', 'Matches found by rules'),
+    'elastalert_alerts_sent_total': ('counter', 'Alerts sent, by alerter type'),
+    'elastalert_alerts_failed_total': ('counter', 'Alerts which could not be sent, by alerter type'),
+    'elastalert_writeback_seconds': ('histogram', 'Time taken to write documents to the writeback index'),
+    'elastalert_loop_lag_seconds': ('histogram', 'How long after the intended time each run of all rules started'),
+    'elastalert_rule_state_bytes': ('gauge', 'Estimated size of the state a rule keeps between runs'),
+}
+
+
+def escape_label(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, escape_label(value)) for name, value in labels))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metrics(object):
+    """ Counters, gauges and histograms, each series identified by its labels, such as the rule name, rendered in the
+    Prometheus text format. Recording holds a lock only to update a value, and rendering copies the values under the
+    lock before formatting them, so scraping never holds up running rules. Only the metrics in METRICS can be recorded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # The value of each series by metric name and sorted label items. A histogram's value is a list of the count
+        # in each bucket, the count above the last bucket, and the sum of the observations.
+        self.values = dict((name, {}) for name in METRICS)
+
+    def inc(self, name, amount=1, **labels):
+        """ Adds amount to a counter. """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """ Sets a gauge. """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        """ Adds an observation, such as a duration in seconds, to a histogram. """
+        key = tuple(sorted(labels.items()))
+        bucket = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                bucket = i
+                break
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [0] * (len(BUCKETS) + 2)
+            counts = series[key]
+            counts[bucket] += 1
+            counts[-1] += value
+
+    def get(self, name, **labels):
+        """ Returns the value of a series, or None if nothing was recorded for it. """
+        with self.lock:
+            value = self.values[name].get(tuple(sorted(labels.items())))
+            return list(value) if isinstance(value, list) else value
+
+    def remove(self, **labels):
+        """ Removes every series with the given labels, such as those of a rule which was removed. """
+        labels = set(labels.items())
+        with self.lock:
+            for series in self.values.itervalues():
+                for key in [key for key in series if labels.issubset(key)]:
+                    del series[key]
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format. """
+        with self.lock:
+            values = dict((name, [(key, list(value) if isinstance(value, list) else value)
+                                  for key, value in series.iteritems()])
+                          for name, series in self.values.iteritems())
+
+        lines = []
+        for name in sorted(values):
+            metric_type, help_text = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for key, value in sorted(values[name]):
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name, format_labels(key), format_value(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float('inf'),), value[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key, [('le', format_value(bound))]), cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(key), format_value(value[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(key), cumulative))
+        return u'\n'.join(lines) + u'\n'
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would otherwise be logged to stderr
+        pass
+
+
+class MetricsServer(object):
+    """ Serves metrics at /metrics on a background thread.
+
+    :param metrics: The Metrics to serve.
+    :param port: The port to listen on. With 0, a free port is chosen, which is then given by port.
+    :param host: The address to listen on.
+    """
+
+    def __init__(self, metrics, port, host='0.0.0.0'):
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsRequestHandler)
+        self.server.metrics = metrics
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='elastalert-metrics')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        elastalert_logger.info('Serving metrics on port %s' % (self.port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,9 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
-import requests
 from alerts import Alerter
-from alerts import BasicMatchString
+from util import compile_format
 from util import EAException
 from util import elastalert_logger
 from util import lookup_es_key
@@ -26,23 +25,20 @@ class OpsGenieAlerter(Alerter):
         self.opsgenie_subject = self.rule.get('opsgenie_subject')
         self.opsgenie_subject_args = self.rule.get('opsgenie_subject_args')
         self.alias = self.rule.get('opsgenie_alias')
+        self.message_format = compile_format(self.custom_message) if self.custom_message is not None else None
+        self.alias_format = compile_format(self.alias) if self.alias is not None else None
         self.opsgenie_proxy = self.rule.get('opsgenie_proxy', None)
 
     def _fill_responders(self, responders, type_):
         return [{'id': r, 'type': type_} for r in responders]
 
     def alert(self, matches):
-        body = ''
-        for match in matches:
-            body += unicode(BasicMatchString(self.rule, match))
-            # Separate text of aggregated alerts with dashes
-            if len(matches) > 1:
-                body += '\n----------------------------------------\n'
+        body = self.get_matches_text(matches)
 
         if self.custom_message is None:
             self.message = self.create_title(matches)
         else:
-            self.message = self.custom_message.format(**matches[0])
+            self.message = self.message_format(matches[0])
 
         post = {}
         post['message'] = self.message
@@ -57,7 +53,7 @@ class OpsGenieAlerter(Alerter):
         post['tags'] = self.tags
 
         if self.alias is not None:
-            post['alias'] = self.alias.format(**matches[0])
+            post['alias'] = self.alias_format(matches[0])
 
         logging.debug(json.dumps(post))
 
@@ -69,7 +65,7 @@ class OpsGenieAlerter(Alerter):
         proxies = {'https': self.opsgenie_proxy} if self.opsgenie_proxy else None
 
         try:
-            r = requests.post(self.to_addr, json=post, headers=headers, proxies=proxies)
+            r = self.http_post(self.to_addr, json=post, headers=headers, proxies=proxies)
 
             logging.debug('request response: {0}'.format(r))
             if r.status_code != 202:
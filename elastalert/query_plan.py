@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from util import dt_to_ts
+
+# The rule options a QueryPlan is compiled from
+COMPILED_OPTIONS = ('filter', 'timestamp_field', 'dt_to_ts', 'five', 'aggregation_query_element',
+                    'bucket_interval_period', 'bucket_offset_delta')
+
+# The parts of the response to each kind of query which are read, so that Elasticsearch can leave out the rest
+FILTER_PATHS = {
+    'hits': 'took,hits.total,hits.hits._id,hits.hits._index,hits.hits._type,hits.hits._source,hits.hits.fields,_scroll_id',
+    'count': 'count',
+    'terms': 'took,aggregations.**.buckets.key,aggregations.**.buckets.doc_count',
+    'aggregation': 'took,hits.total,aggregations',
+}
+
+
+class QueryPlan(object):
+    """ The Elasticsearch queries for a rule, compiled once from its filters and options, so that each query only
+    adds its time range. The sort, terms and aggregation elements are shared between the queries a plan returns,
+    so queries must not be modified other than by adding keys at the top level.
+
+    :param rule: The rule configuration. Only filter is required.
+    """
+
+    def __init__(self, rule):
+        self.options = tuple((option, rule.get(option)) for option in COMPILED_OPTIONS)
+        self.filters = tuple(rule['filter'])
+        self.timestamp_field = rule.get('timestamp_field', '@timestamp')
+        self.to_ts_func = rule.get('dt_to_ts', dt_to_ts)
+        self.five = rule.get('five', False)
+        self.wrapper = 'bool' if self.five else 'filtered'
+        self.sorts = {False: [{self.timestamp_field: {'order': 'asc'}}],
+                      True: [{self.timestamp_field: {'order': 'desc'}}]}
+
+        self.metric_aggregation = rule.get('aggregation_query_element')
+        self.bucket_interval_period = rule.get('bucket_interval_period')
+        self.bucket_offset_delta = rule.get('bucket_offset_delta')
+        self.aggregations = {}
+
+    def is_current(self, rule):
+        """ Returns whether the plan was compiled from the rule's current options. Options are compared by identity,
+        so a changed option means the plan must be compiled again. """
+        return len(rule['filter']) == len(self.filters) and all(rule.get(option) is value for option, value in self.options)
+
+    def get_query(self, starttime=None, endtime=None, sort=True, desc=False, extra_filters=()):
+        """ Returns a query dict that will apply the rule's filters, and extra_filters, filter by start and end time,
+        and sort results by timestamp.
+
+        :param starttime: A timestamp to use as the start time of the query.
+        :param endtime: A timestamp to use as the end time of the query.
+        :param sort: If true, sort results by timestamp. (Default True)
+        :param desc: If true, sort results newest first.
+        :param extra_filters: Filters to apply after the rule's filters.
+        :return: A query dictionary to pass to Elasticsearch.
+        """
+        starttime = self.to_ts_func(starttime)
+        endtime = self.to_ts_func(endtime)
+        if starttime and endtime:
+            must = [{'range': {self.timestamp_field: {'gt': starttime, 'lte': endtime}}}]
+            must.extend(self.filters)
+        else:
+            must = list(self.filters)
+        must.extend(extra_filters)
+        query = {'query': {self.wrapper: {'filter': {'bool': {'must': must}}}}}
+        if sort:
+            query['sort'] = self.sorts[desc]
+        return query
+
+    def add_aggregation(self, query, aggs_element):
+        """ Adds an aggregation to a query returned by get_query. """
+        if not self.five:
+            query_element = query['query']
+            query_element['filtered']['aggs'] = aggs_element
+            return {'aggs': query_element}
+        query['aggs'] = aggs_element
+        return query
+
+    def get_terms_query(self, starttime, endtime, field, size, extra_filters=()):
+        """ Returns a query counting the events for each of the top size values of field. """
+        key = ('terms', field, size)
+        if key not in self.aggregations:
+            self.aggregations[key] = {'counts': {'terms': {'field': field, 'size': size}}}
+        query = self.get_query(starttime, endtime, sort=False, extra_filters=extra_filters)
+        return self.add_aggregation(query, self.aggregations[key])
+
+    def get_aggregation_query(self, starttime, endtime, query_key, terms_size):
+        """ Returns a query for the rule's aggregation_query_element, for each bucket_interval_period, if set, and
+        for each of the top terms_size values of each field in query_key. """
+        key = ('metric', query_key, terms_size)
+        if key not in self.aggregations:
+            if self.bucket_interval_period is not None:
+                aggs_element = {
+                    'interval_aggs': {
+                        'date_histogram': {
+                            'field': self.timestamp_field,
+                            'interval': self.bucket_interval_period},
+                        'aggs': self.metric_aggregation
+                    }
+                }
+                if self.bucket_offset_delta:
+                    aggs_element['interval_aggs']['date_histogram']['offset'] = '+%ss' % (self.bucket_offset_delta)
+            else:
+                aggs_element = self.metric_aggregation
+
+            if query_key is not None:
+                for key_field in reversed(query_key.split(',')):
+                    aggs_element = {'bucket_aggs': {'terms': {'field': key_field, 'size': terms_size}, 'aggs': aggs_element}}
+            self.aggregations[key] = aggs_element
+        query = self.get_query(starttime, endtime, sort=False)
+        return self.add_aggregation(query, self.aggregations[key])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import collections
+
+from util import EAException
+
+
+class RuleRegistry(object):
+    """ A set of rules indexed by name and by rule_key, so that finding, adding, replacing and removing a rule
+    does not search every rule. Rule names are unique, as load_rules requires.
+
+    Iterating over the registry, or indexing it by position, uses a snapshot of the rules in the order they
+    were added, so rules may be added or removed while iterating.
+
+    :param rules: The rules to add.
+    """
+
+    def __init__(self, rules=()):
+        self.rules_by_name = collections.OrderedDict()
+        self.names_by_key = {}
+        self.snapshot = None
+        for rule in rules:
+            self.add(rule)
+
+    def get(self, name):
+        """ Returns the rule with the given name, or None. """
+        return self.rules_by_name.get(name)
+
+    def get_by_key(self, rule_key):
+        """ Returns the rule loaded from the given rule_key, or None. """
+        name = self.names_by_key.get(rule_key)
+        return self.rules_by_name.get(name) if name is not None else None
+
+    def add(self, rule):
+        """ Adds a rule, replacing any rule with the same rule_key, or with the same name and no other rule_key.
+        Raises EAException if a rule loaded from another rule_key has the same name. """
+        existing = self.rules_by_name.get(rule['name'])
+        if existing is not None and existing.get('rule_key') != rule.get('rule_key'):
+            raise EAException('A rule with the name %s already exists' % (rule['name']))
+        self.remove_key(rule.get('rule_key'))
+        self.remove(rule)
+        self.rules_by_name[rule['name']] = rule
+        if rule.get('rule_key') is not None:
+            self.names_by_key[rule['rule_key']] = rule['name']
+        self.snapshot = None
+
+    def remove(self, rule):
+        """ Removes the rule with the same name as rule, returning it, or None if there was none. """
+        removed = self.rules_by_name.pop(rule['name'], None)
+        if removed is not None:
+            if self.names_by_key.get(removed.get('rule_key')) == removed['name']:
+                del self.names_by_key[removed['rule_key']]
+            self.snapshot = None
+        return removed
+
+    def remove_key(self, rule_key):
+        """ Removes the rule loaded from the given rule_key, returning it, or None if there was none. """
+        rule = self.get_by_key(rule_key)
+        return self.remove(rule) if rule is not None else None
+
+    def get_snapshot(self):
+        """ Returns a list of the rules, which must not be modified. It is the same list until a rule is added or
+        removed. """
+        if self.snapshot is None:
+            self.snapshot = list(self.rules_by_name.itervalues())
+        return self.snapshot
+
+    def __iter__(self):
+        return iter(self.get_snapshot())
+
+    def __len__(self):
+        return len(self.rules_by_name)
+
+    def __getitem__(self, index):
+        return self.get_snapshot()[index]
+
+    def __contains__(self, rule):
+        return self.rules_by_name.get(rule['name']) is rule
+
+    def __repr__(self):
+        return 'RuleRegistry(%r)' % (self.rules_by_name.keys())
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+from config import get_file_paths
+from config import get_rule_file_stats
+from config import hash_rule
+from config import isyaml
+from config import load_rule_file
+from util import elastalert_logger
+from util import LazyImport
+
+pyinotify = LazyImport('pyinotify')
+
+
+class RuleWatcher(object):
+    """ Keeps the hashes of rule files, as returned by config.get_rule_hashes, up to date in a background thread.
+    Files are compared by their modification time and size, and only files which changed are parsed again.
+    With inotify, the thread waits for files to be reported as changed instead of checking every file.
+    This uses the pyinotify package, which is only needed if inotify is enabled.
+
+    :param conf: The global configuration.
+    :param use_rule: The --rule argument, if set.
+    :param interval: The number of seconds between checking rule files. With inotify, files are only checked
+    again when they change, or if events were lost.
+    :param use_inotify: Whether to use inotify, falling back to checking the files if it is not available.
+    """
+
+    def __init__(self, conf, use_rule=None, interval=10, use_inotify=False):
+        self.conf = conf
+        self.use_rule = use_rule
+        self.interval = interval
+        self.stats = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.inotify = None
+        # The paths reported by inotify since the last scan, or None if every file should be checked again
+        self.changed_paths = []
+        if use_inotify:
+            try:
+                self.watch_manager = pyinotify.WatchManager()
+                self.inotify = pyinotify.Notifier(self.watch_manager, self.handle_event, timeout=int(interval * 1000))
+            except Exception as e:
+                # pyinotify is not installed, or the system does not support inotify
+                elastalert_logger.warning('inotify is not available, checking rule files every %s seconds instead: %s' % (interval, e))
+        self.scan()
+        self.thread = threading.Thread(target=self.watch, name='elastalert-rule-watcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_rule_hashes(self):
+        """ Returns a dictionary mapping each rule file to the hash of its contents, or to None if it could not
+        be parsed. It must not be modified. """
+        with self.lock:
+            return self.hashes
+
+    def watch_directories(self):
+        """ Adds inotify watches for the directories containing rule files. New subdirectories are watched
+        as soon as they are created. """
+        if self.use_rule and os.path.isfile(self.use_rule):
+            directory, recursive = os.path.dirname(self.use_rule) or '.', False
+        else:
+            directory, recursive = self.conf['rules_folder'], self.conf['scan_subdirectories']
+        mask = (pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM |
+                pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_DELETE_SELF |
+                pyinotify.IN_MOVE_SELF)
+        self.watch_manager.add_watch(directory, mask, rec=recursive, auto_add=recursive)
+
+    def handle_event(self, event):
+        """ Records the path of a file reported by inotify. If events were lost, or a directory changed,
+        every file is checked again. """
+        if self.changed_paths is None:
+            return
+        if event.mask & (pyinotify.IN_Q_OVERFLOW | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF) or event.dir:
+            self.changed_paths = None
+        else:
+            self.changed_paths.append(event.pathname)
+
+    def read_events(self):
+        """ Waits for up to interval seconds for inotify to report changes.
+
+        :return: A list of the paths of changed files, or None if every file should be checked again.
+        """
+        self.changed_paths = []
+        if self.inotify.check_events():
+            self.inotify.read_events()
+            self.inotify.process_events()
+        return self.changed_paths
+
+    def scan(self, paths=None):
+        """ Checks rule files for changes and parses those which changed.
+
+        :param paths: The paths which changed, or None to check every rule file.
+        """
+        if paths is None:
+            if self.inotify:
+                self.watch_directories()
+            stats = get_rule_file_stats(self.conf, self.use_rule)
+        else:
+            stats = dict(self.stats)
+            rule_keys = None
+            for path in paths:
+                if not isyaml(path):
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    stats.pop(path, None)
+                    continue
+                if path not in stats:
+                    # New files are only rules if get_file_paths would have found them, such as with --rule
+                    if rule_keys is None:
+                        rule_keys = set(get_file_paths(self.conf, self.use_rule))
+                    if path not in rule_keys:
+                        continue
+                stats[path] = (stat.st_mtime, stat.st_size)
+
+        changed = [path for path, path_stat in stats.iteritems() if self.stats.get(path) != path_stat]
+        if not changed and len(stats) == len(self.stats):
+            return
+
+        hashes = dict((path, rule_hash) for path, rule_hash in self.hashes.iteritems() if path in stats)
+        for path in changed:
+            try:
+                hashes[path] = hash_rule(load_rule_file(path))
+            except Exception as e:
+                # The error is reported when the rule is loaded
+                elastalert_logger.warning('Could not parse rule file %s: %s' % (path, e))
+                hashes[path] = None
+        self.stats = stats
+        with self.lock:
+            self.hashes = hashes
+
+    def watch(self):
+        while not self.stopped.is_set():
+            try:
+                if self.inotify:
+                    self.scan(self.read_events())
+                else:
+                    self.stopped.wait(self.interval)
+                    self.scan()
+            except Exception as e:
+                logging.exception('Error checking rule files for changes: %s' % (e))
+                self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.inotify:
+            self.inotify.stop()
@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import collections
 import copy
 import datetime
+import heapq
 import sys
 
 from blist import sortedlist
 from util import add_raw_postfix
+from util import approximate_size
 from util import dt_to_ts
 from util import EAException
 from util import elastalert_logger
@@ -26,6 +29,8 @@ class RuleType(object):
     :param rules: A rule configuration.
     """
     required_options = frozenset()
+    # Attributes holding the state a rule keeps between runs, used to estimate its memory usage
+    state_attributes = ('occurrences',)
 
     def __init__(self, rules, args=None):
         self.matches = []
@@ -73,6 +78,56 @@ class RuleType(object):
         """
         pass
 
+    def get_state_size(self):
+        """ Returns an estimate, in bytes, of the memory used by the state kept in state_attributes. """
+        return approximate_size([getattr(self, attr) for attr in self.state_attributes if hasattr(self, attr)])
+
+    def get_key_count(self):
+        """ Returns the number of query keys for which state is being kept. """
+        return len(self.occurrences)
+
+    def get_keys_by_age(self):
+        """ Returns the query keys for which state is being kept, least recently seen first. """
+        return list(self.occurrences)
+
+    def forget_key(self, key):
+        """ Removes all state kept for a query key.
+
+        :param key: The query key value.
+        """
+        for attr in self.state_attributes:
+            state = getattr(self, attr, None)
+            if isinstance(state, dict):
+                state.pop(key, None)
+            elif hasattr(state, 'discard'):
+                state.discard(key)
+
+    def get_state(self):
+        """ Returns the state kept in state_attributes as picklable data, to be restored with set_state. """
+        return dict((attr, getattr(self, attr)) for attr in self.state_attributes if hasattr(self, attr))
+
+    def set_state(self, state):
+        """ Restores state returned by get_state. The state may come from a rule with a different configuration,
+        such as the previous version of a reloaded rule.
+
+        :param state: A dictionary returned by get_state.
+        """
+        for attr, value in state.iteritems():
+            if attr in self.state_attributes:
+                setattr(self, attr, value)
+
+    def forget_oldest_keys(self, count):
+        """ Removes the state kept for up to count query keys, least recently seen first.
+        Used to keep a rule within its memory budget.
+
+        :param count: The maximum number of keys to forget.
+        :return: The number of keys forgotten.
+        """
+        keys = self.get_keys_by_age()[:count]
+        for key in keys:
+            self.forget_key(key)
+        return len(keys)
+
     def add_count_data(self, counts):
         """ Gets called when a rule has use_count_query set to True. Called to add data from querying to the rule.
 
@@ -157,13 +212,40 @@ class WhitelistRule(CompareRule):
 class ChangeRule(CompareRule):
     """ A rule that will store values for a certain term and match if those values change """
     required_options = frozenset(['query_key', 'compound_compare_key', 'ignore_null'])
-    change_map = {}
-    occurrence_time = {}
+    state_attributes = ('occurrences', 'occurrence_time', 'change_map')
+
+    def __init__(self, *args):
+        super(ChangeRule, self).__init__(*args)
+        # Last values per query key, least recently updated first, so that eviction pops from the front
+        self.occurrences = collections.OrderedDict()
+        self.occurrence_time = {}
+        self.change_map = {}
+        self.max_keys = self.rules.get('change_max_keys')
+        # Keys which have not been seen for longer than the TTL are forgotten. With a timeframe, such a key
+        # could not match anyway, since only changes within the timeframe are reported.
+        self.key_ttl = self.rules.get('change_key_ttl', self.rules.get('timeframe'))
+
+    def evict_keys(self, timestamp):
+        """ Forget the least recently updated keys until there are at most change_max_keys of them,
+        and those last updated more than change_key_ttl before timestamp. """
+        if self.max_keys:
+            while len(self.occurrences) > self.max_keys:
+                key, _ = self.occurrences.popitem(last=False)
+                self.occurrence_time.pop(key, None)
+                self.change_map.pop(key, None)
+        if self.key_ttl and self.occurrence_time:
+            while self.occurrences:
+                key = next(iter(self.occurrences))
+                # Keys restored from a rule without a TTL have no time, and are treated as expired
+                occurred = self.occurrence_time.get(key)
+                if occurred is not None and timestamp - occurred <= self.key_ttl:
+                    break
+                self.forget_key(key)
 
     def compare(self, event):
         key = hashable(lookup_es_key(event, self.rules['query_key']))
         values = []
-        elastalert_logger.debug(" Previous Values of compare keys  " + str(self.occurrences))
+        elastalert_logger.debug(" Previous Values of compare keys  " + str(self.occurrences.get(key)))
         for val in self.rules['compound_compare_key']:
             lookup_value = lookup_es_key(event, val)
             values.append(lookup_value)
@@ -183,14 +265,17 @@ class ChangeRule(CompareRule):
             if changed:
                 self.change_map[key] = (self.occurrences[key], values)
                 # If using timeframe, only return true if the time delta is < timeframe
-                if key in self.occurrence_time:
+                if 'timeframe' in self.rules and key in self.occurrence_time:
                     changed = event[self.rules['timestamp_field']] - self.occurrence_time[key] <= self.rules['timeframe']
+            # Re-insert to mark this key as the most recently updated
+            del self.occurrences[key]
 
         # Update the current value and time
         elastalert_logger.debug(" Setting current value of compare keys values " + str(values))
         self.occurrences[key] = values
-        if 'timeframe' in self.rules:
+        if 'timeframe' in self.rules or self.key_ttl:
             self.occurrence_time[key] = event[self.rules['timestamp_field']]
+        self.evict_keys(event[self.rules['timestamp_field']])
         elastalert_logger.debug("Final result of comparision between previous and current values " + str(changed))
         return changed
 
@@ -198,7 +283,7 @@ class ChangeRule(CompareRule):
         # TODO this is not technically correct
         # if the term changes multiple times before an alert is sent
         # this data will be overwritten with the most recent change
-        change = self.change_map.get(hashable(lookup_es_key(match, self.rules['query_key'])))
+        change = self.change_map.pop(hashable(lookup_es_key(match, self.rules['query_key'])), None)
         extra = {}
         if change:
             extra = {'old_value': change[0],
@@ -206,16 +291,31 @@ class ChangeRule(CompareRule):
             elastalert_logger.debug("Description of the changed records  " + str(dict(match.items() + extra.items())))
         super(ChangeRule, self).add_match(dict(match.items() + extra.items()))
 
+    def garbage_collect(self, timestamp):
+        """ Forget keys which have not been updated within change_key_ttl """
+        self.evict_keys(timestamp)
+
 
 class FrequencyRule(RuleType):
     """ A rule that matches if num_events number of events occur within a timeframe """
     required_options = frozenset(['num_events', 'timeframe'])
+    state_attributes = ('occurrences', 'deadlines')
 
     def __init__(self, *args):
         super(FrequencyRule, self).__init__(*args)
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
         self.get_ts = new_get_event_ts(self.ts_field)
         self.attach_related = self.rules.get('attach_related', False)
+        # Keys ordered by the time at which their window may next need attention in garbage_collect
+        self.deadlines = DeadlineQueue()
+
+    def add_occurrence(self, key, event):
+        """ Append an (event, count) tuple to the window for key and schedule the window's expiry. """
+        window = self.occurrences.setdefault(key, EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts))
+        window.append(event)
+        # The window goes stale once its newest event is more than timeframe old. Keep the earliest
+        # deadline; garbage_collect will re-check the window and reschedule it if it is still fresh.
+        self.deadlines.schedule(key, self.get_ts(window.data[-1]) + self.rules['timeframe'], keep_earlier=True)
 
     def add_count_data(self, data):
         """ Add count data to the rule. Data should be of the form {ts: count}. """
@@ -225,7 +325,7 @@ class FrequencyRule(RuleType):
         (ts, count), = data.items()
 
         event = ({self.ts_field: ts}, count)
-        self.occurrences.setdefault('all', EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)).append(event)
+        self.add_occurrence('all', event)
         self.check_for_match('all')
 
     def add_terms_data(self, terms):
@@ -233,7 +333,7 @@ class FrequencyRule(RuleType):
             for bucket in buckets:
                 event = ({self.ts_field: timestamp,
                           self.rules['query_key']: bucket['key']}, bucket['doc_count'])
-                self.occurrences.setdefault(bucket['key'], EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)).append(event)
+                self.add_occurrence(bucket['key'], event)
                 self.check_for_match(bucket['key'])
 
     def add_data(self, data):
@@ -250,7 +350,7 @@ class FrequencyRule(RuleType):
                 key = 'all'
 
             # Store the timestamps of recent occurrences, per key
-            self.occurrences.setdefault(key, EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)).append((event, 1))
+            self.add_occurrence(key, (event, 1))
             self.check_for_match(key, end=False)
 
         # We call this multiple times with the 'end' parameter because subclasses
@@ -271,11 +371,29 @@ class FrequencyRule(RuleType):
 
     def garbage_collect(self, timestamp):
         """ Remove all occurrence data that is beyond the timeframe away """
-        stale_keys = []
-        for key, window in self.occurrences.iteritems():
-            if timestamp - lookup_es_key(window.data[-1][0], self.ts_field) > self.rules['timeframe']:
-                stale_keys.append(key)
-        map(self.occurrences.pop, stale_keys)
+        # Only keys whose deadline has passed can be stale, so the others are never touched
+        for key in self.deadlines.pop_due(timestamp, inclusive=False):
+            window = self.occurrences.get(key)
+            if window is None:
+                # Already removed by a match
+                continue
+            newest = lookup_es_key(window.data[-1][0], self.ts_field)
+            if timestamp - newest > self.rules['timeframe']:
+                self.occurrences.pop(key)
+            else:
+                self.deadlines.schedule(key, newest + self.rules['timeframe'])
+
+    def get_keys_by_age(self):
+        return sorted(self.occurrences, key=lambda key: self.get_ts(self.occurrences[key].data[-1]))
+
+    def get_state(self):
+        return {'occurrences': dict((key, list(window.data)) for key, window in self.occurrences.iteritems())}
+
+    def set_state(self, state):
+        # Re-adding the events rebuilds the deadlines and trims the windows to the current timeframe
+        for key, events in state.get('occurrences', {}).iteritems():
+            for event in events:
+                self.add_occurrence(key, event)
 
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
@@ -375,9 +493,57 @@ class EventWindow(object):
         self.data.rotate(-rotation)
 
 
+class DeadlineQueue(object):
+    """ A min-heap of keys ordered by deadline, used by rules to find the keys that need work in
+    garbage_collect without scanning every key. Each key has at most one live deadline; entries
+    which have been rescheduled or discarded are skipped lazily when they reach the top of the heap. """
+
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def schedule(self, key, deadline, keep_earlier=False):
+        """ Set the deadline for key. If keep_earlier is set, an existing earlier deadline is kept. """
+        current = self.deadlines.get(key)
+        if current is not None and (current == deadline or (keep_earlier and current < deadline)):
+            return
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        # Drop superseded entries once they dominate the heap
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(d, k) for k, d in self.deadlines.iteritems()]
+            heapq.heapify(self.heap)
+
+    def discard(self, key):
+        """ Forget the deadline for key, if any. """
+        self.deadlines.pop(key, None)
+
+    def pop_due(self, timestamp, inclusive=True):
+        """ Remove and return the keys whose deadline is before (or, if inclusive, at) timestamp. """
+        due = []
+        while self.heap:
+            deadline, key = self.heap[0]
+            if deadline > timestamp or (deadline == timestamp and not inclusive):
+                break
+            heapq.heappop(self.heap)
+            if self.deadlines.get(key) != deadline:
+                # Superseded by a later schedule or discard
+                continue
+            del self.deadlines[key]
+            due.append(key)
+        return due
+
+
 class SpikeRule(RuleType):
     """ A rule that uses two sliding windows to compare relative event frequency. """
     required_options = frozenset(['timeframe', 'spike_height', 'spike_type'])
+    state_attributes = ('ref_windows', 'cur_windows', 'first_event', 'skip_checks')
 
     def __init__(self, *args):
         super(SpikeRule, self).__init__(*args)
@@ -546,10 +712,41 @@ class SpikeRule(RuleType):
                 placeholder.update({self.rules['query_key']: qk})
             self.handle_event(placeholder, 0, qk)
 
+    def get_key_count(self):
+        return len(self.cur_windows)
+
+    def get_state(self):
+        return {'ref_windows': dict((qk, list(window.data)) for qk, window in self.ref_windows.iteritems()),
+                'cur_windows': dict((qk, list(window.data)) for qk, window in self.cur_windows.iteritems()),
+                'first_event': self.first_event,
+                'skip_checks': self.skip_checks,
+                'ref_window_filled_once': self.ref_window_filled_once}
+
+    def set_state(self, state):
+        for qk, events in state.get('ref_windows', {}).iteritems():
+            ref_window = self.ref_windows.setdefault(qk, EventWindow(self.timeframe, getTimestamp=self.get_ts))
+            for event in events:
+                ref_window.append(event)
+        for qk, events in state.get('cur_windows', {}).iteritems():
+            ref_window = self.ref_windows.setdefault(qk, EventWindow(self.timeframe, getTimestamp=self.get_ts))
+            cur_window = self.cur_windows.setdefault(qk, EventWindow(self.timeframe, ref_window.append, self.get_ts))
+            for event in events:
+                cur_window.append(event)
+        self.first_event.update(state.get('first_event', {}))
+        self.skip_checks.update(state.get('skip_checks', {}))
+        self.ref_window_filled_once = self.ref_window_filled_once or state.get('ref_window_filled_once', False)
+
+    def get_keys_by_age(self):
+        def newest(qk):
+            window = self.cur_windows[qk]
+            return (bool(window.data), self.get_ts(window.data[-1]) if window.data else None)
+        return sorted(self.cur_windows, key=newest)
+
 
 class FlatlineRule(FrequencyRule):
     """ A rule that matches when there is a low number of events given a timeframe. """
     required_options = frozenset(['timeframe', 'threshold'])
+    state_attributes = ('occurrences', 'deadlines', 'first_event', 'pending_keys')
 
     def __init__(self, *args):
         super(FlatlineRule, self).__init__(*args)
@@ -557,6 +754,35 @@ class FlatlineRule(FrequencyRule):
 
         # Dictionary mapping query keys to the first events
         self.first_event = {}
+        # Keys which have received data since the last garbage_collect
+        self.pending_keys = set()
+
+    def add_occurrence(self, key, event):
+        self.occurrences.setdefault(key, EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)).append(event)
+        self.pending_keys.add(key)
+
+    def get_state(self):
+        state = super(FlatlineRule, self).get_state()
+        state['first_event'] = self.first_event
+        return state
+
+    def set_state(self, state):
+        super(FlatlineRule, self).set_state(state)
+        self.first_event.update(state.get('first_event', {}))
+
+    def next_check_time(self, key):
+        """ Returns the earliest time at which garbage_collect could find a match for key, given the data
+        currently in its window. Before then, the timeframe has not elapsed since the first event or the
+        events in the window still add up to at least the threshold. """
+        earliest = self.first_event[key] + self.rules['timeframe']
+        # Walk back from the newest event until the threshold is reached. The window can only drop
+        # below the threshold once that event is more than timeframe old.
+        count = 0
+        for event in reversed(self.occurrences[key].data):
+            count += event[1]
+            if count >= self.threshold:
+                return max(earliest, self.get_ts(event) + self.rules['timeframe'])
+        return earliest
 
     def check_for_match(self, key, end=True):
         # This function gets called between every added document with end=True after the last
@@ -604,10 +830,20 @@ class FlatlineRule(FrequencyRule):
         return message
 
     def garbage_collect(self, ts):
-        # We add an event with a count of zero to the EventWindow for each key. This will cause the EventWindow
-        # to remove events that occurred more than one `timeframe` ago, and call onRemoved on them.
-        default = ['all'] if 'query_key' not in self.rules else []
-        for key in self.occurrences.keys() or default:
+        # We add an event with a count of zero to the EventWindow for each key that may match. This will cause the
+        # EventWindow to remove events that occurred more than one `timeframe` ago, and call onRemoved on them.
+        # Keys that have not received data and whose next check time is still ahead cannot match yet, so they are
+        # left alone until then.
+        keys = self.pending_keys
+        self.pending_keys = set()
+        keys.update(self.deadlines.pop_due(ts))
+        use_default = not self.occurrences and 'query_key' not in self.rules
+        if use_default:
+            keys.add('all')
+        for key in keys:
+            if key not in self.occurrences and not (use_default and key == 'all'):
+                # Forgotten by forget_keys
+                continue
             self.occurrences.setdefault(
                 key,
                 EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)
@@ -616,10 +852,16 @@ class FlatlineRule(FrequencyRule):
             )
             self.first_event.setdefault(key, ts)
             self.check_for_match(key)
+            if key in self.occurrences:
+                self.deadlines.schedule(key, self.next_check_time(key))
+            else:
+                self.deadlines.discard(key)
 
 
 class NewTermsRule(RuleType):
     """ Alerts on a new value in a list of fields. """
+    # Seen terms are never forgotten, as that would cause them to alert again
+    state_attributes = ('seen_values',)
 
     def __init__(self, rule, args=None):
         super(NewTermsRule, self).__init__(rule, args)
@@ -645,6 +887,10 @@ class NewTermsRule(RuleType):
             # Refuse to start if we cannot get existing terms
             raise EAException('Error searching for existing terms: %s' % (repr(e))), None, sys.exc_info()[2]
 
+    def get_state(self):
+        # Existing terms are queried from Elasticsearch when the rule is loaded
+        return {}
+
     def get_all_terms(self, args):
         """ Performs a terms aggregation for each field to get every existing term. """
         self.es = elasticsearch_client(self.rules)
@@ -884,6 +1130,7 @@ class NewTermsRule(RuleType):
 class CardinalityRule(RuleType):
     """ A rule that matches if cardinality of a field is above or below a threshold within a timeframe """
     required_options = frozenset(['timeframe', 'cardinality_field'])
+    state_attributes = ('cardinality_cache', 'first_event')
 
     def __init__(self, *args):
         super(CardinalityRule, self).__init__(*args)
@@ -939,6 +1186,15 @@ class CardinalityRule(RuleType):
                     event.update({self.rules['query_key']: qk})
                 self.check_for_match(qk, event, False)
 
+    def get_key_count(self):
+        return len(self.cardinality_cache)
+
+    def get_keys_by_age(self):
+        def newest(qk):
+            terms = self.cardinality_cache[qk]
+            return (bool(terms), max(terms.values()) if terms else None)
+        return sorted(self.cardinality_cache, key=newest)
+
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
         starttime = pretty_ts(dt_to_ts(ts_to_dt(match[self.ts_field]) - self.rules['timeframe']), lt)
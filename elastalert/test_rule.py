@@ -23,6 +23,7 @@ from elastalert.config import load_options
 from elastalert.config import load_rule_yaml
 from elastalert.elastalert import ElastAlerter
 from elastalert.util import elasticsearch_client
+from elastalert.util import get_bytes_transferred
 from elastalert.util import lookup_es_key
 from elastalert.util import ts_now
 from elastalert.util import ts_to_dt
@@ -204,7 +205,10 @@ class MockElastAlerter(object):
         elastalert.elasticsearch_client = mock.Mock()
 
     def run_elastalert(self, rule, conf, args):
-        """ Creates an ElastAlert instance and run's over for a specific rule using either real or mock data. """
+        """ Creates an ElastAlert instance and run's over for a specific rule using either real or mock data.
+
+        :return: A tuple of the bytes sent to and received from Elasticsearch while running the rule, if not using mock data.
+        """
 
         # Load and instantiate rule
         # Pass an args containing the context of whether we're alerting or not
@@ -281,6 +285,26 @@ class MockElastAlerter(object):
                 if errors and args.stop_error:
                     exit(1)
 
+        if not args.json:
+            return get_bytes_transferred(client.current_es)
+
+    def compare_transfer_size(self, rule_yaml, conf, args):
+        """ Runs the rule without and then with es_filter_path and es_http_compress, and prints how many bytes each
+        run transferred to and from Elasticsearch. """
+        transferred = []
+        for trimmed in (False, True):
+            rule = copy.deepcopy(rule_yaml)
+            rule['es_filter_path'] = rule['es_http_compress'] = trimmed
+            transferred.append(self.run_elastalert(rule, conf, args))
+
+        print('\nBytes transferred to and from Elasticsearch:')
+        for label, (sent, received) in zip(('Untrimmed and uncompressed', 'With es_filter_path and es_http_compress'),
+                                           transferred):
+            print('%s: %d sent, %d received' % (label, sent, received))
+        untrimmed = sum(transferred[0])
+        if untrimmed:
+            print('Saved %.1f%%' % (100.0 * (untrimmed - sum(transferred[1])) / untrimmed))
+
     def load_conf(self, rules, args):
         """ Loads a default conf dictionary (from global config file, if provided, or hard-coded mocked data),
             for initializing rules. Also initializes rules.
@@ -354,6 +378,11 @@ class MockElastAlerter(object):
             action='store_true',
             dest='count',
             help='Only display the number of documents matching the filter')
+        parser.add_argument(
+            '--transfer-size',
+            action='store_true',
+            dest='transfer_size',
+            help='Run the rule without and with response trimming and compression, and compare the bytes transferred')
         parser.add_argument('--config', action='store', dest='config', help='Global config file.')
         args = parser.parse_args()
 
@@ -373,7 +402,10 @@ class MockElastAlerter(object):
                     data_file.write(json.dumps([doc['_source'] for doc in hits], indent='    '))
 
         if not args.schema_only and not args.count:
-            self.run_elastalert(rule_yaml, conf, args)
+            if args.transfer_size and not args.json:
+                self.compare_transfer_size(rule_yaml, conf, args)
+            else:
+                self.run_elastalert(rule_yaml, conf, args)
 
 
 def main():
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-import collections
 import datetime
+import importlib
 import logging
 import os
+import re
+import sys
+import zlib
+from string import Formatter
 
 import dateutil.parser
 import dateutil.tz
@@ -98,6 +102,14 @@ def set_es_key(lookup_dict, term, value):
     return False
 
 
+def es_key_getter(term):
+    """ Returns a function which looks up term in a dictionary, as lookup_es_key does. Terms which do not
+    contain a full stop are looked up directly, without searching through the dictionary. """
+    if isinstance(term, string_types) and '.' not in term:
+        return lambda lookup_dict: lookup_dict.get(term)
+    return lambda lookup_dict: lookup_es_key(lookup_dict, term)
+
+
 def lookup_es_key(lookup_dict, term):
     """ Performs iterative dictionary search for the given term.
     :returns: The value identified by term or None if it cannot be found.
@@ -185,6 +197,27 @@ def hashable(obj):
     return obj
 
 
+def approximate_size(obj, seen=None):
+    """ Estimates the memory used by obj, in bytes, by walking the containers it is made of.
+    Objects referenced more than once are only counted once. """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += approximate_size(key, seen) + approximate_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == 'sortedlist':
+        for item in obj:
+            size += approximate_size(item, seen)
+    elif hasattr(obj, '__dict__') and not callable(obj):
+        # Instances such as EventWindow, but not the functions and bound methods they reference
+        size += approximate_size(vars(obj), seen)
+    return size
+
+
 def format_index(index, start, end):
     """ Takes an index, specified using strftime format, start and end time timestamps,
     and outputs a wildcard based index string to match all possible timestamps. """
@@ -204,6 +237,32 @@ class EAException(Exception):
     pass
 
 
+class LazyImport(object):
+    """ A stand-in for a module, or an object in a module, which is only imported when it is first used.
+    This keeps the libraries needed by a single alerter from slowing down every import of ElastAlert.
+
+    :param module_name: The name of the module to import.
+    :param attribute: The name of an object in the module to use instead of the module itself.
+    """
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def resolve(self):
+        if self._target is None:
+            module = importlib.import_module(self._module_name)
+            self._target = getattr(module, self._attribute) if self._attribute else module
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+
 def seconds(td):
     return td.seconds + td.days * 24 * 3600
 
@@ -273,6 +332,48 @@ def replace_dots_in_field_names(document):
     return document
 
 
+class CompressedRequestsHttpConnection(RequestsHttpConnection):
+    """ A RequestsHttpConnection which, with http_compress, gzips request bodies and asks for gzipped responses.
+    It counts the bytes of the request and response bodies it transfers, as sent over the wire.
+
+    :param http_compress: If true, compress requests and responses.
+    """
+
+    def __init__(self, http_compress=False, **kwargs):
+        super(CompressedRequestsHttpConnection, self).__init__(**kwargs)
+        self.http_compress = http_compress
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        if http_compress:
+            self.session.headers['accept-encoding'] = 'gzip'
+        self.session.hooks['response'].append(self.count_response)
+
+    def count_response(self, response, **kwargs):
+        # Once the content has been read, the raw response knows how many bytes it read before decompressing them
+        response.content
+        self.bytes_received += response.raw.tell()
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        if body is not None:
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            if self.http_compress:
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = compressor.compress(body) + compressor.flush()
+                headers = dict(headers or {})
+                headers['content-encoding'] = 'gzip'
+            self.bytes_sent += len(body)
+        return super(CompressedRequestsHttpConnection, self).perform_request(method, url, params, body, timeout, ignore,
+                                                                             headers)
+
+
+def get_bytes_transferred(es_client):
+    """ Returns a tuple of the bytes sent and received by the connections of an elasticsearch_client. """
+    connections = es_client.transport.connection_pool.connections
+    return (sum(getattr(connection, 'bytes_sent', 0) for connection in connections),
+            sum(getattr(connection, 'bytes_received', 0) for connection in connections))
+
+
 def elasticsearch_client(conf):
     """ returns an Elasticsearch instance configured using an es_conn_config """
     es_conn_conf = build_es_conn_config(conf)
@@ -289,7 +390,8 @@ def elasticsearch_client(conf):
                          use_ssl=es_conn_conf['use_ssl'],
                          verify_certs=es_conn_conf['verify_certs'],
                          ca_certs=es_conn_conf['ca_certs'],
-                         connection_class=RequestsHttpConnection,
+                         connection_class=CompressedRequestsHttpConnection,
+                         http_compress=es_conn_conf['http_compress'],
                          http_auth=es_conn_conf['http_auth'],
                          timeout=es_conn_conf['es_conn_timeout'],
                          send_get_body_as=es_conn_conf['send_get_body_as'],
@@ -318,6 +420,7 @@ def build_es_conn_config(conf):
     parsed_conf['es_url_prefix'] = ''
     parsed_conf['es_conn_timeout'] = conf.get('es_conn_timeout', 20)
     parsed_conf['send_get_body_as'] = conf.get('es_send_get_body_as', 'GET')
+    parsed_conf['http_compress'] = conf.get('es_http_compress', True)
 
     if 'es_username' in conf:
         parsed_conf['es_username'] = os.environ.get('ES_USERNAME', conf['es_username'])
@@ -377,6 +480,102 @@ def flatten_dict(dct, delim='.', prefix=''):
     return ret
 
 
+def lookup_flat_key(dct, key, delim='.'):
+    """ Looks up key as if dct had been flattened with flatten_dict, without flattening all of it.
+    :raises KeyError: If the flattened dictionary would not contain key.
+    """
+    if key in dct and type(dct[key]) != dict:
+        return dct[key]
+    index = key.find(delim)
+    while index != -1:
+        prefix = key[:index]
+        if prefix in dct and type(dct[prefix]) == dict:
+            try:
+                return lookup_flat_key(dct[prefix], key[index + len(delim):], delim)
+            except KeyError:
+                pass
+        index = key.find(delim, index + 1)
+    raise KeyError(key)
+
+
+class FlatMatch(object):
+    """ A read only mapping of the flattened fields of a match, which returns missing_text for any field
+    the match does not have. Fields are looked up when they are used. """
+
+    def __init__(self, match, missing_text):
+        self.match = match
+        self.missing_text = missing_text
+
+    def __getitem__(self, key):
+        try:
+            return lookup_flat_key(self.match, key)
+        except KeyError:
+            return self.missing_text
+
+
+def get_format_fields(format_string):
+    """ Returns the names of the keyword arguments used by a new-style format string.
+    :raises ValueError: If the format string is malformed.
+    """
+    names = set()
+    for _, field_name, format_spec, _ in Formatter().parse(format_string):
+        if field_name is not None:
+            names.add(re.match(r'[^.[]*', field_name).group())
+        if format_spec:
+            names |= get_format_fields(format_spec)
+    return names
+
+
+def compile_format(format_string):
+    """ Compiles a new-style format string into a function which formats it with the fields of a match,
+    as format_string.format(**match) would, but only copying the fields which the format string uses. """
+    try:
+        names = get_format_fields(format_string)
+    except ValueError:
+        # Formatting will raise the error when it is used
+        return lambda match: format_string.format(**match)
+
+    def render(match):
+        return format_string.format(**dict((name, match[name]) for name in names if name in match))
+    return render
+
+
+def compile_resolve_string(string, missing_text='<MISSING VALUE>'):
+    """ Compiles a string for resolve_string into a function of a match. The fields used by the string
+    are found once, so that each call only looks up those fields rather than flattening the whole match. """
+    try:
+        names = get_format_fields(string)
+    except ValueError:
+        names = None
+
+    def render(match):
+        if names is None:
+            fields = flatten_dict(match)
+        else:
+            fields = {}
+            for name in names:
+                try:
+                    fields[name] = lookup_flat_key(match, name)
+                except KeyError:
+                    pass
+        fields['_missing_value'] = missing_text
+        resolved = string
+        while True:
+            try:
+                resolved = resolved.format(**fields)
+                resolved = resolved % FlatMatch(match, missing_text)
+                break
+            except KeyError as e:
+                if '{%s}' % e.message not in resolved:
+                    break
+                resolved = resolved.replace('{%s}' % e.message, '{_missing_value}')
+        return resolved
+    return render
+
+
+resolve_string_cache = {}
+
+
 def resolve_string(string, match, missing_text='<MISSING VALUE>'):
     """
         Given a python string that may contain references to fields on the match dictionary,
@@ -385,22 +584,17 @@ def resolve_string(string, match, missing_text='<MISSING VALUE>'):
             it is replaced by a default string.
         Strings can be formatted using the old-style format ('%(field)s') or
             the new-style format ('{match[field]}').
+        Each string is compiled with compile_resolve_string the first time it is used.
 
         :param string: A string that may contain references to values of the 'match' dictionary.
         :param match: A dictionary with the values to replace where referenced by keys in the string.
         :param missing_text: The default text to replace a formatter with if the field doesnt exist.
     """
-    flat_match = flatten_dict(match)
-    dd_match = collections.defaultdict(lambda: missing_text, flat_match)
-    dd_match['_missing_value'] = missing_text
-    while True:
-        try:
-            string = string.format(**dd_match)
-            string = string % dd_match
-            break
-        except KeyError as e:
-            if '{%s}' % e.message not in string:
-                break
-            string = string.replace('{%s}' % e.message, '{_missing_value}')
-
-    return string
\ No newline at end of file
+    key = (string, missing_text)
+    render = resolve_string_cache.get(key)
+    if render is None:
+        # Strings can include values from matches, so the cache is emptied rather than let it grow without limit
+        if len(resolve_string_cache) >= 1000:
+            resolve_string_cache.clear()
+        render = resolve_string_cache[key] = compile_resolve_string(string, missing_text)
+    return render(match)
@@ -23,6 +23,7 @@ setup(
         'console_scripts': ['elastalert-create-index=elastalert.create_index:main',
                             'elastalert-test-rule=elastalert.test_rule:main',
                             'elastalert-rule-from-kibana=elastalert.rule_from_kibana:main',
+                            'elastalert-import-time=elastalert.import_time:main',
                             'elastalert=elastalert.elastalert:main']},
     packages=find_packages(),
     package_data={'elastalert': ['schema.yaml']},
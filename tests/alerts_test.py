@@ -2,23 +2,37 @@
 import datetime
 import json
 import subprocess
+import threading
+import time
+import zlib
 from contextlib import nested
+from smtplib import SMTPServerDisconnected
 
 import mock
 import pytest
+import requests
 from jira.exceptions import JIRAError
+from texttable import Texttable
 
 from elastalert.alerts import Alerter
 from elastalert.alerts import BasicMatchString
 from elastalert.alerts import CommandAlerter
 from elastalert.alerts import EmailAlerter
+from elastalert.alerts import get_http_session
+from elastalert.alerts import HTTPPostAlerter
 from elastalert.alerts import JiraAlerter
+from elastalert.alerts import JiraCache
 from elastalert.alerts import JiraFormattedMatchString
 from elastalert.alerts import PagerDutyAlerter
+from elastalert.alerts import ServiceNowAlerter
 from elastalert.alerts import SimplePostAlerter
 from elastalert.alerts import SlackAlerter
+from elastalert.alerts import SMTPPool
+from elastalert.alerts import SnsAlerter
+from elastalert.alerts import StompAlerter
 from elastalert.config import load_modules
 from elastalert.opsgenie import OpsGenieAlerter
+from elastalert.util import EAException
 from elastalert.util import ts_add
 
 
@@ -340,7 +354,7 @@ def test_opsgenie_basic():
     rule = {'name': 'testOGalert', 'opsgenie_key': 'ogkey',
             'opsgenie_account': 'genies', 'opsgenie_addr': 'https://api.opsgenie.com/v1/json/alert',
             'opsgenie_recipients': ['lytics'], 'type': mock_rule()}
-    with mock.patch('requests.post') as mock_post:
+    with mock.patch('requests.Session.post') as mock_post:
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00'}])
@@ -363,7 +377,7 @@ def test_opsgenie_frequency():
             'opsgenie_recipients': ['lytics'], 'type': mock_rule(),
             'filter': [{'query': {'query_string': {'query': '*hihi*'}}}],
             'alert': 'opsgenie'}
-    with mock.patch('requests.post') as mock_post:
+    with mock.patch('requests.Session.post') as mock_post:
 
         alert = OpsGenieAlerter(rule)
         alert.alert([{'@timestamp': '2014-10-31T00:00:00'}])
@@ -407,8 +421,9 @@ def test_jira():
 
     with nested(
         mock.patch('elastalert.alerts.JIRA'),
-        mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value.priorities.return_value = [mock_priority]
         mock_jira.return_value.fields.return_value = []
@@ -440,8 +455,9 @@ def test_jira():
     rule['jira_bump_tickets'] = True
     with nested(
         mock.patch('elastalert.alerts.JIRA'),
-        mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value = mock.Mock()
         mock_jira.return_value.search_issues.return_value = []
@@ -458,8 +474,9 @@ def test_jira():
     rule['jira_ignore_in_title'] = 'test_term'
     with nested(
         mock.patch('elastalert.alerts.JIRA'),
-        mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value = mock.Mock()
         mock_jira.return_value.search_issues.return_value = []
@@ -474,8 +491,9 @@ def test_jira():
     # Issue is still created if search_issues throws an exception
     with nested(
         mock.patch('elastalert.alerts.JIRA'),
-        mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value = mock.Mock()
         mock_jira.return_value.search_issues.side_effect = JIRAError
@@ -550,8 +568,9 @@ def test_jira_arbitrary_field_support():
 
     with nested(
             mock.patch('elastalert.alerts.JIRA'),
-            mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+            mock.patch('elastalert.alerts.yaml_loader'),
+            mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value.priorities.return_value = [mock_priority]
         mock_jira.return_value.fields.return_value = mock_fields
@@ -593,8 +612,9 @@ def test_jira_arbitrary_field_support():
 
     with nested(
             mock.patch('elastalert.alerts.JIRA'),
-            mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+            mock.patch('elastalert.alerts.yaml_loader'),
+            mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value.priorities.return_value = [mock_priority]
         mock_jira.return_value.fields.return_value = mock_fields
@@ -611,8 +631,9 @@ def test_jira_arbitrary_field_support():
 
     with nested(
             mock.patch('elastalert.alerts.JIRA'),
-            mock.patch('elastalert.alerts.yaml_loader')
-    ) as (mock_jira, mock_open):
+            mock.patch('elastalert.alerts.yaml_loader'),
+            mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
         mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
         mock_jira.return_value.priorities.return_value = [mock_priority]
         mock_jira.return_value.fields.return_value = mock_fields
@@ -626,6 +647,95 @@ def test_jira_arbitrary_field_support():
         assert "Exception encountered when trying to add 'invalid_watcher' as a watcher. Does the user exist?" in str(exception)
 
 
+def test_jira_cache():
+    rule = {
+        'name': 'test alert',
+        'jira_account_file': 'jirafile',
+        'type': mock_rule(),
+        'jira_project': 'testproject',
+        'jira_issuetype': 'testtype',
+        'jira_server': 'jiraserver',
+        'jira_bump_tickets': True,
+        'timestamp_field': '@timestamp',
+        'rule_file': '/tmp/foo.yaml',
+    }
+    match = {'@timestamp': '2014-10-31T00:00:00'}
+
+    with nested(
+        mock.patch('elastalert.alerts.JIRA'),
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
+        mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
+        mock_jira.return_value.priorities.return_value = []
+        mock_jira.return_value.fields.return_value = []
+        mock_jira.return_value.search_issues.return_value = []
+        mock_jira.return_value.create_issue.return_value.fields.updated = '2014-10-31T00:00:00'
+
+        # Client and metadata are shared by rules with the same server and account
+        alerts = [JiraAlerter(dict(rule, name='rule %d' % (i))) for i in range(3)]
+        assert mock_jira.call_count == 1
+        assert mock_jira.return_value.priorities.call_count == 1
+        assert mock_jira.return_value.fields.call_count == 1
+
+        # The new ticket is found by the next alert without searching again
+        alerts[0].alert([match])
+        alerts[0].alert([match])
+        assert mock_jira.return_value.search_issues.call_count == 1
+        assert mock_jira.return_value.create_issue.call_count == 1
+        assert mock_jira.return_value.add_comment.call_count == 1
+
+        # Metadata is fetched again once the TTL has passed
+        JiraAlerter(dict(rule, jira_metadata_ttl=-1))
+        assert mock_jira.call_count == 1
+        assert mock_jira.return_value.fields.call_count == 2
+
+        mock_open.return_value = {'user': 'otheruser', 'password': 'jirapassword'}
+        JiraAlerter(rule)
+        assert mock_jira.call_count == 2
+
+    # A slow server does not hold up alerters using another server
+    cache = JiraCache()
+    fetching = threading.Event()
+    release = threading.Event()
+    fetched = threading.Event()
+
+    def jira(server, basic_auth):
+        if server == 'slowserver':
+            fetching.set()
+            release.wait(5)
+            fetched.set()
+        return mock.Mock()
+
+    with mock.patch('elastalert.alerts.JIRA', side_effect=jira):
+        slow = threading.Thread(target=cache.get, args=(('slowserver', 'user', 'password'), 60))
+        slow.start()
+        try:
+            assert fetching.wait(5)
+            cache.get(('jiraserver', 'user', 'password'), 60)
+            assert not fetched.is_set()
+        finally:
+            release.set()
+            slow.join()
+
+    # Searches are not cached with a TTL of 0
+    rule['jira_search_cache_ttl'] = 0
+    with nested(
+        mock.patch('elastalert.alerts.JIRA'),
+        mock.patch('elastalert.alerts.yaml_loader'),
+        mock.patch('elastalert.alerts.jira_cache', JiraCache())
+    ) as (mock_jira, mock_open, _):
+        mock_open.return_value = {'user': 'jirauser', 'password': 'jirapassword'}
+        mock_jira.return_value.priorities.return_value = []
+        mock_jira.return_value.fields.return_value = []
+        mock_jira.return_value.search_issues.return_value = []
+        alert = JiraAlerter(rule)
+        alert.alert([match])
+        alert.alert([match])
+        assert mock_jira.return_value.search_issues.call_count == 2
+        assert mock_jira.return_value.create_issue.call_count == 2
+
+
 def test_kibana(ea):
     rule = {'filter': [{'query': {'query_string': {'query': 'xy:z'}}}],
             'name': 'Test rule!',
@@ -759,7 +869,7 @@ def test_slack_uses_custom_title():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -781,7 +891,8 @@ def test_slack_uses_custom_title():
         rule['slack_webhook_url'],
         data=mock.ANY,
         headers={'content-type': 'application/json'},
-        proxies=None
+        proxies=None,
+        timeout=(10, 30)
     )
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
@@ -799,7 +910,7 @@ def test_slack_uses_rule_name_when_custom_title_is_not_provided():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -821,7 +932,8 @@ def test_slack_uses_rule_name_when_custom_title_is_not_provided():
         rule['slack_webhook_url'][0],
         data=mock.ANY,
         headers={'content-type': 'application/json'},
-        proxies=None
+        proxies=None,
+        timeout=(10, 30)
     )
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
@@ -840,7 +952,7 @@ def test_slack_uses_custom_slack_channel():
         '@timestamp': '2016-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
 
     expected_data = {
@@ -862,7 +974,8 @@ def test_slack_uses_custom_slack_channel():
         rule['slack_webhook_url'][0],
         data=mock.ANY,
         headers={'content-type': 'application/json'},
-        proxies=None
+        proxies=None,
+        timeout=(10, 30)
     )
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
@@ -881,7 +994,7 @@ def test_simple_alerter():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'rule': rule['name'],
@@ -891,7 +1004,8 @@ def test_simple_alerter():
         rule['simple_webhook_url'],
         data=mock.ANY,
         headers={'Content-Type': 'application/json', 'Accept': 'application/json;charset=utf-8'},
-        proxies=None
+        proxies=None,
+        timeout=(10, 30)
     )
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
@@ -910,7 +1024,7 @@ def test_pagerduty_alerter():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -922,7 +1036,8 @@ def test_pagerduty_alerter():
         'incident_key': '',
         'service_key': 'magicalbadgers',
     }
-    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None)
+    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None,
+                                              timeout=(10, 30))
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
 
@@ -941,7 +1056,7 @@ def test_pagerduty_alerter_custom_incident_key():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -953,7 +1068,8 @@ def test_pagerduty_alerter_custom_incident_key():
         'incident_key': 'custom key',
         'service_key': 'magicalbadgers',
     }
-    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None)
+    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None,
+                                              timeout=(10, 30))
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
 
@@ -973,7 +1089,7 @@ def test_pagerduty_alerter_custom_incident_key_with_args():
         '@timestamp': '2017-01-01T00:00:00',
         'somefield': 'foobarbaz'
     }
-    with mock.patch('requests.post') as mock_post_request:
+    with mock.patch('requests.Session.post') as mock_post_request:
         alert.alert([match])
     expected_data = {
         'client': 'ponies inc.',
@@ -985,7 +1101,8 @@ def test_pagerduty_alerter_custom_incident_key_with_args():
         'incident_key': 'custom foobarbaz',
         'service_key': 'magicalbadgers',
     }
-    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None)
+    mock_post_request.assert_called_once_with(alert.url, data=mock.ANY, headers={'content-type': 'application/json'}, proxies=None,
+                                              timeout=(10, 30))
     assert expected_data == json.loads(mock_post_request.call_args_list[0][1]['data'])
 
 
@@ -1079,3 +1196,289 @@ def test_resolving_rule_references(ea):
     assert 'the_owner' == alert.rule['list_of_things'][1]
     assert 'the_owner' == alert.rule['list_of_things'][2][1]
     assert 'the_owner' == alert.rule['nested_dict']['nested_owner']
+
+
+def test_http_sessions_are_shared():
+    session = get_http_session('https://hooks.slack.com/services/a')
+    assert get_http_session('https://hooks.slack.com/services/b') is session
+    assert get_http_session('http://hooks.slack.com/services/a') is not session
+    assert get_http_session('https://hooks.slack.com/services/a', proxies={'https': 'http://proxy:3128'}) is not session
+    assert get_http_session('https://hooks.slack.com/services/a', retries=5) is not session
+
+
+def test_http_sessions_do_not_share_cookies():
+    rules = []
+    for username in ('user1', 'user2'):
+        rules.append({'name': 'Test ServiceNow Rule %s' % (username),
+                      'type': mock_rule(),
+                      'username': username,
+                      'password': 'password of %s' % (username),
+                      'servicenow_rest_url': 'https://servicenow.example.com/api/now/table/incident',
+                      'short_description': 'ServiceNow',
+                      'comments': 'comments',
+                      'assignment_group': 'group',
+                      'category': 'category',
+                      'subcategory': 'subcategory',
+                      'cmdb_ci': 'ci',
+                      'caller_id': 'caller',
+                      'alert': []})
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = request.url
+        # Each response sets a session cookie, as cookielib reads it from the underlying httplib response
+        set_cookie = ['JSESSIONID=session%s; Path=/' % (len(sent))]
+        headers = mock.Mock(getheaders=lambda name: set_cookie if name == 'Set-Cookie' else [])
+        response.raw = mock.Mock(spec=['_original_response', 'read'], read=mock.Mock(return_value=''),
+                                 _original_response=mock.Mock(msg=headers))
+        return response
+
+    with mock.patch('requests.adapters.HTTPAdapter.send', side_effect=send):
+        for rule in rules:
+            ServiceNowAlerter(rule).alert([{'@timestamp': '2017-01-01T00:00:00'}])
+
+    assert len(sent) == 2
+    assert get_http_session(rules[0]['servicenow_rest_url']).cookies.keys() == []
+    assert sent[1].headers['Authorization'] != sent[0].headers['Authorization']
+    assert 'Cookie' not in sent[1].headers
+
+
+def test_http_post_timeout():
+    rule = {
+        'name': 'Test HTTP Post',
+        'type': 'any',
+        'http_post_url': 'http://test.webhook.url',
+        'http_connect_timeout': 1,
+        'http_read_timeout': 5,
+        'alert': []
+    }
+    load_modules(rule)
+    alert = HTTPPostAlerter(rule)
+    with mock.patch('requests.Session.post') as mock_post_request:
+        alert.alert([{'@timestamp': '2017-01-01T00:00:00'}])
+    assert mock_post_request.call_args[1]['timeout'] == (1, 5)
+
+
+def test_http_post_does_not_modify_match():
+    rule = {
+        'name': 'Test HTTP Post',
+        'type': 'any',
+        'http_post_url': 'http://test.webhook.url',
+        'http_post_static_payload': {'name': 'somestaticname'},
+        'alert': []
+    }
+    load_modules(rule)
+    alert = HTTPPostAlerter(rule)
+    match = {'@timestamp': '2017-01-01T00:00:00', 'somefield': 'foobarbaz'}
+    with mock.patch('requests.Session.post') as mock_post_request:
+        alert.alert([match])
+    assert json.loads(mock_post_request.call_args[1]['data']) == dict(match, name='somestaticname')
+    assert match == {'@timestamp': '2017-01-01T00:00:00', 'somefield': 'foobarbaz'}
+
+
+def test_http_post_batches():
+    rule = {
+        'name': 'Test HTTP Post',
+        'type': 'any',
+        'http_post_url': ['http://test.webhook.url', 'http://test2.webhook.url'],
+        'http_post_payload': {'field': 'somefield'},
+        'http_post_batch_size': 2,
+        'alert': []
+    }
+    load_modules(rule)
+    alert = HTTPPostAlerter(rule)
+    matches = [{'somefield': i} for i in range(5)]
+    with mock.patch('requests.Session.post') as mock_post_request:
+        alert.alert(matches)
+    # Three batches to each URL
+    assert mock_post_request.call_count == 6
+    bodies = [json.loads(call[1]['data']) for call in mock_post_request.call_args_list if call[0][0] == rule['http_post_url'][0]]
+    assert bodies == [[{'field': 0}, {'field': 1}], [{'field': 2}, {'field': 3}], [{'field': 4}]]
+
+    # Newline delimited and compressed
+    rule['http_post_batch_format'] = 'ndjson'
+    rule['http_post_gzip'] = True
+    rule['http_post_concurrent'] = True
+    alert = HTTPPostAlerter(rule)
+    with mock.patch('requests.Session.post') as mock_post_request:
+        alert.alert(matches)
+    assert mock_post_request.call_count == 6
+    call = mock_post_request.call_args_list[0]
+    assert call[1]['headers']['Content-Type'] == 'application/x-ndjson'
+    assert call[1]['headers']['Content-Encoding'] == 'gzip'
+    lines = zlib.decompress(call[1]['data'], 16 + zlib.MAX_WBITS).splitlines()
+    assert [json.loads(line) for line in lines] in ([{'field': 0}, {'field': 1}], [{'field': 2}, {'field': 3}], [{'field': 4}])
+
+
+def test_email_keepalive():
+    rule = {'name': 'test alert', 'email': ['testing@test.test'], 'from_addr': 'testfrom@test.test',
+            'type': mock_rule(), 'timestamp_field': '@timestamp', 'smtp_keepalive': True, 'alert_subject': 'Test alert'}
+    with nested(mock.patch('elastalert.alerts.SMTP'), mock.patch('elastalert.alerts.smtp_pool', SMTPPool())) as (mock_smtp, _):
+        mock_smtp.return_value.noop.return_value = (250, 'OK')
+        alert = EmailAlerter(rule)
+        alert.alert([{'test_term': 'test_value'}])
+        alert.alert([{'test_term': 'test_value'}])
+        # The connection is opened once and checked before it is reused
+        assert mock_smtp.call_count == 1
+        assert mock_smtp.return_value.noop.call_count == 1
+        assert mock_smtp.return_value.sendmail.call_count == 2
+        assert mock_smtp.return_value.close.call_count == 0
+
+        # The server closed the connection
+        mock_smtp.return_value.noop.side_effect = SMTPServerDisconnected()
+        alert.alert([{'test_term': 'test_value'}])
+        assert mock_smtp.call_count == 2
+        assert mock_smtp.return_value.close.call_count == 1
+
+
+def test_smtp_pool_reconnects():
+    pool = SMTPPool()
+    stale = mock.Mock()
+    stale.noop.return_value = (250, 'OK')
+    stale.sendmail.side_effect = SMTPServerDisconnected()
+    fresh = mock.Mock()
+    fresh.noop.return_value = (250, 'OK')
+    pool.release('key', stale)
+    pool.sendmail('key', lambda: fresh, 60, 'from@test.test', ['to@test.test'], 'message')
+    fresh.sendmail.assert_called_once_with('from@test.test', ['to@test.test'], 'message')
+    assert pool.acquire('key', mock.Mock(), 60) is fresh
+
+    # Connections idle for too long are closed
+    pool.release('key', stale)
+    with mock.patch('time.time', return_value=time.time() + 61):
+        assert pool.acquire('key', lambda: fresh, 60) is fresh
+    assert stale.close.call_count == 1
+
+
+def test_stomp_connection_is_shared():
+    rule = {
+        'name': 'test stomp',
+        'type': mock_rule(),
+        'stomp_hostname': 'broker',
+        'stomp_hostport': 61613,
+        'stomp_login': 'user',
+        'stomp_password': 'password',
+        'timestamp_field': '@timestamp',
+        'rule_file': '/tmp/foo.yaml',
+        'alert_subject': 'Test stomp',
+    }
+    match = {'@timestamp': '2017-01-01T00:00:00'}
+    with nested(mock.patch('elastalert.alerts.stomp'), mock.patch('elastalert.alerts.stomp_connections', {})) as (mock_stomp, _):
+        mock_stomp.Connection.return_value.is_connected.return_value = True
+        alerts = [StompAlerter(dict(rule)), StompAlerter(dict(rule))]
+        alerts[0].alert([match])
+        alerts[1].alert([match])
+        mock_stomp.Connection.assert_called_once_with([('broker', 61613)], heartbeats=(10000, 10000))
+        mock_stomp.Connection.return_value.connect.assert_called_once_with('user', 'password')
+        assert mock_stomp.Connection.return_value.send.call_count == 2
+
+        # A lost connection is replaced
+        mock_stomp.Connection.return_value.is_connected.side_effect = [False, True]
+        alerts[0].alert([match])
+        assert mock_stomp.Connection.call_count == 2
+        assert mock_stomp.Connection.return_value.send.call_count == 3
+
+
+def test_stomp_connect_timeout():
+    rule = {
+        'name': 'test stomp',
+        'type': mock_rule(),
+        'stomp_hostname': 'broker',
+        'stomp_hostport': 61613,
+        'stomp_login': 'user',
+        'stomp_password': 'password',
+        'stomp_connect_timeout': 0,
+        'timestamp_field': '@timestamp',
+        'rule_file': '/tmp/foo.yaml',
+    }
+    with nested(mock.patch('elastalert.alerts.stomp'), mock.patch('elastalert.alerts.stomp_connections', {})) as (mock_stomp, _):
+        mock_stomp.Connection.return_value.is_connected.return_value = False
+        with pytest.raises(EAException):
+            StompAlerter(rule).get_connection()
+        assert mock_stomp.Connection.return_value.disconnect.call_count == 1
+
+        # A broker which does not respond does not hold up alerters using another broker
+        connecting = threading.Event()
+        release = threading.Event()
+        connected = threading.Event()
+
+        def connection(host_and_ports, heartbeats):
+            conn = mock.Mock()
+            if host_and_ports[0][0] == 'slowbroker':
+                def start():
+                    connecting.set()
+                    release.wait(5)
+                    connected.set()
+                conn.start.side_effect = start
+            return conn
+
+        mock_stomp.Connection.side_effect = connection
+        slow = threading.Thread(target=StompAlerter(dict(rule, stomp_hostname='slowbroker')).get_connection)
+        slow.start()
+        try:
+            assert connecting.wait(5)
+            StompAlerter(dict(rule, stomp_connect_timeout=10)).get_connection()
+            assert not connected.is_set()
+        finally:
+            release.set()
+            slow.join()
+
+
+def test_sns_client_is_shared():
+    rule = {
+        'name': 'test sns',
+        'type': mock_rule(),
+        'sns_topic_arn': 'arn:aws:sns:us-east-1:123456789:topic',
+        'timestamp_field': '@timestamp',
+        'alert_subject': 'Test sns',
+    }
+    match = {'@timestamp': '2017-01-01T00:00:00'}
+    with nested(mock.patch('elastalert.alerts.boto3'), mock.patch('elastalert.alerts.sns_clients', {})) as (mock_boto3, _):
+        SnsAlerter(dict(rule)).alert([match])
+        SnsAlerter(dict(rule)).alert([match])
+        assert mock_boto3.Session.call_count == 1
+        assert mock_boto3.Session.return_value.client.return_value.publish.call_count == 2
+
+        SnsAlerter(dict(rule, aws_region='eu-west-1')).alert([match])
+        assert mock_boto3.Session.call_count == 2
+
+
+def test_alert_text_is_rendered_once():
+    rule = {
+        'name': 'test rule',
+        'type': mock.Mock(),
+        'timestamp_field': '@timestamp',
+        'aggregation': {'hours': 1},
+        'summary_table_fields': ['field'],
+        'alert_subject': 'Subject {0}',
+        'alert_subject_args': ['field'],
+    }
+    rule['type'].get_match_str.return_value = 'rule text'
+    matches = [{'@timestamp': '2017-01-01T00:00:00', 'field': 'a'}, {'@timestamp': '2017-01-01T00:00:01', 'field': 'b'}]
+    alerters = [Alerter(rule), Alerter(rule)]
+
+    # Without a pipeline, text is rendered by each alerter
+    bodies = [alerter.create_alert_body(matches) for alerter in alerters]
+    assert rule['type'].get_match_str.call_count == 4
+    assert bodies[0] == bodies[1]
+    assert 'rule text' in bodies[0]
+    assert bodies[0].count('\n----------------------------------------\n') == 2
+
+    pipeline = {}
+    for alerter in alerters:
+        alerter.pipeline = pipeline
+    rule['type'].get_match_str.reset_mock()
+    with mock.patch('elastalert.alerts.Texttable', side_effect=Texttable) as mock_table:
+        assert [alerter.create_alert_body(matches) for alerter in alerters] == bodies
+    assert mock_table.call_count == 1
+    assert rule['type'].get_match_str.call_count == 2
+    assert alerters[0].create_title(matches) == alerters[1].create_title(matches) == 'Subject a'
+
+    # Alerters with their own configuration do not share text with the others
+    other = Alerter(dict(rule, alert_subject='Other {0}'))
+    other.pipeline = pipeline
+    assert other.create_title(matches) == 'Other a'
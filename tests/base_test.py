@@ -10,9 +10,16 @@ import mock
 import pytest
 from elasticsearch.exceptions import ElasticsearchException
 
+from elastalert.dispatch import StormControl
+from elastalert.dispatch import WorkerPool
 from elastalert.enhancements import BaseEnhancement
 from elastalert.enhancements import DropMatchException
 from elastalert.kibana import dashboard_temp
+from elastalert.metrics import Metrics
+from elastalert.query_plan import FILTER_PATHS
+from elastalert.rule_registry import RuleRegistry
+from elastalert.ruletypes import AnyRule
+from elastalert.ruletypes import FrequencyRule
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_unix
 from elastalert.util import dt_to_unixms
@@ -93,7 +100,7 @@ def test_query(ea):
     ea.current_es.search.assert_called_with(body={
         'query': {'filtered': {'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'], ignore_unavailable=True,
-        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
+        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'], filter_path=FILTER_PATHS['hits'])
 
 
 def test_query_with_fields(ea):
@@ -103,7 +110,7 @@ def test_query_with_fields(ea):
     ea.current_es.search.assert_called_with(body={
         'query': {'filtered': {'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}], 'fields': ['@timestamp']}, index='idx', ignore_unavailable=True,
-        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
+        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'], filter_path=FILTER_PATHS['hits'])
 
 
 def test_query_with_unix(ea):
@@ -116,7 +123,7 @@ def test_query_with_unix(ea):
     ea.current_es.search.assert_called_with(
         body={'query': {'filtered': {'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
               'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'], ignore_unavailable=True,
-        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
+        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'], filter_path=FILTER_PATHS['hits'])
 
 
 def test_query_with_unixms(ea):
@@ -129,7 +136,7 @@ def test_query_with_unixms(ea):
     ea.current_es.search.assert_called_with(
         body={'query': {'filtered': {'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
               'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'], ignore_unavailable=True,
-        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
+        size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'], filter_path=FILTER_PATHS['hits'])
 
 
 def test_no_hits(ea):
@@ -665,6 +672,26 @@ def test_realert_with_nested_query_key(ea):
     assert ea.rules[0]['alert'][0].alert.call_count == 1
 
 
+def test_run_rule_metrics(ea):
+    ea.metrics = Metrics()
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    hits['took'] = 250
+    ea.current_es.search.return_value = hits
+    ea.rules[0]['type'].matches = [{'@timestamp': END}]
+    with mock.patch('elastalert.elastalert.elasticsearch_client', return_value=ea.current_es):
+        ea.run_rule(ea.rules[0], END, START)
+
+    # The day is queried in segments, which each return the same hits
+    assert ea.metrics.get('elastalert_hits_total', rule='anytest') == ea.num_hits > 2
+    assert ea.metrics.get('elastalert_duplicate_hits_total', rule='anytest') == ea.num_dupes == ea.num_hits - 2
+    assert ea.metrics.get('elastalert_matches_total', rule='anytest') == 1
+    assert ea.metrics.get('elastalert_alerts_sent_total', rule='anytest', alerter='mock') == 1
+    assert ea.metrics.get('elastalert_rule_state_bytes', rule='anytest') == ea.rules[0]['state_size']
+    assert ea.metrics.get('elastalert_query_seconds', rule='anytest', type='hits')[-1] > 0
+    assert ea.metrics.get('elastalert_query_took_seconds', rule='anytest', type='hits')[-1] == 0.25 * ea.num_hits / 2
+    assert sum(ea.metrics.get('elastalert_writeback_seconds', doc_type='elastalert_status')[:-1]) == 1
+
+
 def test_count(ea):
     ea.rules[0]['use_count_query'] = True
     ea.rules[0]['doc_type'] = 'doctype'
@@ -680,7 +707,57 @@ def test_count(ea):
         query['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['lte'] = dt_to_ts(end)
         query['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['gt'] = dt_to_ts(start)
         start = start + ea.run_every
-        ea.current_es.count.assert_any_call(body=query, doc_type='doctype', index='idx', ignore_unavailable=True)
+        ea.current_es.count.assert_any_call(body=query, doc_type='doctype', index='idx', ignore_unavailable=True,
+                                            filter_path='count')
+
+
+def test_count_request_cache(ea):
+    ea.rules[0]['use_count_query'] = True
+    ea.rules[0]['doc_type'] = 'doctype'
+    ea.rules[0]['request_cache'] = True
+    ea.rules[0]['request_cache_stats'] = True
+    ea.rules[0]['request_cache_interval'] = datetime.timedelta(minutes=10)
+    ea.current_es = mock.Mock()
+    ea.current_es.count.return_value = {'count': 5}
+    ea.current_es.indices.stats.side_effect = [{'_all': {'total': {'request_cache': {'hit_count': 3, 'miss_count': 1}}}},
+                                               {'_all': {'total': {'request_cache': {'hit_count': 4, 'miss_count': 1}}}}]
+    ea.request_cache_hits = ea.request_cache_misses = 0
+    assert ea.run_query(ea.rules[0], START, END)
+
+    # The range is aligned to 10 minutes and the query routed to the same shards on every run
+    query = {'query': {'filtered': {'filter': {'bool': {'must': [
+        {'range': {'@timestamp': {'gt': '2014-09-26T12:30:00Z', 'lte': '2014-09-27T12:30:00Z'}}}]}}}}}
+    ea.current_es.count.assert_called_with(body=query, doc_type='doctype', index='idx', ignore_unavailable=True,
+                                           preference='elastalert-anytest', filter_path='count')
+    assert ea.request_cache_hits == 1
+    assert ea.request_cache_misses == 0
+
+    # Nothing is queried until the next boundary has passed
+    ea.current_es.count.reset_mock()
+    assert ea.run_query(ea.rules[0], END, END + datetime.timedelta(minutes=1))
+    assert not ea.current_es.count.called
+
+
+def test_query_without_filter_path(ea):
+    ea.rules[0]['es_filter_path'] = False
+    ea.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(ea.rules[0], START, END)
+    assert 'filter_path' not in ea.current_es.search.call_args[1]
+
+
+def test_query_filtered_no_hits(ea):
+    # With filter_path, Elasticsearch leaves out hits.hits when there are none
+    ea.current_es.search.return_value = {'hits': {'total': 0}}
+    assert ea.run_query(ea.rules[0], START, END)
+    assert ea.num_hits == 0
+
+
+def test_request_cache_args(ea):
+    assert ea.get_request_cache_args(ea.rules[0]) == {}
+    ea.rules[0]['request_cache'] = True
+    assert ea.get_request_cache_args(ea.rules[0]) == {'preference': 'elastalert-anytest', 'request_cache': 'true'}
+    ea.rules[0]['request_cache_preference'] = 'shared'
+    assert ea.get_request_cache_args(ea.rules[0], count=True) == {'preference': 'shared'}
 
 
 def run_and_assert_segmented_queries(ea, start, end, segment_size):
@@ -877,8 +954,9 @@ def test_kibana_dashboard(ea):
 def test_rule_changes(ea):
     ea.rule_hashes = {'rules/rule1.yaml': 'ABC',
                       'rules/rule2.yaml': 'DEF'}
-    ea.rules = [ea.init_rule(rule, True) for rule in [{'rule_key': 'rules/rule1.yaml', 'name': 'rule1', 'filter': []},
-                                                      {'rule_key': 'rules/rule2.yaml', 'name': 'rule2', 'filter': []}]]
+    rules = [{'rule_key': 'rules/rule1.yaml', 'name': 'rule1', 'filter': []},
+             {'rule_key': 'rules/rule2.yaml', 'name': 'rule2', 'filter': []}]
+    ea.rules = RuleRegistry([ea.init_rule(rule, True) for rule in rules])
     ea.rules[1]['processed_hits'] = ['save me']
     new_hashes = {'rules/rule1.yaml': 'ABC',
                   'rules/rule3.yaml': 'XXX',
@@ -925,6 +1003,19 @@ def test_rule_changes(ea):
             ea.load_rule_changes()
     assert len(ea.rules) == 4
 
+    # A changed rule renamed to another rule's name wont load, and both rules keep running
+    new_hashes = copy.copy(new_hashes)
+    new_hashes['rules/rule4.yaml'] = 'zxcv'
+    with mock.patch('elastalert.elastalert.get_rule_hashes') as mock_hashes:
+        with mock.patch('elastalert.elastalert.load_rule_configuration') as mock_load:
+            with mock.patch.object(ea, 'handle_error') as mock_error:
+                mock_load.return_value = {'filter': [], 'name': 'rule1', 'rule_key': 'rules/rule4.yaml'}
+                mock_hashes.return_value = new_hashes
+                ea.load_rule_changes()
+                assert 'A rule with the name rule1 already exists' in mock_error.call_args[0][0]
+    assert [rule['name'] for rule in ea.rules] == ['rule1', 'rule2', 'rule3', 'rule4']
+    assert ea.rules.get('rule1')['rule_key'] == 'rules/rule1.yaml'
+
 
 def test_strf_index(ea):
     """ Test that the get_index function properly generates indexes spanning days """
@@ -1078,6 +1169,259 @@ def test_uncaught_exceptions(ea):
     assert mock_email.call_args_list[0][1] == {'exception': e, 'rule': ea.disabled_rules[0]}
 
 
+def test_state_budget_evict(ea):
+    rule = ea.rules[0]
+    rule['state_size'] = 1000
+    rule['type'].get_key_count.return_value = 10
+    rule['type'].forget_oldest_keys.return_value = 6
+    ea.notify_email = 'qlo@example.com'
+    with contextlib.nested(mock.patch.object(ea, 'get_rule_state_size'),
+                           mock.patch.object(ea, 'handle_error'),
+                           mock.patch.object(ea, 'send_notification_email')) as (mock_size, mock_error, mock_email):
+        mock_size.return_value = 400
+        ea.enforce_state_budget(rule, 500)
+
+    # Half way over budget, so half of the keys are forgotten
+    rule['type'].forget_oldest_keys.assert_called_once_with(5)
+    assert rule['state_size'] == 400
+    assert len(ea.rules) == 1
+    assert len(ea.disabled_rules) == 0
+    assert mock_error.call_args[0][1] == {'rule': rule['name'], 'state_size': 400, 'forgotten_keys': 6}
+    assert mock_email.call_count == 1
+
+
+def test_state_budget_disable(ea):
+    rule = ea.rules[0]
+    rule['state_size'] = 1000
+
+    # Nothing can be evicted
+    with mock.patch.object(ea, 'handle_error') as mock_error:
+        ea.enforce_state_budget(rule, 500)
+    assert len(ea.rules) == 0
+    assert list(ea.disabled_rules) == [rule]
+    assert 'disabled' in mock_error.call_args[0][0]
+
+    # Disabled without trying to evict
+    ea.rules = RuleRegistry([rule])
+    ea.disabled_rules = RuleRegistry()
+    rule['state_budget_action'] = 'disable'
+    rule['type'].forget_oldest_keys.reset_mock()
+    rule['type'].forget_oldest_keys.return_value = 1
+    with mock.patch.object(ea, 'handle_error'):
+        ea.enforce_state_budget(rule, 500)
+    assert rule['type'].forget_oldest_keys.call_count == 0
+    assert list(ea.disabled_rules) == [rule]
+
+
+def test_total_state_budget(ea):
+    small_rule = copy.copy(ea.rules[0])
+    small_rule['name'] = 'small'
+    small_rule['rule_key'] = 'small.yaml'
+    small_rule['state_size'] = 100
+    ea.rules[0]['state_size'] = 1000
+    ea.rules.add(small_rule)
+    ea.max_total_state_bytes = 800
+
+    def enforce(rule, budget):
+        rule['state_size'] = budget
+    with mock.patch.object(ea, 'enforce_state_budget') as mock_enforce:
+        mock_enforce.side_effect = enforce
+        ea.enforce_total_state_budget()
+    # Only the largest rule needs to shrink
+    mock_enforce.assert_called_once_with(ea.rules[0], 700)
+
+
+def test_run_rule_writes_state_size(ea):
+    ea.rules[0]['type'].get_state_size.return_value = 1234
+    ea.rules[0]['type'].get_key_count.return_value = 5
+    ea.rules[0]['max_rule_state_bytes'] = 10 ** 6
+    with contextlib.nested(mock.patch.object(ea, 'run_query'),
+                           mock.patch.object(ea, 'writeback'),
+                           mock.patch.object(ea, 'enforce_state_budget')) as (mock_query, mock_writeback, mock_enforce):
+        ea.run_rule(ea.rules[0], END, START)
+    body = mock_writeback.call_args[0][1]
+    assert body['state_size'] >= 1234
+    assert body['state_keys'] == 5
+    assert mock_enforce.call_count == 0
+
+    # Without a budget or metrics, the state is not measured
+    ea.rules[0].pop('max_rule_state_bytes')
+    ea.rules[0].pop('state_size')
+    with contextlib.nested(mock.patch.object(ea, 'run_query'),
+                           mock.patch.object(ea, 'writeback'),
+                           mock.patch.object(ea, 'get_rule_state_size')) as (mock_query, mock_writeback, mock_size):
+        ea.run_rule(ea.rules[0], END, START)
+    assert mock_size.call_count == 0
+    assert 'state_size' not in ea.rules[0]
+    body = mock_writeback.call_args[0][1]
+    assert 'state_size' not in body
+    assert 'state_keys' not in body
+
+
+def test_state_snapshots(ea, tmpdir):
+    ea.state_snapshot_dir = str(tmpdir)
+    frequency_rule = {'num_events': 10, 'timeframe': datetime.timedelta(hours=1), 'timestamp_field': '@timestamp'}
+    rule = ea.rules[0]
+    rule['type'] = FrequencyRule(frequency_rule)
+    rule['type'].add_data([{'@timestamp': ts_now()}, {'@timestamp': ts_now()}])
+    rule['processed_hits'] = {'abcd': ts_now()}
+    rule['previous_endtime'] = ts_now()
+    ea.write_state_snapshots()
+
+    new_rule = copy.copy(rule)
+    new_rule['type'] = FrequencyRule(frequency_rule)
+    new_rule['processed_hits'] = {}
+    assert ea.load_state_snapshot(new_rule)
+    assert new_rule['type'].occurrences['all'].count() == 2
+    assert new_rule['processed_hits'].keys() == ['abcd']
+
+    # A different rule type is not restored
+    new_rule['type'] = AnyRule({})
+    assert not ea.load_state_snapshot(new_rule)
+
+    # Nor is a snapshot older than old_query_limit
+    rule['previous_endtime'] = ts_now() - ea.old_query_limit - datetime.timedelta(hours=1)
+    ea.write_state_snapshots()
+    new_rule['type'] = FrequencyRule(frequency_rule)
+    assert not ea.load_state_snapshot(new_rule)
+    assert new_rule['type'].occurrences == {}
+
+    # Nor a corrupt file
+    tmpdir.join(ea.get_state_snapshot_path(rule).split('/')[-1]).write('garbage')
+    assert not ea.load_state_snapshot(new_rule)
+
+
+def test_init_rule_carries_state(ea):
+    new_rule = copy.copy(ea.rules[0])
+    new_rule['type'] = copy.copy(ea.rules[0]['type'])
+    ea.rules[0]['type'].get_state.return_value = {'occurrences': {'all': []}}
+    with mock.patch.object(ea, 'modify_rule_for_ES5'):
+        ea.init_rule(new_rule, new=False)
+    new_rule['type'].set_state.assert_called_once_with({'occurrences': {'all': []}})
+
+
+def test_alert_dispatcher(ea):
+    ea.alert_dispatcher = WorkerPool(2, retries=1, backoff=0)
+    ea.rules[0]['alert'][0].get_info = mock.Mock(return_value={'type': 'mock'})
+    ea.rules[0]['alert'][0].alert.side_effect = [EAException('Timed out'), None]
+    matches = [{'@timestamp': END_TIMESTAMP}, {'@timestamp': END_TIMESTAMP}]
+    with mock.patch.object(ea, 'writeback') as mock_writeback:
+        ea.alert(matches, ea.rules[0], alert_time=END)
+        ea.alert_dispatcher.stop()
+    # Results are not written one at a time
+    assert mock_writeback.call_count == 0
+    assert ea.rules[0]['alert'][0].alert.call_count == 2
+
+    ea.writeback_es.bulk.return_value = {'errors': False, 'items': []}
+    ea.flush_alert_results()
+    actions = ea.writeback_es.bulk.call_args[1]['body']
+    assert len(actions) == 4
+    agg_id = actions[0]['index']['_id']
+    assert actions[1]['alert_sent'] is True
+    assert '_id' not in actions[2]['index']
+    assert actions[3]['aggregate_id'] == agg_id
+
+
+def test_alert_dispatcher_uncaught_exception(ea):
+    ea.alert_dispatcher = WorkerPool(2, retries=0, backoff=0)
+    ea.disable_rules_on_error = True
+    rule = ea.rules[0]
+    with mock.patch.object(ea, 'run_alerters', side_effect=ValueError('bad rule')):
+        with mock.patch.object(ea, 'handle_error'):
+            ea.alert([{'@timestamp': END_TIMESTAMP}], rule, alert_time=END)
+            ea.alert_dispatcher.stop()
+    # Workers leave the rules and counts to the main thread
+    assert rule in ea.rules
+    assert ea.alerts_sent == 0
+
+    ea.flush_alert_results()
+    assert rule not in ea.rules
+    assert rule in ea.disabled_rules
+    assert not ea.writeback_es.bulk.called
+
+
+def test_alert_dispatcher_storm_control(ea):
+    ea.alert_dispatcher = WorkerPool(1, retries=0, backoff=0)
+    ea.storm_control = StormControl({'mock': (0.001, 1)}, ea.alert_dispatcher)
+    alerter = ea.rules[0]['alert'][0]
+    alerter.rule = ea.rules[0]
+    alerter.get_info = mock.Mock(return_value={'type': 'mock'})
+    alerter.get_destination = mock.Mock(return_value='#alerts')
+    alerter.max_coalesced_alerts = 10
+    ea.alert([{'@timestamp': END_TIMESTAMP}], ea.rules[0], alert_time=END)
+    ea.alert([{'@timestamp': END_TIMESTAMP}], ea.rules[0], alert_time=END)
+
+    # The held alert does not keep the only worker busy
+    done = threading.Event()
+    ea.alert_dispatcher.submit('other', done.set)
+    assert done.wait(5)
+    assert alerter.alert.call_count == 1
+
+    # Held alerts are sent, and written back, when the dispatcher stops
+    ea.writeback_es.bulk.return_value = {'errors': False, 'items': []}
+    ea.stop_alert_dispatcher()
+    assert alerter.alert.call_count == 2
+    actions = ea.writeback_es.bulk.call_args[1]['body']
+    assert len(actions) == 4
+    assert 'storm_control' not in actions[1]
+    assert actions[3]['alert_sent'] is True
+    assert actions[3]['storm_control'][0]['alerter'] == 'mock'
+
+
+def test_rule_init_workers(ea):
+    ea.rules = RuleRegistry()
+    ea.rule_hashes = {'a.yaml': 'x', 'b.yaml': 'x', 'c.yaml': 'x'}
+    ea.rule_initializer = WorkerPool(3, retries=0, default_concurrency=1)
+    release = threading.Event()
+    initializing = []
+    concurrent = []
+
+    def load_and_init_rule(rule):
+        initializing.append(rule['es_host'])
+        concurrent.append(initializing.count(rule['es_host']))
+        try:
+            if rule['name'] == 'a':
+                release.wait(5)
+            if rule['name'] == 'b':
+                raise EAException('no terms')
+            return rule
+        finally:
+            initializing.remove(rule['es_host'])
+
+    with mock.patch.object(ea, 'load_and_init_rule', side_effect=load_and_init_rule):
+        with mock.patch.object(ea, 'run_scheduled_rule') as mock_run:
+            with mock.patch.object(ea, 'handle_error') as mock_error:
+                # Rules a and b are on the same cluster, so only one of them is initialized at once
+                for name, host in [('a', 'es'), ('b', 'es'), ('c', 'other')]:
+                    ea.initializing_rules.add(name)
+                    ea.rule_initializer.submit(name, ea.initialize_rule, {'name': name, 'rule_key': name + '.yaml',
+                                                                          'es_host': host, 'es_port': 9200})
+                # Rule c runs as soon as it is ready, without waiting for a
+                ea.run_initialized_rules(0.1)
+                assert [rule['name'] for rule in ea.rules] == ['c']
+                assert mock_run.call_count == 1
+
+                release.set()
+                ea.run_initialized_rules(5)
+    ea.stop()
+    assert not ea.rule_initializer.running
+
+    assert not ea.initializing_rules
+    assert [rule['name'] for rule in ea.rules] == ['c', 'a']
+    assert [call[0][0]['name'] for call in mock_run.call_args_list] == ['c', 'a']
+    assert max(concurrent) == 1
+    mock_error.assert_called_once_with('Could not initialize rule b: no terms', {'rule': 'b'})
+
+
+def test_stop_stops_background_threads(ea):
+    ea.rule_watcher = mock.Mock()
+    ea.rule_initializer = mock.Mock()
+    ea.stop()
+    assert not ea.running
+    ea.rule_watcher.stop.assert_called_once_with()
+    ea.rule_initializer.stop.assert_called_once_with(cancel=True)
+
+
 def test_get_top_counts_handles_no_hits_returned(ea):
     with mock.patch.object(ea, 'get_hits_terms') as mock_hits:
         mock_hits.return_value = None
@@ -1109,3 +1453,33 @@ def test_remove_old_events(ea):
     ea.remove_old_events(ea.rules[0])
     assert len(ea.rules[0]['processed_hits']) == 2
     assert 'baz' not in ea.rules[0]['processed_hits']
+
+
+def test_match_with_batch_enhancement(ea):
+    mod = BaseEnhancement(ea.rules[0])
+    mod.process = mock.Mock()
+    mod.process_batch = mock.Mock(side_effect=lambda matches: matches[1:])
+    ea.rules[0]['match_enhancements'] = [mod]
+    ea.rules[0]['alert'] = [mock.Mock()]
+    matches = [{'@timestamp': END, 'n': 1}, {'@timestamp': END, 'n': 2}]
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.send_alert(matches, ea.rules[0])
+    mod.process_batch.assert_called_once_with(matches)
+    assert mod.process.call_count == 0
+    assert ea.rules[0]['alert'][0].alert.call_args[0][0] == [{'@timestamp': END, 'n': 2}]
+
+    # If every match is dropped, nothing is sent
+    mod.process_batch = mock.Mock(return_value=[])
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.send_alert(matches, ea.rules[0])
+    assert ea.rules[0]['alert'][0].alert.call_count == 1
+
+    # With run_enhancements_first, the rule's new matches are batched together
+    ea.rules[0]['run_enhancements_first'] = True
+    mod.process_batch = mock.Mock(side_effect=lambda matches: matches)
+    ea.rules[0]['type'].matches = [{'@timestamp': END}, {'@timestamp': END}]
+    ea.current_es.search.return_value = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    with mock.patch('elastalert.elastalert.elasticsearch_client'):
+        ea.run_rule(ea.rules[0], END, START)
+    assert mod.process_batch.call_count == 1
+    assert len(mod.process_batch.call_args[0][0]) == 2
@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import copy
 import datetime
+import io
+import json
+import os
 
 import mock
 import pytest
+import requests
+from requests.exceptions import RequestException
 
 import elastalert.alerts
 import elastalert.ruletypes
+from elastalert.config import ApiRuleSource
 from elastalert.config import get_file_paths
 from elastalert.config import load_rule_configuration
 from elastalert.config import load_modules
@@ -196,6 +202,50 @@ def test_load_default_host_port():
             assert rules['es_host'] == 'elasticsearch.test'
 
 
+def test_load_rules_cache(tmpdir):
+    test_config_copy = copy.deepcopy(test_config)
+    test_config_copy['rule_cache_dir'] = str(tmpdir)
+    args = copy.copy(test_args)
+    listdir = os.listdir
+
+    def load(rule, rebuild=False):
+        args.rebuild_rule_cache = rebuild
+        with mock.patch('elastalert.config.yaml_loader') as mock_open:
+            mock_open.side_effect = [copy.deepcopy(test_config_copy), copy.deepcopy(rule)]
+            with mock.patch('os.listdir') as mock_ls:
+                mock_ls.side_effect = lambda path: ['testrule.yaml'] if path == 'test_folder' else listdir(path)
+                with mock.patch('elastalert.config.load_options', wraps=load_options) as mock_load_options:
+                    with mock.patch('elastalert.config.elastalert_logger') as mock_logger:
+                        conf = load_rules(args)
+        return conf['rules'][0], mock_load_options.call_count, mock_logger.info.call_args[0][0]
+
+    rule, validated, log = load(test_rule)
+    assert validated == 1
+    assert log == 'Rule cache: 0 hits, 1 misses'
+    assert len(tmpdir.listdir()) == 1
+
+    # The unchanged rule is not validated again
+    cached_rule, validated, log = load(test_rule)
+    assert validated == 0
+    assert log == 'Rule cache: 1 hits, 0 misses'
+    assert cached_rule['timeframe'] == datetime.timedelta(minutes=10)
+    assert sorted(cached_rule['include']) == sorted(rule['include'])
+    assert cached_rule['ts_to_dt'] is rule['ts_to_dt']
+    assert isinstance(cached_rule['type'], elastalert.ruletypes.SpikeRule)
+
+    _, validated, log = load(test_rule, rebuild=True)
+    assert validated == 1
+    assert log == 'Rule cache: 0 hits, 1 misses'
+
+    # A changed rule is validated again and replaces the old one in the cache
+    changed_rule = copy.deepcopy(test_rule)
+    changed_rule['timeframe'] = {'minutes': 20}
+    cached_rule, validated, log = load(changed_rule)
+    assert validated == 1
+    assert cached_rule['timeframe'] == datetime.timedelta(minutes=20)
+    assert len(tmpdir.listdir()) == 1
+
+
 def test_compound_query_key():
     test_rule_copy = copy.deepcopy(test_rule)
     test_rule_copy.pop('use_count_query')
@@ -292,3 +342,79 @@ def test_get_file_paths():
     assert 'root/a.yaml' in paths
     assert 'root/b.yaml' in paths
     assert len(paths) == 2
+
+
+def mock_api_response(status_code, body=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.raw = io.BytesIO(json.dumps(body))
+    return response
+
+
+api_config = {'rules_type': 'api',
+              'rules_api_host': 'rules.test',
+              'rules_api_path': 'rules'}
+
+
+def test_api_rule_source_conditional_requests():
+    with mock.patch('elastalert.http.get_session') as mock_session:
+        session = mock_session.return_value
+        session.get.side_effect = [mock_api_response(200, {'rule1': {'name': 'rule1'}}, {'ETag': '"abc"'}),
+                                   mock_api_response(304)]
+        source = ApiRuleSource(api_config)
+        hashes = source.get_rule_hashes()
+        assert hashes.keys() == ['rule1']
+
+        # Nothing changed, so the rules are not hashed again
+        assert source.get_rule_hashes() is hashes
+    assert 'If-None-Match' not in session.get.call_args_list[0][1]['headers']
+    assert session.get.call_args_list[1][1]['headers']['If-None-Match'] == '"abc"'
+    assert session.get.call_args_list[1][0][0] == 'http://rules.test:80/rules'
+    assert session.get.call_args_list[1][1]['timeout'] == 30
+
+
+def test_api_rule_source_delta():
+    conf = dict(api_config, rules_api_delta=True)
+    with mock.patch('elastalert.http.get_session') as mock_session:
+        session = mock_session.return_value
+        session.get.side_effect = [
+            mock_api_response(200, {'rules': {'rule1': {'name': 'rule1'}, 'rule2': {'name': 'rule2'}}, 'version': 1}),
+            mock_api_response(200, {'rules': {'rule1': {'name': 'rule1b'}}, 'next': 'rules?since=1&page=2'}),
+            mock_api_response(200, {'deleted': ['rule2'], 'rules': {'rule3': {'name': 'rule3'}}, 'version': 2}),
+            mock_api_response(200, {'rules': {'rule4': {'name': 'rule4'}}, 'version': 3, 'full': True})]
+        source = ApiRuleSource(conf)
+        source.get_rule_hashes()
+        with mock.patch('elastalert.config.hash_rule', side_effect=lambda rule: rule['name']) as mock_hash:
+            new_hashes = source.get_rule_hashes()
+        # Only the rules which changed were hashed
+        assert mock_hash.call_count == 2
+        assert new_hashes == {'rule1': 'rule1b', 'rule3': 'rule3'}
+        assert source.version == 2
+
+        # A full rule set replaces the rules
+        assert source.get_rules() == {'rule4': {'name': 'rule4'}}
+    assert session.get.call_args_list[1][0][0] == 'http://rules.test:80/rules?since=1'
+    assert session.get.call_args_list[2][0][0] == 'http://rules.test:80/rules?since=1&page=2'
+    assert session.get.call_args_list[3][0][0] == 'http://rules.test:80/rules?since=2'
+
+
+def test_api_rule_source_cache(tmpdir):
+    conf = dict(api_config, rules_api_cache_file=str(tmpdir.join('rules.json')))
+    with mock.patch('elastalert.http.get_session') as mock_session:
+        response = mock_api_response(200, {'rule1': {'name': 'rule1'}}, {'Last-Modified': 'yesterday'})
+        mock_session.return_value.get.return_value = response
+        assert ApiRuleSource(conf).get_rules() == {'rule1': {'name': 'rule1'}}
+
+    # The last rules are used while the API cannot be reached
+    with mock.patch('elastalert.http.get_session') as mock_session:
+        session = mock_session.return_value
+        session.get.side_effect = RequestException('timed out')
+        assert ApiRuleSource(conf).get_rules() == {'rule1': {'name': 'rule1'}}
+    assert session.get.call_args[1]['headers']['If-Modified-Since'] == 'yesterday'
+
+    # Without a cache, the error is raised
+    with mock.patch('elastalert.http.get_session') as mock_session:
+        mock_session.return_value.get.side_effect = RequestException('timed out')
+        with pytest.raises(EAException):
+            ApiRuleSource(api_config).get_rules()
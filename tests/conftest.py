@@ -22,6 +22,7 @@ class mock_es_client(object):
         self.create = mock.Mock()
         self.index = mock.Mock()
         self.delete = mock.Mock()
+        self.bulk = mock.Mock()
         self.info = mock.Mock(return_value=mock_info)
 
 
@@ -34,6 +35,11 @@ class mock_ruletype(object):
         self.get_match_data = lambda x: x
         self.get_match_str = lambda x: "some stuff happened"
         self.garbage_collect = mock.Mock()
+        self.get_state_size = mock.Mock(return_value=0)
+        self.get_key_count = mock.Mock(return_value=0)
+        self.forget_oldest_keys = mock.Mock(return_value=0)
+        self.get_state = mock.Mock(return_value={})
+        self.set_state = mock.Mock()
 
 
 class mock_alert(object):
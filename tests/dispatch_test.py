@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import mock
+import pytest
+
+from elastalert.dispatch import StormControl
+from elastalert.dispatch import TokenBucket
+from elastalert.dispatch import WorkerPool
+from elastalert.util import EAException
+
+
+def test_dispatcher_runs_jobs_in_order_per_key():
+    dispatcher = WorkerPool(4)
+    sent = {'a': [], 'b': []}
+    for i in range(20):
+        dispatcher.submit('a', sent['a'].append, i)
+        dispatcher.submit('b', sent['b'].append, i)
+    dispatcher.stop()
+    assert sent['a'] == range(20)
+    assert sent['b'] == range(20)
+
+
+def test_dispatcher_does_not_block_other_keys():
+    dispatcher = WorkerPool(2)
+    release = threading.Event()
+    done = threading.Event()
+    dispatcher.submit('slow', release.wait)
+    dispatcher.submit('slow', mock.Mock())
+    dispatcher.submit('fast', done.set)
+    assert done.wait(5)
+    release.set()
+    dispatcher.stop()
+
+
+def test_dispatcher_concurrency():
+    dispatcher = WorkerPool(4, concurrency={'jira': 1})
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+
+    def alert():
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        threading.Event().wait(0.01)
+        with lock:
+            running[0] -= 1
+
+    for i in range(8):
+        dispatcher.submit(i, dispatcher.call, 'jira', alert)
+    dispatcher.stop()
+    assert most_running[0] == 1
+
+
+def test_dispatcher_retries():
+    dispatcher = WorkerPool(0, retries=2, backoff=0)
+    alert = mock.Mock(side_effect=[EAException(), EAException(), 'sent'])
+    assert dispatcher.call('email', alert) == 'sent'
+    assert alert.call_count == 3
+
+    alert = mock.Mock(side_effect=EAException())
+    with pytest.raises(EAException):
+        dispatcher.call('email', alert)
+    assert alert.call_count == 3
+
+    # Other exceptions are not retried
+    alert = mock.Mock(side_effect=ValueError())
+    with pytest.raises(ValueError):
+        dispatcher.call('email', alert)
+    assert alert.call_count == 1
+
+
+def test_dispatcher_results():
+    dispatcher = WorkerPool(1)
+    dispatcher.submit('a', dispatcher.add_result, 1)
+    dispatcher.submit('a', dispatcher.add_result, 2)
+    dispatcher.stop()
+    assert dispatcher.pop_results() == [1, 2]
+    assert dispatcher.pop_results() == []
+
+
+def test_worker_pool_stop_cancel():
+    pool = WorkerPool(1, name='elastalert-test')
+    assert [thread.name for thread in pool.threads] == ['elastalert-test-0']
+    started = threading.Event()
+    release = threading.Event()
+    pool.submit('a', lambda: started.set() or release.wait(5))
+    pool.submit('b', pool.add_result, 'b')
+    assert started.wait(5)
+    # The running job finishes, but the queued one is dropped
+    threading.Timer(0.1, release.set).start()
+    pool.stop(cancel=True)
+    assert release.is_set()
+    assert pool.pop_results() == []
+
+
+def test_token_bucket():
+    with mock.patch('time.time', return_value=100):
+        bucket = TokenBucket(0.5, burst=2)
+        assert bucket.take() == 0
+        assert bucket.take() == 0
+        assert bucket.take() == 2
+    with mock.patch('time.time', return_value=101):
+        assert bucket.take() == 1
+    with mock.patch('time.time', return_value=102):
+        assert bucket.take() == 0
+
+
+def mock_alerter(name, destination='#alerts', max_coalesced_alerts=10):
+    alerter = mock.Mock(rule={'name': name}, max_coalesced_alerts=max_coalesced_alerts)
+    alerter.get_destination.return_value = destination
+    return alerter
+
+
+def test_storm_control_coalesces_held_alerts():
+    pool = WorkerPool(2)
+    storm_control = StormControl({'slack': (0.001, 1)}, pool)
+    send = mock.Mock()
+    send_coalesced = mock.Mock()
+    sent = {}
+
+    def on_sent(name):
+        return lambda error, decision: sent.__setitem__(name, (error, decision))
+
+    # Alerts without a limit, or a destination, are sent straight away
+    assert storm_control.send('email', mock_alerter('a'), [1], send, send_coalesced, on_sent('a')) is False
+    assert storm_control.send('slack', mock_alerter('a', None), [1], send, send_coalesced, on_sent('a')) is False
+    assert storm_control.send('slack', mock_alerter('a'), [1], send, send_coalesced, on_sent('a')) is False
+    assert send.call_count == 3
+    assert sent == {}
+
+    # The bucket is empty, so the next alert is held without waiting, and later alerts are coalesced with it
+    leader = mock_alerter('leader')
+    assert storm_control.send('slack', leader, ['leader'], send, send_coalesced, on_sent('leader')) is True
+    for name in ['b', 'c']:
+        assert storm_control.send('slack', mock_alerter(name), [name], send, send_coalesced, on_sent(name)) is True
+    assert send.call_count == 3
+    assert send_coalesced.call_count == 0
+
+    # Stopping sends the held alerts on the pool's workers
+    storm_control.stop()
+    pool.stop()
+    assert send.call_count == 3
+    send_coalesced.assert_called_once_with(leader, mock.ANY)
+    coalesced = send_coalesced.call_args[0][1]
+    assert [matches for alerter, matches in coalesced] == [['leader'], ['b'], ['c']]
+    assert sent['leader'] == (None, mock.ANY)
+    assert sent['leader'][1]['coalesced_alerts'] == 3
+    assert sent['b'][1]['coalesced_into'] == 'leader'
+    assert sent['c'][1]['throttled_seconds'] >= 0
+
+    # Once stopped, alerts are no longer held
+    assert storm_control.send('slack', mock_alerter('d'), [1], send, send_coalesced, on_sent('d')) is False
+    assert send.call_count == 4
+
+
+def test_storm_control_releases_held_alerts():
+    pool = WorkerPool(1)
+    storm_control = StormControl({'slack': (1000, 1)}, pool)
+    storm_control.send('slack', mock_alerter('a'), [1], mock.Mock(), mock.Mock(), mock.Mock())
+
+    # Alerters which cannot coalesce are held for their own turn, and errors from sending them are passed on
+    send = mock.Mock(side_effect=EAException('rate limited'))
+    done = threading.Event()
+    errors = []
+
+    def on_sent(error, decision):
+        errors.append(error)
+        if len(errors) == 2:
+            done.set()
+
+    for name in ['b', 'c']:
+        assert storm_control.send('slack', mock_alerter(name, max_coalesced_alerts=1), [name], send, mock.Mock(), on_sent)
+    assert done.wait(5)
+    assert send.call_count == 2
+    assert all(isinstance(error, EAException) for error in errors)
+    assert storm_control.held == {}
+    storm_control.stop()
+    pool.stop()
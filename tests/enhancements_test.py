@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import time
+
+import mock
+
+from elastalert.enhancements import BaseEnhancement
+from elastalert.enhancements import cached_by_fields
+from elastalert.enhancements import EnhancementCache
+
+
+class LookupEnhancement(BaseEnhancement):
+    def __init__(self, rule):
+        super(LookupEnhancement, self).__init__(rule)
+        self.lookups = []
+
+    @cached_by_fields(['host', 'geo.country'], max_size=2)
+    def lookup(self, match):
+        self.lookups.append(match['host'])
+        return match['host'].upper()
+
+    def process(self, match):
+        match['host_info'] = self.lookup(match)
+
+
+def test_cached_by_fields():
+    enhancement = LookupEnhancement({})
+    matches = [{'host': 'a', 'geo': {'country': 'x'}},
+               {'host': 'a', 'geo': {'country': 'x'}},
+               {'host': 'a', 'geo': {'country': 'y'}},
+               {'host': 'b'},
+               {'host': 'a', 'geo': {'country': 'x'}}]
+    for match in matches:
+        enhancement.process(match)
+    assert [match['host_info'] for match in matches] == ['A', 'A', 'A', 'B', 'A']
+    # The first key is evicted when the third is added
+    assert enhancement.lookups == ['a', 'a', 'b', 'a']
+    assert enhancement.get_cache_stats() == {'lookup': {'hits': 1, 'misses': 4, 'hit_rate': 0.2, 'size': 2}}
+
+    # Each instance has its own cache
+    assert LookupEnhancement({}).get_cache_stats() == {}
+
+    # Unhashable values are not cached
+    match = {'host': 'c', 'geo': {'country': ['x']}}
+    enhancement.process(match)
+    enhancement.process(match)
+    assert enhancement.lookups[-2:] == ['c', 'c']
+
+
+def test_enhancement_cache_ttl():
+    cache = EnhancementCache(ttl=10)
+    cache.set('key', 'value')
+    assert cache.get('key') == (True, 'value')
+    with mock.patch('time.time', return_value=time.time() + 11):
+        assert cache.get('key') == (False, None)
+    assert cache.get_stats()['hit_rate'] == 0.5
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+
+import mock
+import requests
+
+from elastalert.http import get_session
+from elastalert.http import HttpConnection
+from elastalert.http import HttpsConnection
+
+
+def gzipped_response(body):
+    data = io.BytesIO()
+    with gzip.GzipFile(fileobj=data, mode='wb') as fh:
+        fh.write(body)
+    raw = requests.packages.urllib3.HTTPResponse(io.BytesIO(data.getvalue()), headers={'Content-Encoding': 'gzip'},
+                                                 status=200, preload_content=False)
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = raw
+    return response
+
+
+def test_sessions_are_shared():
+    with mock.patch('elastalert.http.sessions', {}):
+        conn = HttpConnection('example.com')
+        assert HttpConnection('example.com', port=80).session is conn.session
+        assert HttpConnection('example.com', port=8080).session is not conn.session
+        assert HttpsConnection('example.com').session is not conn.session
+        assert get_session('http', 'example.com', 80, retries=0) is not conn.session
+
+        retry = conn.session.get_adapter('http://example.com').max_retries
+        assert retry.total == 3
+        assert 503 in retry.status_forcelist
+
+
+def test_response_decodes_json_once():
+    session = mock.Mock()
+    session.get.return_value = gzipped_response('{"rules": [1, 2]}')
+    conn = HttpConnection('example.com', session=session, timeout=(5, 60))
+    conn.get('rules', params={'names': ['a', 'b']})
+    assert conn.response.decode_json() == {'rules': [1, 2]}
+    assert conn.response.decode_json() == {'rules': [1, 2]}
+    session.get.assert_called_once_with('http://example.com:80/rules', params={'names': 'a,b'}, headers=None,
+                                        timeout=(5, 60), stream=True)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+import subprocess
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(*args):
+    process = subprocess.Popen([sys.executable] + list(args), cwd=root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = process.communicate()
+    return process.returncode, stdout, stderr
+
+
+def test_alerter_libraries_imported_lazily():
+    libraries = ['boto3', 'exotel', 'jira', 'stomp', 'texttable', 'twilio']
+    returncode, stdout, _ = run_python('-c', 'import sys; import elastalert.config; '
+                                             'print(" ".join(m for m in %r if m in sys.modules))' % (libraries))
+    assert returncode == 0
+    assert stdout.strip() == ''
+
+
+def test_import_time_budget():
+    returncode, stdout, stderr = run_python('-m', 'elastalert.import_time', '--budget', '0', 'elastalert.config')
+    assert returncode == 1
+    assert 'Importing elastalert.config took' in stdout
+    assert 'import time: self [us] | cumulative | imported package' in stderr
+    assert '| elastalert.config' in stderr
+    assert 'longer than the budget' in stderr
+
+    returncode, stdout, stderr = run_python('-m', 'elastalert.import_time', '--budget', '60', 'elastalert.config')
+    assert returncode == 0
+    assert 'longer than the budget' not in stderr
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import urllib2
+
+import pytest
+
+from elastalert.metrics import Metrics
+from elastalert.metrics import MetricsServer
+
+
+def test_metrics_render():
+    metrics = Metrics()
+    metrics.inc('elastalert_hits_total', 5, rule='rule "1"')
+    metrics.inc('elastalert_hits_total', 2, rule='rule "1"')
+    metrics.set('elastalert_rule_state_bytes', 1024, rule='rule2')
+    metrics.observe('elastalert_query_seconds', 0.02, rule='rule2', type='count')
+    metrics.observe('elastalert_query_seconds', 1000, rule='rule2', type='count')
+
+    lines = metrics.render().splitlines()
+    assert '# TYPE elastalert_hits_total counter' in lines
+    assert 'elastalert_hits_total{rule="rule \\"1\\""} 7.0' in lines
+    assert 'elastalert_rule_state_bytes{rule="rule2"} 1024.0' in lines
+    assert 'elastalert_query_seconds_bucket{rule="rule2",type="count",le="0.01"} 0' in lines
+    assert 'elastalert_query_seconds_bucket{rule="rule2",type="count",le="0.025"} 1' in lines
+    assert 'elastalert_query_seconds_bucket{rule="rule2",type="count",le="300.0"} 1' in lines
+    assert 'elastalert_query_seconds_bucket{rule="rule2",type="count",le="+Inf"} 2' in lines
+    assert 'elastalert_query_seconds_sum{rule="rule2",type="count"} 1000.02' in lines
+    assert 'elastalert_query_seconds_count{rule="rule2",type="count"} 2' in lines
+
+    metrics.remove(rule='rule2')
+    assert metrics.get('elastalert_rule_state_bytes', rule='rule2') is None
+    assert metrics.get('elastalert_query_seconds', rule='rule2', type='count') is None
+    assert metrics.get('elastalert_hits_total', rule='rule "1"') == 7
+
+    with pytest.raises(KeyError):
+        metrics.inc('elastalert_unknown_total')
+
+
+def test_metrics_server():
+    metrics = Metrics()
+    metrics.inc('elastalert_matches_total', rule='rule1')
+    server = MetricsServer(metrics, 0, host='127.0.0.1')
+    server.start()
+    try:
+        response = urllib2.urlopen('http://127.0.0.1:%d/metrics' % (server.port), timeout=5)
+        assert response.info()['Content-Type'].startswith('text/plain')
+        assert 'elastalert_matches_total{rule="rule1"} 1.0' in response.read().splitlines()
+
+        with pytest.raises(urllib2.HTTPError):
+            urllib2.urlopen('http://127.0.0.1:%d/' % (server.port), timeout=5)
+    finally:
+        server.stop()
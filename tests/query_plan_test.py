@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from elastalert.query_plan import QueryPlan
+from elastalert.util import dt_to_ts
+from elastalert.util import ts_to_dt
+
+START = ts_to_dt('2014-01-01T00:00:00Z')
+END = ts_to_dt('2014-01-01T01:00:00Z')
+
+
+def get_rule(**options):
+    rule = {'filter': [{'term': {'user': 'alice'}}], 'timestamp_field': '@timestamp', 'dt_to_ts': dt_to_ts,
+            'five': False}
+    rule.update(options)
+    return rule
+
+
+def test_query_plan_queries():
+    plan = QueryPlan(get_rule())
+    time_range = {'range': {'@timestamp': {'gt': '2014-01-01T00:00:00Z', 'lte': '2014-01-01T01:00:00Z'}}}
+    must = [time_range, {'term': {'user': 'alice'}}]
+    assert plan.get_query(START, END) == {'query': {'filtered': {'filter': {'bool': {'must': must}}}},
+                                          'sort': [{'@timestamp': {'order': 'asc'}}]}
+
+    terms_query = plan.get_terms_query(START, END, 'host', 10, [{'term': {'qk': 'a'}}])
+    assert terms_query == {'aggs': {'filtered': {'filter': {'bool': {'must': must + [{'term': {'qk': 'a'}}]}},
+                                                 'aggs': {'counts': {'terms': {'field': 'host', 'size': 10}}}}}}
+    # Each query gets its own list of filters
+    assert plan.get_terms_query(START, END, 'host', 10)['aggs']['filtered']['filter']['bool']['must'] == must
+
+    plan = QueryPlan(get_rule(five=True, aggregation_query_element={'cpu_avg': {'avg': {'field': 'cpu'}}},
+                              bucket_interval_period='5m'))
+    assert plan.get_aggregation_query(START, END, 'a,b', 5) == {
+        'query': {'bool': {'filter': {'bool': {'must': must}}}},
+        'aggs': {'bucket_aggs': {'terms': {'field': 'a', 'size': 5}, 'aggs': {
+            'bucket_aggs': {'terms': {'field': 'b', 'size': 5}, 'aggs': {
+                'interval_aggs': {'date_histogram': {'field': '@timestamp', 'interval': '5m'},
+                                  'aggs': {'cpu_avg': {'avg': {'field': 'cpu'}}}}}}}}}}
+
+
+def test_query_plan_is_current():
+    rule = get_rule()
+    plan = QueryPlan(rule)
+    assert plan.is_current(rule)
+
+    rule['filter'].append({'term': {'host': 'a'}})
+    assert not plan.is_current(rule)
+
+    rule = get_rule()
+    plan = QueryPlan(rule)
+    rule['five'] = True
+    assert not plan.is_current(rule)
+
+    rule = get_rule()
+    plan = QueryPlan(rule)
+    rule['dt_to_ts'] = lambda dt: dt.isoformat() if isinstance(dt, datetime.datetime) else dt
+    assert not plan.is_current(rule)
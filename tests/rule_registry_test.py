@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from elastalert.rule_registry import RuleRegistry
+from elastalert.util import EAException
+
+
+def test_rule_registry():
+    rule1 = {'name': 'rule1', 'rule_key': 'rule1.yaml'}
+    rule2 = {'name': 'rule2', 'rule_key': 'rule2.yaml'}
+    registry = RuleRegistry([rule1, rule2])
+    assert len(registry) == 2
+    assert registry.get('rule1') is rule1
+    assert registry.get_by_key('rule2.yaml') is rule2
+    assert registry.get('rule3') is None
+    assert registry[1] is rule2
+    assert rule1 in registry
+    assert dict(rule1) not in registry
+
+    # Reloading a file replaces its rule, even if the rule was renamed
+    renamed = {'name': 'renamed', 'rule_key': 'rule1.yaml'}
+    registry.add(renamed)
+    assert list(registry) == [rule2, renamed]
+    assert registry.get('rule1') is None
+    assert registry.get_by_key('rule1.yaml') is renamed
+
+    # A rule from another file with the same name is not replaced
+    with pytest.raises(EAException):
+        registry.add({'name': 'rule2', 'rule_key': 'rule3.yaml'})
+    assert registry.get('rule2') is rule2
+    assert len(registry) == 2
+
+    # Iterating uses a snapshot, so rules can be removed while iterating
+    for rule in registry:
+        assert registry.remove(rule) is rule
+    assert len(registry) == 0
+    assert registry.get_by_key('rule1.yaml') is None
+    assert registry.remove(rule1) is None
+
+    registry.add(rule1)
+    assert registry.remove_key('rule1.yaml') is rule1
+    assert registry.remove_key('rule1.yaml') is None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+import mock
+import pytest
+
+from elastalert.config import hash_rule
+from elastalert.rule_watcher import RuleWatcher
+
+
+def write_rule(path, name, mtime=None):
+    with open(path, 'w') as fh:
+        fh.write('name: %s\n' % (name))
+    if mtime:
+        os.utime(path, (mtime, mtime))
+
+
+def rules_conf(tmpdir):
+    return {'rules_folder': str(tmpdir), 'scan_subdirectories': True}
+
+
+def test_rule_watcher_parses_changed_files(tmpdir):
+    rule1 = str(tmpdir.join('rule1.yaml'))
+    rule2 = str(tmpdir.join('rule2.yaml'))
+    write_rule(rule1, 'rule1', 1000)
+    write_rule(rule2, 'rule2', 1000)
+    watcher = RuleWatcher(rules_conf(tmpdir), interval=3600)
+    try:
+        hashes = watcher.get_rule_hashes()
+        assert hashes == {rule1: hash_rule({'name': 'rule1', 'rule_key': rule1}),
+                          rule2: hash_rule({'name': 'rule2', 'rule_key': rule2})}
+
+        # Nothing changed, so no files are read
+        with mock.patch('elastalert.rule_watcher.load_rule_file') as mock_load:
+            watcher.scan()
+        assert mock_load.call_count == 0
+        assert watcher.get_rule_hashes() is hashes
+
+        # Only the changed and new files are read
+        write_rule(rule2, 'rule2b', 2000)
+        rule3 = str(tmpdir.join('rule3.yaml'))
+        write_rule(rule3, 'rule3')
+        tmpdir.join('notes.txt').write('not a rule')
+        with mock.patch('elastalert.rule_watcher.load_rule_file', side_effect=lambda path: {'path': path}) as mock_load:
+            watcher.scan()
+        assert sorted(call[0][0] for call in mock_load.call_args_list) == [rule2, rule3]
+        hashes = watcher.get_rule_hashes()
+        assert hashes[rule1] == hash_rule({'name': 'rule1', 'rule_key': rule1})
+        assert hashes[rule2] == hash_rule({'path': rule2})
+        assert hashes[rule3] == hash_rule({'path': rule3})
+
+        # Deleted files are removed and files which cannot be parsed have no hash
+        os.remove(rule1)
+        with open(rule2, 'w') as fh:
+            fh.write('name: [')
+        watcher.scan()
+        assert watcher.get_rule_hashes() == {rule2: None, rule3: hashes[rule3]}
+    finally:
+        watcher.stop()
+
+
+def test_rule_watcher_changed_paths(tmpdir):
+    rule1 = str(tmpdir.join('rule1.yaml'))
+    write_rule(rule1, 'rule1', 1000)
+    watcher = RuleWatcher(rules_conf(tmpdir), interval=3600)
+    try:
+        rule2 = str(tmpdir.join('rule2.yaml'))
+        write_rule(rule2, 'rule2')
+        write_rule(rule1, 'rule1b', 2000)
+
+        # Only the paths which were reported are checked
+        watcher.scan([rule2])
+        assert watcher.get_rule_hashes() == {rule1: hash_rule({'name': 'rule1', 'rule_key': rule1}),
+                                             rule2: hash_rule({'name': 'rule2', 'rule_key': rule2})}
+
+        os.remove(rule2)
+        watcher.scan([rule1, rule2, str(tmpdir.join('notes.txt'))])
+        assert watcher.get_rule_hashes() == {rule1: hash_rule({'name': 'rule1b', 'rule_key': rule1})}
+    finally:
+        watcher.stop()
+
+
+def test_rule_watcher_inotify(tmpdir):
+    pytest.importorskip('pyinotify')
+    rule1 = str(tmpdir.join('rule1.yaml'))
+    write_rule(rule1, 'rule1')
+    watcher = RuleWatcher(rules_conf(tmpdir), interval=0.05, use_inotify=True)
+    try:
+        assert watcher.inotify
+        tmpdir.mkdir('sub')
+        rule2 = str(tmpdir.join('sub', 'rule2.yaml'))
+        deadline = time.time() + 5
+        while rule2 not in watcher.get_rule_hashes() and time.time() < deadline:
+            # The new directory is watched once its creation is noticed
+            write_rule(rule2, 'rule2')
+            time.sleep(0.05)
+        assert watcher.get_rule_hashes()[rule2] == hash_rule({'name': 'rule2', 'rule_key': rule2})
+
+        os.remove(rule1)
+        while rule1 in watcher.get_rule_hashes() and time.time() < deadline:
+            time.sleep(0.05)
+        assert watcher.get_rule_hashes().keys() == [rule2]
+    finally:
+        watcher.stop()
+
+
+def test_rule_watcher_inotify_unavailable(tmpdir):
+    with mock.patch('elastalert.rule_watcher.pyinotify') as mock_pyinotify:
+        mock_pyinotify.WatchManager.side_effect = ImportError('No module named pyinotify')
+        watcher = RuleWatcher(rules_conf(tmpdir), interval=3600, use_inotify=True)
+    try:
+        assert watcher.inotify is None
+    finally:
+        watcher.stop()
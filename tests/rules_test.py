@@ -10,6 +10,7 @@ from elastalert.ruletypes import BaseAggregationRule
 from elastalert.ruletypes import BlacklistRule
 from elastalert.ruletypes import CardinalityRule
 from elastalert.ruletypes import ChangeRule
+from elastalert.ruletypes import DeadlineQueue
 from elastalert.ruletypes import EventWindow
 from elastalert.ruletypes import FlatlineRule
 from elastalert.ruletypes import FrequencyRule
@@ -183,6 +184,43 @@ def test_freq_terms():
     assert rule.matches[1].get('username') == 'userA'
 
 
+def test_freq_garbage_collect_by_deadline():
+    rules = {'num_events': 10,
+             'timeframe': datetime.timedelta(minutes=10),
+             'query_key': 'username'}
+    rule = FrequencyRule(rules)
+    rule.add_data([create_event(ts_to_dt('2014-01-01T00:00:00Z'), username='old')])
+    rule.add_data([create_event(ts_to_dt('2014-01-01T00:08:00Z'), username='new')])
+    assert len(rule.deadlines) == 2
+
+    # Only the window for 'old' has expired
+    rule.garbage_collect(ts_to_dt('2014-01-01T00:11:00Z'))
+    assert rule.occurrences.keys() == ['new']
+
+    # 'new' received more data, so its window is rescheduled rather than removed
+    rule.add_data([create_event(ts_to_dt('2014-01-01T00:12:00Z'), username='new')])
+    rule.garbage_collect(ts_to_dt('2014-01-01T00:19:00Z'))
+    assert rule.occurrences.keys() == ['new']
+    assert rule.deadlines.deadlines['new'] == ts_to_dt('2014-01-01T00:22:00Z')
+    rule.garbage_collect(ts_to_dt('2014-01-01T00:23:00Z'))
+    assert rule.occurrences == {}
+    assert len(rule.deadlines) == 0
+
+
+def test_deadline_queue():
+    queue = DeadlineQueue()
+    queue.schedule('a', 3)
+    queue.schedule('b', 1)
+    queue.schedule('c', 2)
+    queue.schedule('a', 5, keep_earlier=True)
+    queue.schedule('b', 4)
+    queue.discard('c')
+    assert queue.pop_due(3, inclusive=False) == []
+    assert queue.pop_due(3) == ['a']
+    assert queue.pop_due(10) == ['b']
+    assert len(queue) == 0
+
+
 def test_eventwindow():
     timeframe = datetime.timedelta(minutes=10)
     window = EventWindow(timeframe)
@@ -494,6 +532,126 @@ def test_change():
     assert rule.matches == []
 
 
+def test_change_max_keys():
+    rules = {'compound_compare_key': ['term'],
+             'query_key': 'username',
+             'ignore_null': True,
+             'timestamp_field': '@timestamp',
+             'change_max_keys': 2}
+    rule = ChangeRule(rules)
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:00:00Z'), username='a', term='good'),
+                   create_event(ts_to_dt('2014-09-26T12:00:01Z'), username='b', term='good'),
+                   create_event(ts_to_dt('2014-09-26T12:00:02Z'), username='a', term='good'),
+                   create_event(ts_to_dt('2014-09-26T12:00:03Z'), username='c', term='good')])
+    # b was the least recently updated
+    assert rule.get_key_count() == 2
+    assert set(rule.occurrences.keys()) == set(['a', 'c'])
+
+    # a still changes, b is treated as a new key
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:00:04Z'), username='a', term='bad'),
+                   create_event(ts_to_dt('2014-09-26T12:00:05Z'), username='b', term='bad')])
+    assert_matches_have(rule.matches, [('username', 'a', 'term', 'bad')])
+    assert rule.get_key_count() == 2
+
+
+def test_change_key_ttl():
+    rules = {'compound_compare_key': ['term'],
+             'query_key': 'username',
+             'ignore_null': True,
+             'timestamp_field': '@timestamp',
+             'change_key_ttl': datetime.timedelta(minutes=5)}
+    rule = ChangeRule(rules)
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:00:00Z'), username='a', term='good'),
+                   create_event(ts_to_dt('2014-09-26T12:03:00Z'), username='b', term='good')])
+    assert rule.get_key_count() == 2
+
+    rule.garbage_collect(ts_to_dt('2014-09-26T12:06:00Z'))
+    assert rule.occurrences.keys() == ['b']
+    assert 'a' not in rule.occurrence_time
+
+    # Without a timeframe, ttl only bounds memory, any change to a remembered key matches
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:07:00Z'), username='a', term='bad'),
+                   create_event(ts_to_dt('2014-09-26T12:07:30Z'), username='b', term='bad')])
+    assert_matches_have(rule.matches, [('username', 'b', 'term', 'bad')])
+
+    # A rule reloaded with a TTL forgets the keys restored from a rule without one, which have no time
+    rules.pop('change_key_ttl')
+    rule = ChangeRule(copy.copy(rules))
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:00:00Z'), username='a', term='good')])
+    assert rule.occurrence_time == {}
+    reloaded = ChangeRule(dict(rules, change_key_ttl=datetime.timedelta(minutes=5)))
+    reloaded.set_state(rule.get_state())
+    reloaded.add_data([create_event(ts_to_dt('2014-09-26T12:01:00Z'), username='b', term='good')])
+    assert reloaded.occurrences.keys() == ['b']
+
+
+def test_forget_oldest_keys():
+    rules = {'num_events': 10,
+             'timeframe': datetime.timedelta(hours=1),
+             'query_key': 'username'}
+    rule = FrequencyRule(rules)
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:00:00Z'), username='b'),
+                   create_event(ts_to_dt('2014-09-26T12:01:00Z'), username='a'),
+                   create_event(ts_to_dt('2014-09-26T12:02:00Z'), username='c'),
+                   create_event(ts_to_dt('2014-09-26T12:03:00Z'), username='b')])
+    assert rule.get_key_count() == 3
+    size = rule.get_state_size()
+    assert rule.get_keys_by_age() == ['a', 'c', 'b']
+
+    assert rule.forget_oldest_keys(2) == 2
+    assert rule.occurrences.keys() == ['b']
+    assert 'a' not in rule.deadlines
+    assert rule.get_state_size() < size
+
+    # Forgotten keys start over
+    rule.add_data([create_event(ts_to_dt('2014-09-26T12:04:00Z'), username='a')])
+    assert rule.occurrences['a'].count() == 1
+    assert rule.forget_oldest_keys(5) == 2
+    assert rule.get_key_count() == 0
+
+
+def test_rule_state_round_trip():
+    rules = {'timeframe': datetime.timedelta(seconds=10),
+             'spike_height': 2,
+             'spike_type': 'up',
+             'timestamp_field': '@timestamp'}
+    rule = SpikeRule(rules)
+    rule.add_data(hits(25, timestamp_field='@timestamp'))
+    assert rule.ref_window_filled_once
+
+    # A restarted rule can alert straight away
+    restored = SpikeRule(copy.copy(rules))
+    restored.set_state(rule.get_state())
+    assert restored.ref_window_filled_once
+    assert restored.ref_windows['all'].count() == rule.ref_windows['all'].count()
+    assert restored.cur_windows['all'].count() == rule.cur_windows['all'].count()
+
+    # Windows are trimmed to the timeframe of the restored rule
+    rules = {'num_events': 100,
+             'timeframe': datetime.timedelta(hours=1),
+             'timestamp_field': '@timestamp'}
+    rule = FrequencyRule(rules)
+    rule.add_data(hits(25, timestamp_field='@timestamp'))
+    restored = FrequencyRule(dict(rules, timeframe=datetime.timedelta(seconds=10)))
+    restored.set_state(rule.get_state())
+    assert restored.occurrences['all'].count() == 10
+    assert 'all' in restored.deadlines
+
+
+def test_change_state_per_instance():
+    rules = {'compound_compare_key': ['term'],
+             'query_key': 'username',
+             'ignore_null': True,
+             'timestamp_field': '@timestamp'}
+    rule1 = ChangeRule(copy.copy(rules))
+    rule2 = ChangeRule(copy.copy(rules))
+    rule1.add_data(hits(5, username='qlo', term='good'))
+    assert rule1.get_key_count() == 1
+    assert rule2.get_key_count() == 0
+    assert rule2.occurrence_time == {}
+    assert rule1.get_state_size() > rule2.get_state_size()
+
+
 def test_new_term():
     rules = {'fields': ['a', 'b'],
              'timestamp_field': '@timestamp',
@@ -821,6 +979,28 @@ def test_flatline_query_key():
     assert set(['key1', 'key2', 'key3']) == set([m['key'] for m in rule.matches if m['@timestamp'] == timestamp])
 
 
+def test_flatline_garbage_collect_skips_busy_keys():
+    rules = {'timeframe': datetime.timedelta(seconds=30),
+             'threshold': 2,
+             'query_key': 'qk',
+             'timestamp_field': '@timestamp'}
+    rule = FlatlineRule(rules)
+    rule.add_data(hits(20, qk='busy') + hits(1, qk='quiet'))
+    rule.garbage_collect(ts_to_dt('2014-09-26T12:00:20Z'))
+    assert rule.matches == []
+    busy_len = len(rule.occurrences['busy'].data)
+
+    # busy still has at least 2 events within the timeframe, so it is not touched
+    rule.garbage_collect(ts_to_dt('2014-09-26T12:00:31Z'))
+    assert [m['key'] for m in rule.matches] == ['quiet']
+    assert len(rule.occurrences['busy'].data) == busy_len
+
+    # Once a timeframe has passed since busy was first checked, and its 2 most recent events
+    # are more than a timeframe old, it matches too
+    rule.garbage_collect(ts_to_dt('2014-09-26T12:00:51Z'))
+    assert set(m['key'] for m in rule.matches[1:]) == set(['busy', 'quiet'])
+
+
 def test_cardinality_max():
     rules = {'max_cardinality': 4,
              'timeframe': datetime.timedelta(minutes=10),
@@ -1,5 +1,21 @@
 # -*- coding: utf-8 -*-
-from elastalert.util import lookup_es_key, set_es_key, add_raw_postfix, replace_dots_in_field_names
+import zlib
+
+import mock
+import pytest
+
+from elastalert.util import add_raw_postfix
+from elastalert.util import compile_format
+from elastalert.util import compile_resolve_string
+from elastalert.util import CompressedRequestsHttpConnection
+from elastalert.util import es_key_getter
+from elastalert.util import get_format_fields
+from elastalert.util import LazyImport
+from elastalert.util import lookup_es_key
+from elastalert.util import lookup_flat_key
+from elastalert.util import replace_dots_in_field_names
+from elastalert.util import resolve_string
+from elastalert.util import set_es_key
 
 
 def test_setting_keys(ea):
@@ -100,3 +116,83 @@ def test_replace_dots_in_field_names(ea):
     }
     assert replace_dots_in_field_names(actual) == expected
     assert replace_dots_in_field_names({'a': 0, 1: 2}) == {'a': 0, 1: 2}
+
+
+def test_resolve_string():
+    match = {
+        'name': 'mySystem',
+        'temperature': 45,
+        'values': [1, 2],
+        'nested': {'field': 'a', 'deeper': {'field': 'b'}},
+        'dotted.field': 'c',
+    }
+    assert resolve_string('{name} is {temperature}', match) == 'mySystem is 45'
+    assert resolve_string('%(nested.field)s %(nested.deeper.field)s %(dotted.field)s', match) == 'a b c'
+    assert resolve_string('{missing} %(missing)s', match, 'x') == 'x x'
+    assert resolve_string('{name:>10}', match) == '  mySystem'
+    # Nested dictionaries are not available to new-style formats, as with a flattened match
+    assert resolve_string('{nested}', match) == '<MISSING VALUE>'
+
+    # Strings are compiled once
+    with mock.patch('elastalert.util.compile_resolve_string', side_effect=compile_resolve_string) as mock_compile:
+        resolve_string('{name} again', match)
+        resolve_string('{name} again', {'name': 'other'})
+    assert mock_compile.call_count == 1
+
+
+def test_lookup_flat_key():
+    match = {'a': {'b': {'c': 1}}, 'a.b': {'d': 2}, 'e': {}}
+    assert lookup_flat_key(match, 'a.b.c') == 1
+    assert lookup_flat_key(match, 'a.b.d') == 2
+    for key in ['a', 'a.b', 'e', 'f', 'a.c']:
+        with pytest.raises(KeyError):
+            lookup_flat_key(match, key)
+
+
+def test_compile_format():
+    render = compile_format('{host} {value:.1f}')
+    assert render({'host': 'abc', 'value': 1.25, 'other': 0}) == 'abc 1.2'
+    with pytest.raises(KeyError):
+        render({'host': 'abc'})
+    assert get_format_fields('{a[0]} {b.c} {d:{e}}') == set(['a', 'b', 'd', 'e'])
+
+
+def test_es_key_getter():
+    record = {'a': {'b': 1}, 'c.d': 2, 'e': 3}
+    for term in ['a.b', 'c.d', 'e', 'f', 'a.f']:
+        assert es_key_getter(term)(record) == lookup_es_key(record, term)
+
+
+def test_lazy_import():
+    missing = LazyImport('elastalert_missing_module')
+    with pytest.raises(ImportError):
+        missing.anything
+
+    with mock.patch('importlib.import_module', return_value=mock.Mock(dumps=lambda obj: 'dumped')) as mock_import:
+        dumps = LazyImport('json', 'dumps')
+        assert mock_import.call_count == 0
+        assert dumps({}) == 'dumped'
+        assert dumps({}) == 'dumped'
+    assert mock_import.call_args_list == [mock.call('json')]
+
+
+def test_compressed_connection():
+    with mock.patch('elasticsearch.RequestsHttpConnection.perform_request', return_value=(200, {}, '{}')) as mock_request:
+        connection = CompressedRequestsHttpConnection(http_compress=True)
+        connection.perform_request('GET', '/idx/_search', body='{"query": {}}')
+    body, headers = mock_request.call_args[0][3], mock_request.call_args[0][6]
+    assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == '{"query": {}}'
+    assert headers == {'content-encoding': 'gzip'}
+    assert connection.bytes_sent == len(body)
+    assert connection.session.headers['accept-encoding'] == 'gzip'
+
+    response = mock.Mock()
+    response.raw.tell.return_value = 123
+    connection.count_response(response)
+    assert connection.bytes_received == 123
+
+    with mock.patch('elasticsearch.RequestsHttpConnection.perform_request', return_value=(200, {}, '{}')) as mock_request:
+        connection = CompressedRequestsHttpConnection()
+        connection.perform_request('GET', '/idx/_search', body='{"query": {}}')
+    assert mock_request.call_args[0][3] == '{"query": {}}'
+    assert 'accept-encoding' not in connection.session.headers